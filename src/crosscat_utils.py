@@ -17,6 +17,7 @@
 import json
 
 import numpy as np
+import pandas as pd
 import matplotlib
 from matplotlib import pyplot as plt
 from matplotlib.patches import Rectangle
@@ -128,6 +129,66 @@ def plot_crosscat_chain_diagnostics(bdb, diagnostic, generator):
 
     return figure
 
+@population_method(population_to_bdb=0, generator_name=1)
+def similar_rows(bdb, generator, rowids=None, k=10, among=None,
+        modelnos=None):
+    """Find the k rows most similar to each of the given rows.
+
+    Crosscat's similarity of two rows is the fraction of columns whose view
+    puts them in the same cluster, averaged over models, so two rows which
+    share no cluster in any view of any model have similarity 0.  Rather
+    than estimating the similarity of a row to every row, as ``ESTIMATE
+    SIMILARITY`` does, it is computed only for the rows which share a
+    cluster with it, and only the best k of those are kept.  How many rows
+    that rules out depends on the models: a view with a single cluster
+    leaves every row a candidate.
+
+    Only the rows the generator models are considered, which are all of
+    them unless it was created with a subsample.
+
+    Parameters
+    ----------
+    bdb : __population_to_bdb__
+    generator : __generator_name__
+    rowids : list of int
+        Rows to find the neighbors of. Defaults to every row modelled.
+    k : int
+        Number of neighbors to find for each row, which is its own nearest
+        neighbor. A row which shares a cluster with fewer than k rows has
+        fewer neighbors.
+    among : list of int
+        Rows which may be neighbors. Defaults to every row modelled.
+    modelnos : list of int
+        Models to average the similarity over. Defaults to all models.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        The neighbors of each row of rowids, most similar first, with
+        columns rowid0 for the row, rowid1 for its neighbor and value for
+        their similarity.
+    """
+    if k < 1:
+        raise BLE(ValueError('Invalid number of neighbors %d' % (k,)))
+    generator_id = bayeslite.core.bayesdb_get_generator(bdb, generator)
+    clusters = RowClusters(bdb, generator_id, modelnos=modelnos)
+    if rowids is None:
+        rowids = clusters.rowids
+    candidates = None if among is None else clusters.mask(among)
+    rowid0 = []
+    rowid1 = [np.zeros(0, dtype=np.int64)]
+    values = [np.zeros(0)]
+    for rowid in rowids:
+        neighbors, similarities = clusters.neighbors(rowid, k, candidates)
+        rowid0.extend([rowid] * len(neighbors))
+        rowid1.append(neighbors)
+        values.append(similarities)
+    return pd.DataFrame({
+        'rowid0': np.array(rowid0, dtype=np.int64),
+        'rowid1': np.concatenate(rowid1),
+        'value': np.concatenate(values),
+    }, columns=['rowid0', 'rowid1', 'value'])
+
 ###############################################################################
 ###                              INTERNAL                                   ###
 ###############################################################################
@@ -141,6 +202,129 @@ def get_rows_in_cluster(X_D, view, cluster):
     return [r for r, c in enumerate(X_D[view]) if c == cluster]
 
 
+class RowClusters(object):
+    """Cluster assignments of the rows a crosscat generator models, in every
+    view of every model, indexed by cluster.
+
+    Each (model, view) pair is a column of labels, numbered so that no two
+    pairs share a label, and weighted by its share of the similarity: the
+    fraction of the columns in the view, over the number of models.
+    """
+
+    def __init__(self, bdb, generator_id, modelnos=None):
+        cursor = bdb.sql_execute('''
+            SELECT metamodel FROM bayesdb_generator WHERE id = ?
+        ''', (generator_id,))
+        metamodel = cursor.next()[0]
+        if metamodel.lower() != 'crosscat':
+            raise BLE(ValueError(
+                'Metamodel for generator %s (%s) should be crosscat' %
+                (bayeslite.core.bayesdb_generator_name(bdb, generator_id),
+                    metamodel)))
+        cursor = bdb.sql_execute('''
+            SELECT sql_rowid, cc_row_id FROM bayesdb_crosscat_subsample
+                WHERE generator_id = ?
+                ORDER BY sql_rowid ASC
+        ''', (generator_id,))
+        subsample = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, 2)
+        self.rowids = subsample[:, 0]
+        row_ids = subsample[:, 1]
+
+        labels = []
+        weights = []
+        nmodels = 0
+        for _modelno, theta in get_thetas(bdb, generator_id, modelnos):
+            views = theta['X_L']['column_partition']['assignments']
+            for view, assignments in enumerate(theta['X_D']):
+                offset = labels[-1].max() + 1 if labels else 0
+                labels.append(
+                    np.asarray(assignments, dtype=np.int64)[row_ids] + offset)
+                weights.append(views.count(view) / float(len(views)))
+            nmodels += 1
+        if nmodels == 0:
+            raise BLE(ValueError('No models of generator %s to find similar '
+                'rows with' %
+                (bayeslite.core.bayesdb_generator_name(bdb, generator_id),)))
+        self.labels = np.column_stack(labels)
+        self.weights = np.array(weights) / nmodels
+
+        # The rows with each label, all in one array: those labelled c are
+        # members[starts[c]:starts[c+1]].
+        flat = self.labels.ravel()
+        order = np.argsort(flat, kind='mergesort')
+        self.members = order // self.labels.shape[1]
+        self.starts = np.searchsorted(
+            flat[order], np.arange(self.labels.max() + 2))
+
+    def index(self, rowids):
+        """Return the positions of rowids among the rows modelled."""
+        rowids = np.asarray(rowids, dtype=np.int64)
+        index = np.searchsorted(self.rowids, rowids)
+        found = index < len(self.rowids)
+        found[found] = self.rowids[index[found]] == rowids[found]
+        if not found.all():
+            raise BLE(ValueError('Row %d is not modelled by the generator' %
+                (rowids[~found][0],)))
+        return index
+
+    def mask(self, rowids):
+        """Return a boolean array marking rowids among the rows modelled."""
+        mask = np.zeros(len(self.rowids), dtype=bool)
+        mask[self.index(rowids)] = True
+        return mask
+
+    def neighbors(self, rowid, k, candidates=None):
+        """Return the rowids of the k rows most similar to rowid, and their
+        similarities, most similar first and by rowid among ties.
+
+        Only the rows sharing a cluster with rowid are compared with it, and
+        of those only the ones marked in the boolean array candidates, if
+        given.
+        """
+        [i] = self.index([rowid])
+        own = self.labels[i]
+        others = np.unique(np.concatenate(
+            [self.members[self.starts[c]:self.starts[c + 1]] for c in own]))
+        if candidates is not None:
+            others = others[candidates[others]]
+        values = (self.labels[others] == own).dot(self.weights)
+        order = np.lexsort((self.rowids[others], -values))[:k]
+        return self.rowids[others[order]], values[order]
+
+
+def get_thetas(bdb, generator_id, modelnos=None):
+    """Return the (modelno, theta) pairs of the models of a crosscat
+    generator, in order of modelno, restricted to modelnos if given."""
+    cursor = bdb.sql_execute('''
+        SELECT modelno, theta_json FROM bayesdb_crosscat_theta
+            WHERE generator_id = ?
+            ORDER BY modelno ASC
+    ''', (generator_id,))
+    return [(modelno, json.loads(theta_json)) for modelno, theta_json in cursor
+        if modelnos is None or modelno in modelnos]
+
+
+def get_column_views(bdb, generator_id, colnos):
+    """Return the views of columns of a crosscat generator in its models.
+
+    Returns (modelnos, views), where views[m][i] is the view of the column
+    numbered colnos[i] in the model numbered modelnos[m].
+    """
+    cursor = bdb.sql_execute('''
+        SELECT colno, cc_colno FROM bayesdb_crosscat_column
+            WHERE generator_id = ?
+    ''', (generator_id,))
+    cc_colnos = dict(cursor.fetchall())
+    cc_colnos = [cc_colnos[colno] for colno in colnos]
+    modelnos = []
+    views = []
+    for modelno, theta in get_thetas(bdb, generator_id):
+        assignments = theta['X_L']['column_partition']['assignments']
+        modelnos.append(modelno)
+        views.append(np.array([assignments[c] for c in cc_colnos]))
+    return modelnos, views
+
+
 def get_M_c(bdb, generator_name):
     generator_id = bayeslite.core.bayesdb_get_generator(bdb, generator_name)
     sql = '''
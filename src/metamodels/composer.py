@@ -14,9 +14,16 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import collections
+import contextlib
+import hashlib
+import multiprocessing as mp
 import sqlite3
+import time
+import weakref
 
 import numpy as np
+import pandas as pd
 
 import bayeslite.core as core
 from bayeslite.exception import BayesLiteException as BLE
@@ -24,6 +31,8 @@ from bayeslite.math_util import logmeanexp
 from bayeslite.sqlite3_util import sqlite3_quote_name as quote
 from bayeslite.util import casefold
 
+from bdbcontrib.bql_utils import table_to_df
+
 from crosscat.utils import sample_utils as su
 
 import bayeslite.metamodel
@@ -118,20 +127,125 @@ BEGIN
 END;
 ''']
 
+composer_schema_2 = [
+'''
+UPDATE bayesdb_metamodel SET version = 2 WHERE name = 'composer';
+''','''
+CREATE TABLE bayesdb_composer_model_foreign_predictor(
+    generator_id INTEGER NOT NULL REFERENCES bayesdb_generator(id),
+    modelno INTEGER NOT NULL,
+    colno INTEGER NOT NULL,
+    predictor_binary BLOB NOT NULL,
+
+    PRIMARY KEY(generator_id, modelno, colno),
+    FOREIGN KEY(generator_id, modelno)
+        REFERENCES bayesdb_generator_model(generator_id, modelno),
+    FOREIGN KEY(generator_id, colno)
+        REFERENCES bayesdb_composer_column_foreign_predictor(generator_id,
+            colno)
+);
+''']
+
 class Composer(bayeslite.metamodel.IBayesDBMetamodel):
     """A metamodel which composes foreign predictors with CrossCat.
+
+    Parameters
+    ----------
+    n_samples : int, optional
+        Default number of weighted samples used to estimate densities and
+        mutual information.  Defaults to 100.
+    n_particles : int, optional
+        If given, :meth:`simulate` draws a single set of `n_particles`
+        weighted particles and resamples all of its predictions from it
+        (sampling-importance resampling), which is cheaper but makes the
+        predictions dependent: they repeat when the evidence is poorly
+        covered by the prior.  By default, each prediction is resampled
+        from `n_samples` particles of its own.  The effective sample size
+        of the particles is returned along with the predictions by
+        :meth:`simulate` and :meth:`simulate_rows` given `return_ess=True`.
+    predictor_cache_bytes : int, optional
+        Bound on the total size of the deserialized foreign predictors
+        kept in memory for each BayesDB handle, measured by the size of
+        their serialized form.  Defaults to 256 MiB.
+    training_processes : int, optional
+        Number of processes training foreign predictors in parallel during
+        INITIALIZE MODELS.  Defaults to 1, which trains them one after
+        another in this process.  Larger values fork a pool of workers,
+        which pays off only when training dominates the cost of forking
+        and of pickling the table and predictors.
+    bootstrap_predictors : bool, optional
+        If true, INITIALIZE MODELS also trains, for each new model, an
+        instance of every foreign predictor on a bootstrap resample of
+        the table.  Queries USING MODEL then use that model's instances,
+        and queries over all models average over them, reflecting the
+        uncertainty of the predictors.  Only predictors whose factory
+        defines `create_from_df` are replicated; the others, and models
+        initialized without replicates, share the instance trained on
+        the full table.  Defaults to false.
+    tolerance : float, optional
+        If given, density and mutual information estimates are adaptive:
+        they draw batches of `n_samples` samples until the standard error
+        of the estimate falls below `tolerance`, `max_seconds` have
+        elapsed, or `max_samples` samples have been drawn.  By default,
+        each estimate draws a single batch.
+    max_seconds : float, optional
+        Time budget of each adaptive estimate.  Unbounded by default.
+    max_samples : int, optional
+        Bound on the samples drawn by each adaptive estimate.  Defaults to
+        100 times `n_samples`.  The standard error of an estimate (in log
+        space for densities) is returned along with it by
+        :meth:`logpdf_joint`, :meth:`column_mutual_information` and
+        :meth:`conditional_mutual_information` given `return_stderr=True`.
     """
 
-    def __init__(self, n_samples=None):
+    def __init__(self, n_samples=None, n_particles=None,
+            predictor_cache_bytes=None, training_processes=None,
+            bootstrap_predictors=False, tolerance=None, max_seconds=None,
+            max_samples=None):
         # In-memory map of registered foreign predictor builders.
         self.predictor_builder = {}
-        self.predictor_cache = {}
+        # In-memory map of each bdb to an LRU cache of its deserialized
+        # foreign predictors, which outlives any one query.
+        if predictor_cache_bytes is None:
+            predictor_cache_bytes = 256 * 2**20
+        assert 0 <= predictor_cache_bytes
+        self.predictor_cache_bytes = predictor_cache_bytes
+        self.predictor_cache = weakref.WeakKeyDictionary()
+        # In-memory map of each bdb to the catalog metadata of its composer
+        # generators, keyed by generator id, which is fixed from CREATE
+        # GENERATOR until DROP GENERATOR.
+        self.catalog_cache = weakref.WeakKeyDictionary()
+        # In-memory map of each bdb to the column dependence matrices of
+        # its composer generators, keyed by generator id, with the model
+        # iterations and SQLite data version they were computed at.  Unlike
+        # bdb.cache, it outlives transactions, so pairwise queries are
+        # served from it until the models change.
+        self.dependence_cache = weakref.WeakKeyDictionary()
         # Default number of samples.
         if n_samples is None:
             self.n_samples = 100
         else:
             assert 0 < n_samples
             self.n_samples = n_samples
+        # Number of particles shared by the predictions of simulate, if
+        # any.
+        assert n_particles is None or 0 < n_particles
+        self.n_particles = n_particles
+        # Number of processes training foreign predictors.
+        if training_processes is None:
+            training_processes = 1
+        assert 0 < training_processes
+        self.training_processes = training_processes
+        # Whether to train a bootstrap replicate of the foreign predictors
+        # for each model.
+        self.bootstrap_predictors = bootstrap_predictors
+        # Stopping rule of adaptive estimates, if any.
+        assert tolerance is None or 0 <= tolerance
+        self.tolerance = tolerance
+        self.max_seconds = max_seconds
+        if max_samples is None:
+            max_samples = 100 * self.n_samples
+        self.max_samples = max_samples
 
     def _predictor_cache(self, bdb):
         assert bdb.cache is not None
@@ -142,6 +256,109 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
             bdb.cache['composer'] = comp_cache
             return comp_cache
 
+    def _persistent_predictor_cache(self, bdb):
+        if bdb not in self.predictor_cache:
+            self.predictor_cache[bdb] = PredictorCache(
+                self.predictor_cache_bytes)
+        return self.predictor_cache[bdb]
+
+    def _catalog(self, bdb, genid):
+        generators = self.catalog_cache.setdefault(bdb, {})
+        if genid not in generators:
+            generators[genid] = self._read_catalog(bdb, genid)
+        return generators[genid]
+
+    def _invalidate_catalog(self, bdb, genid):
+        self.catalog_cache.get(bdb, {}).pop(genid, None)
+
+    def _read_catalog(self, bdb, genid):
+        # Read everything the inference methods need about the generator
+        # from the database at once.
+        cursor = bdb.sql_execute('''
+            SELECT crosscat_generator_id FROM bayesdb_composer_cc_id
+                WHERE generator_id = ?
+        ''', (genid,))
+        cc_id = cursor.fetchall()[0][0]
+        cursor = bdb.sql_execute('''
+            SELECT colno, local FROM bayesdb_composer_column_owner
+                WHERE generator_id = ?
+                ORDER BY colno ASC
+        ''', (genid,))
+        owners = cursor.fetchall()
+        lcols = frozenset(colno for colno, local in owners if local)
+        fcols = frozenset(colno for colno, local in owners if not local)
+        cursor = bdb.sql_execute('''
+            SELECT fcolno, pcolno FROM bayesdb_composer_column_parents
+                WHERE generator_id = ?
+                ORDER BY fcolno ASC, pcolno ASC
+        ''', (genid,))
+        parents = {}
+        for fcolno, pcolno in cursor:
+            parents.setdefault(fcolno, set()).add(pcolno)
+        cursor = bdb.sql_execute('''
+            SELECT colno FROM bayesdb_composer_column_toposort
+                WHERE generator_id = ?
+                ORDER BY position ASC
+            ''', (genid,))
+        topo = tuple(row[0] for row in cursor)
+        # Ancestors of each foreign column in the network.
+        ancestors = {}
+        for fcolno in topo:
+            ancestors[fcolno] = frozenset(parents.get(fcolno, ())).union(
+                *[ancestors.get(pcolno, ()) for pcolno in
+                    parents.get(fcolno, ())])
+        cursor = bdb.sql_execute('''
+            SELECT colno, predictor_name
+                FROM bayesdb_composer_column_foreign_predictor
+                WHERE generator_id = ?
+        ''', (genid,))
+        predictor_names = dict(cursor.fetchall())
+        colnames = {colno:
+            core.bayesdb_generator_column_name(bdb, genid, colno)
+            for colno, _ in owners}
+        return {
+            'cc_id': cc_id,
+            'cc_metamodel': bdb.sql_execute('''
+                SELECT metamodel FROM bayesdb_generator WHERE id = ?
+            ''', (cc_id,)).fetchall()[0][0],
+            'cc_colnos': {colno: core.bayesdb_generator_column_number(
+                bdb, cc_id, colnames[colno]) for colno in lcols},
+            'lcols': lcols,
+            'fcols': fcols,
+            'pcols': {fcolno: frozenset(pcolnos)
+                for fcolno, pcolnos in parents.iteritems()},
+            'topo': topo,
+            'ancestors': ancestors,
+            'predictor_names': predictor_names,
+            'colnames': colnames,
+        }
+
+    def _model_state(self, bdb, genid):
+        # Returns what the inference methods need to know about the models
+        # of genid, which, unlike the catalog, changes with them.  It is
+        # kept for the transaction, and forgotten when the models change.
+        assert bdb.cache is not None
+        if 'composer_models' in bdb.cache:
+            models = bdb.cache['composer_models']
+        else:
+            models = {}
+            bdb.cache['composer_models'] = models
+        if genid not in models:
+            models[genid] = {
+                # Whether any model has foreign predictors of its own.
+                'model_predictors': bdb.sql_execute('''
+                    SELECT EXISTS(SELECT * FROM
+                        bayesdb_composer_model_foreign_predictor
+                        WHERE generator_id = ?)
+                ''', (genid,)).fetchall()[0][0] != 0,
+            }
+        return models[genid]
+
+    def _forget_models(self, bdb, genid):
+        if bdb.cache is not None:
+            bdb.cache.get('composer_models', {}).pop(genid, None)
+        self.dependence_cache.get(bdb, {}).pop(genid, None)
+
     def register_foreign_predictor(self, builder):
         """Register an object which builds a foreign predictor.
 
@@ -201,6 +418,11 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
             with bdb.savepoint():
                 for stmt in composer_schema_1:
                     bdb.sql_execute(stmt)
+            version = 1
+        if version == 1:
+            with bdb.savepoint():
+                for stmt in composer_schema_2:
+                    bdb.sql_execute(stmt)
         return
 
     def create_generator(self, bdb, table, schema, instantiate):
@@ -209,6 +431,10 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
             dependencies) = self.parse(schema)
         # Instantiate **this** generator.
         genid, bdbcolumns = instantiate(columns.items())
+        # Forget any generator which had this id in a rolled back
+        # transaction.
+        self._invalidate_catalog(bdb, genid)
+        self._forget_models(bdb, genid)
         # Create internal crosscat generator. The name will be the same as
         # this generator name, with a _cc suffix.
         SUFFIX = '_cc'
@@ -277,9 +503,16 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
             keys = [k for k in self._predictor_cache(bdb) if k[0] == genid]
             for k in keys:
                 del self._predictor_cache(bdb)[k]
+            self._persistent_predictor_cache(bdb).evict_generator(genid)
             # Obtain before losing references.
             cc_name = core.bayesdb_generator_name(bdb, self.cc_id(bdb, genid))
+            self._invalidate_catalog(bdb, genid)
+            self._forget_models(bdb, genid)
             # Delete tables reverse order of insertion.
+            bdb.sql_execute('''
+                DELETE FROM bayesdb_composer_model_foreign_predictor
+                    WHERE generator_id = ?
+            ''', (genid,))
             bdb.sql_execute('''
                 DELETE FROM bayesdb_composer_column_foreign_predictor
                     WHERE generator_id = ?
@@ -305,6 +538,16 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
                 DROP GENERATOR {}
             '''.format(quote(cc_name)))
 
+    def rename_column(self, bdb, genid, oldname, newname):
+        # The stored foreign predictors know their targets and conditions
+        # by the old names, and would not find them under the new ones, so
+        # renaming is refused.  The caches are forgotten all the same.
+        self._invalidate_catalog(bdb, genid)
+        self._forget_models(bdb, genid)
+        raise BLE(NotImplementedError('Composer generator {} cannot rename '
+            'its column {} to {}.'.format(
+                core.bayesdb_generator_name(bdb, genid), oldname, newname)))
+
     def initialize_models(self, bdb, genid, modelnos, model_config):
         # Initialize internal crosscat, maintaining equality of model numbers.
         # The semantics of INITIALIZE are that it guarantees the existence
@@ -314,8 +557,13 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
         qg = quote(core.bayesdb_generator_name(bdb, self.cc_id(bdb, genid)))
         bql = 'INITIALIZE {} MODELS FOR {};'.format(max(modelnos)+1, qg)
         bdb.execute(bql)
-        # Initialize the foriegn predictors.
-        for fcol in self.fcols(bdb, genid):
+        # Initialize the foreign predictors, all trained before any is
+        # stored: one instance of each on the full table, and, if
+        # requested, one on a bootstrap resample for each new model.
+        table_name = core.bayesdb_generator_table(bdb, genid)
+        keys = []
+        jobs = []
+        for fcol in self.topo(bdb, genid):
             # Convert column numbers to names.
             targets = \
                 [(core.bayesdb_generator_column_name(bdb, genid, fcol),
@@ -323,25 +571,90 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
             conditions = \
                 [(core.bayesdb_generator_column_name(bdb, genid, pcol),
                   core.bayesdb_generator_column_stattype(bdb, genid, pcol))
-                 for pcol in self.pcols(bdb, genid, fcol)]
-            # Initialize the foreign predictor.
-            table_name = core.bayesdb_generator_table(bdb, genid)
-            predictor_name = self.predictor_name(bdb, genid, fcol)
-            builder = self.predictor_builder[predictor_name]
-            predictor = builder.create(bdb, table_name, targets, conditions)
-            # Store in the database.
-            with bdb.savepoint():
-                sql = '''
-                    UPDATE bayesdb_composer_column_foreign_predictor SET
-                        predictor_binary = :predictor_binary
-                        WHERE generator_id = :genid AND colno = :colno
-                '''
-                predictor_binary = builder.serialize(bdb, predictor)
-                bdb.sql_execute(sql, {
-                    'genid': genid,
-                    'predictor_binary': sqlite3.Binary(predictor_binary),
-                    'colno': fcol
-                })
+                 for pcol in sorted(self.pcols(bdb, genid, fcol))]
+            builder = self.predictor_builder[
+                self.predictor_name(bdb, genid, fcol)]
+            keys.append((fcol, None))
+            jobs.append((builder, targets, conditions, None))
+            if self.bootstrap_predictors and \
+                    hasattr(builder, 'create_from_df'):
+                for modelno in modelnos:
+                    keys.append((fcol, modelno))
+                    jobs.append((builder, targets, conditions,
+                        bdb.np_prng.randint(2**31 - 1)))
+        predictors = self._train_predictors(bdb, table_name, jobs)
+        # Store in the database.
+        with bdb.savepoint():
+            for (fcol, modelno), (builder, _, _, _), predictor in \
+                    zip(keys, jobs, predictors):
+                predictor_binary = sqlite3.Binary(
+                    builder.serialize(bdb, predictor))
+                if modelno is None:
+                    bdb.sql_execute('''
+                        UPDATE bayesdb_composer_column_foreign_predictor SET
+                            predictor_binary = ?
+                            WHERE generator_id = ? AND colno = ?
+                    ''', (predictor_binary, genid, fcol))
+                else:
+                    bdb.sql_execute('''
+                        INSERT OR REPLACE INTO
+                            bayesdb_composer_model_foreign_predictor
+                            (generator_id, modelno, colno, predictor_binary)
+                            VALUES (?, ?, ?, ?)
+                    ''', (genid, modelno, fcol, predictor_binary))
+            self._forget_predictors(bdb, genid)
+
+    def _train_predictors(self, bdb, table_name, jobs):
+        # Train a predictor for each (builder, targets, conditions, seed)
+        # job, returning them in order.  Builders with `create_from_df`
+        # share a single read of the table and are trained in a process
+        # pool, on a bootstrap resample of it seeded by `seed` unless that
+        # is None; the others create their predictors from the table
+        # themselves.
+        pooled = [i for i, (builder, _, _, _) in enumerate(jobs)
+            if hasattr(builder, 'create_from_df')]
+        predictors = [None] * len(jobs)
+        if pooled:
+            columns = sorted(set(name for i in pooled
+                for name, _ in jobs[i][1] + jobs[i][2]))
+            df = table_to_df(bdb, table_name, columns)
+            tasks = [jobs[i] for i in pooled]
+            processes = min(self.training_processes, len(tasks))
+            if processes > 1:
+                pool = mp.Pool(processes=processes,
+                    initializer=_init_training_worker, initargs=(df,))
+                try:
+                    trained = pool.map(_train_predictor, tasks)
+                    pool.close()
+                except:
+                    pool.terminate()
+                    raise
+                finally:
+                    pool.join()
+            else:
+                trained = [_fit_predictor(df, *task) for task in tasks]
+            for i, predictor in zip(pooled, trained):
+                predictors[i] = predictor
+        for i, (builder, targets, conditions, _) in enumerate(jobs):
+            if predictors[i] is None:
+                predictors[i] = builder.create(bdb, table_name, targets,
+                    conditions)
+        return predictors
+
+    def _forget_predictors(self, bdb, genid):
+        # Forget which predictors this savepoint has looked up for genid,
+        # and what it knows about its models.
+        cache = self._predictor_cache(bdb)
+        for key in [k for k in cache if k[0] == genid]:
+            del cache[key]
+        self._forget_models(bdb, genid)
+        self._forget_evidence(bdb)
+
+    def _forget_evidence(self, bdb):
+        # Forget the memoized samples of the query in progress, if any,
+        # which were drawn from models that have since changed.
+        if bdb.cache is not None:
+            bdb.cache.get('composer_evidence', {}).clear()
 
     def drop_models(self, bdb, genid, modelnos=None):
         qg = quote(core.bayesdb_generator_name(bdb, self.cc_id(bdb, genid)))
@@ -351,6 +664,19 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
         else:
             bql = 'DROP MODELS FROM {};'.format(qg)
         bdb.execute(bql)
+        # Drop the foreign predictors of the models.
+        sql = '''
+            DELETE FROM bayesdb_composer_model_foreign_predictor
+                WHERE generator_id = ?
+        '''
+        with bdb.savepoint():
+            if modelnos is None:
+                bdb.sql_execute(sql, (genid,))
+            else:
+                for modelno in modelnos:
+                    bdb.sql_execute(sql + ' AND modelno = ?',
+                        (genid, modelno))
+            self._forget_predictors(bdb, genid)
 
     def analyze_models(self, bdb, genid, modelnos=None, iterations=1,
                 max_seconds=None, ckpt_iterations=None, ckpt_seconds=None):
@@ -359,6 +685,9 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
         self.cc(bdb, genid).analyze_models(bdb, self.cc_id(bdb, genid),
             modelnos=modelnos, iterations=iterations, max_seconds=max_seconds,
             ckpt_iterations=ckpt_iterations, ckpt_seconds=ckpt_seconds)
+        # The views have changed.
+        self._forget_models(bdb, genid)
+        self._forget_evidence(bdb)
         # Accounting.
         sql = '''
             UPDATE bayesdb_generator_model
@@ -377,15 +706,15 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
 
     def column_dependence_probability(self, bdb, genid, modelno, colno0,
             colno1):
-        if modelno is None:
-            modelnos = core.bayesdb_generator_modelnos(bdb, genid)
-        else:
-            modelnos = [modelno]
         with bdb.savepoint():
-            p = sum(self._column_dependence_probability(
-                     bdb, genid, m, colno0, colno1)
-                    for m in modelnos) / float(len(modelnos))
-        return p
+            if modelno is not None:
+                return self._column_dependence_probability(bdb, genid,
+                    modelno, colno0, colno1)
+            if colno0 == colno1:
+                return 1
+            index, _modelnos, matrices = self._dependence_matrices(bdb,
+                genid)
+            return np.mean(matrices[:, index[colno0], index[colno1]])
 
     def _column_dependence_probability(self, bdb, genid, modelno, colno0,
             colno1):
@@ -397,45 +726,79 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
         # Trivial case.
         if colno0 == colno1:
             return 1
-        fcols = set(self.fcols(bdb, genid))
-        c0_foreign = colno0 in fcols
-        c1_foreign = colno1 in fcols
-        # Neither col is foreign, delegate to CrossCat.
-        # XXX Fails for future implementation of conditional dependence.
-        if not (c0_foreign or c1_foreign):
-            return self.cc(bdb, genid).column_dependence_probability(bdb,
-                self.cc_id(bdb, genid), modelno,
-                self.cc_colno(bdb, genid, colno0),
-                self.cc_colno(bdb, genid, colno1))
-        # (colno0, colno1) form a (target, conditions) pair.
-        # WE explicitly modeled them as dependent by assumption.
+        index, modelnos, matrices = self._dependence_matrices(bdb, genid)
+        if modelno not in modelnos:
+            raise BLE(ValueError('No model {} in generator {}.'.format(
+                modelno, core.bayesdb_generator_name(bdb, genid))))
+        return matrices[modelnos.index(modelno), index[colno0],
+            index[colno1]]
+
+    def _dependence_matrices(self, bdb, genid):
+        # Returns (index, modelnos, matrices), where matrices[m, i, j] is
+        # the dependence probability of the columns numbered i and j by
+        # index in model modelnos[m].  Computed once for all pairs and
+        # models from the crosscat views and the network, and kept across
+        # queries until the models change.  The iterations of the crosscat
+        # models tell if they are analyzed directly, and SQLite's data
+        # version if another connection has committed any change, e.g.
+        # dropped and initialized the models again.
+        cursor = bdb.sql_execute('''
+            SELECT modelno, iterations FROM bayesdb_generator_model
+                WHERE generator_id = ?
+                ORDER BY modelno ASC
+        ''', (self.cc_id(bdb, genid),))
+        iterations = tuple(cursor)
+        if not iterations:
+            raise BLE(ValueError('No models in generator {}.'.format(
+                core.bayesdb_generator_name(bdb, genid))))
+        version = (iterations,
+            bdb.sql_execute('PRAGMA data_version').fetchall()[0][0])
+        generators = self.dependence_cache.setdefault(bdb, {})
+        if genid not in generators or generators[genid][0] != version:
+            generators[genid] = (version,
+                self._compute_dependence_matrices(bdb, genid))
+        return generators[genid][1]
+
+    def _compute_dependence_matrices(self, bdb, genid):
+        # Local columns depend on each other iff crosscat assigns them to
+        # the same view.
+        # A foreign column and its conditions are dependent by assumption.
         # TODO: Strong assumption? What if FP determines it is not
         # dependent on one of its conditions? (ie 0 coeff in regression)
-        if colno0 in self.pcols(bdb, genid, colno1) or \
-                colno1 in self.pcols(bdb, genid, colno0):
-            return 1
-        # (colno0, colno1) form a (local, foreign) pair.
-        # IF [col0 FP target], [col1 CC], and [all conditions of col0 IND col1]
-        #   then [col0 IND col1].
+        # A foreign column is independent of a column iff all of its
+        # conditions are.
         # XXX Reverse is not true generally (counterxample), but we shall
-        # assume an IFF condition. This assumption is not unlike the transitive
-        # closure property of independence in crosscat.
-        if (c0_foreign and not c1_foreign) or \
-                (c1_foreign and not c0_foreign):
-            fcol = colno0 if c0_foreign else colno1
-            lcol = colno1 if c0_foreign else colno0
-            return any(self._column_dependence_probability(bdb, genid, modelno,
-                pcol, lcol) for pcol in self.pcols(bdb, genid, fcol))
-        # XXX TODO: Determine independence semantics for this case.
-        # Both columns are foreign. (Recursively) return 1 if any of their
-        # conditions (possibly FPs) have dependencies.
-        assert c0_foreign and c1_foreign
-        return any(self._column_dependence_probability(bdb, genid, modelno,
-                pcol0, pcol1) for pcol0 in self.pcols(bdb, genid, colno0)
-                for pcol1 in self.pcols(bdb, genid, colno1))
+        # assume an IFF condition. This assumption is not unlike the
+        # transitive closure property of independence in crosscat.
+        # XXX TODO: Determine independence semantics for two foreign
+        # columns.  Taking the closure, two columns are dependent iff any
+        # of their local ancestors (or themselves, if local) share a view.
+        lcols = sorted(self.lcols(bdb, genid))
+        colnos = lcols + self.topo(bdb, genid)
+        index = {colno: i for i, colno in enumerate(colnos)}
+        ancestors = self._catalog(bdb, genid)['ancestors']
+        roots = np.zeros((len(colnos), len(lcols)))
+        for colno in colnos:
+            for lcol in [colno] if colno not in ancestors else \
+                    [a for a in ancestors[colno] if a not in ancestors]:
+                roots[index[colno], index[lcol]] = 1
+        modelnos, views = self._crosscat_views(bdb, genid, lcols)
+        matrices = np.empty((len(modelnos), len(colnos), len(colnos)))
+        for m, view in enumerate(views):
+            same_view = np.equal.outer(view, view).astype(float)
+            matrices[m] = roots.dot(same_view).dot(roots.T) > 0
+        return index, modelnos, matrices
+
+    def _crosscat_views(self, bdb, genid, lcols):
+        # Returns (modelnos, views), where views[m][i] is the view of
+        # lcols[i] in the internal crosscat model modelnos[m].
+        # Imported here, as crosscat_utils brings pyplot with it.
+        from bdbcontrib.crosscat_utils import get_column_views
+        return get_column_views(bdb, self.cc_id(bdb, genid),
+            self.cc_colnos(bdb, genid, lcols))
 
     def column_mutual_information(self, bdb, genid, modelno, colno0, colno1,
-            numsamples=None):
+            numsamples=None, return_stderr=False):
         if numsamples is None:
             numsamples = self.n_samples
         # XXX Aggregator only.
@@ -447,20 +810,32 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
             modelnos = core.bayesdb_generator_modelnos(bdb, genid)
         else:
             modelnos = [modelno]
-        with bdb.savepoint():
-            mi = sum(self.conditional_mutual_information(
-                      bdb, genid, modelno, X, W, Z, Y)
-                     for modelno in modelnos) / float(len(modelnos))
+        with bdb.savepoint(), self._evidence_memo(bdb):
+            mis, stderrs = zip(*[self._conditional_mutual_information_stderr(
+                bdb, genid, modelno, X, W, Z, Y, numsamples=numsamples)
+                for modelno in modelnos])
+        mi = sum(mis) / float(len(modelnos))
+        if return_stderr:
+            # The estimates of the models are independent.
+            return mi, np.sqrt(np.sum(np.square(stderrs))) / len(modelnos)
         return mi
 
     def conditional_mutual_information(self, bdb, genid, modelno, X, W, Z, Y,
-            numsamples=None):
-        with bdb.savepoint():
-            return self._conditional_mutual_information(
+            numsamples=None, return_stderr=False):
+        with bdb.savepoint(), self._evidence_memo(bdb):
+            mi, stderr = self._conditional_mutual_information_stderr(
                 bdb, genid, modelno, X, W, Z, Y, numsamples=numsamples)
+        return (mi, stderr) if return_stderr else mi
 
     def _conditional_mutual_information(self, bdb, genid, modelno, X, W, Z, Y,
             numsamples=None):
+        return self._conditional_mutual_information_stderr(bdb, genid,
+            modelno, X, W, Z, Y, numsamples=numsamples)[0]
+
+    def _conditional_mutual_information_stderr(self, bdb, genid, modelno, X,
+            W, Z, Y, numsamples=None):
+        # Returns the estimate of _conditional_mutual_information and its
+        # standard error.
         # WARNING: SUPER EXPERIMENTAL.
         # Computes the conditional mutual information I(X:W|Z,Y=y), defined
         # defined as the expectation E_z~Z{X:W|Z=z,Y=y}.
@@ -474,42 +849,59 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
             raise BLE(ValueError('Duplicate cells received in '
                 'conditional_mutual_information.\n'
                 'X: {}\nW: {}\nZ: {}\nY: {}'.format(X, W, Z, Y)))
-        # Simulate from joint.
-        XWZ_samples = self.simulate(bdb, genid, modelno, X+W+Z,
-            Y, numpredictions=numsamples)
-        # Simple Monte Carlo
-        mi = logpz = logpxwz = logpxz = logpwz = 0
-        for s in XWZ_samples:
-            Qx = [(r,c,v) for ((r,c),v) in zip(X, s[:len(X)])]
-            Qw = [(r,c,v) for ((r,c),v) in zip(W, s[len(X):len(X)+len(W)])]
-            Qz = [(r,c,v) for ((r,c),v) in zip(Z, s[len(X)+len(W):])]
-            if Z:
-                logpz = self._joint_logpdf(bdb, genid, modelno, Qz, Y)
-            else:
-                logpz = 0
-            logpxwz = self._joint_logpdf(bdb, genid, modelno, Qx+Qw+Qz, Y)
-            logpxz = self._joint_logpdf(bdb, genid, modelno, Qx+Qz, Y)
-            logpwz = self._joint_logpdf(bdb, genid, modelno, Qw+Qz, Y)
-            mi += logpz + logpxwz - logpxz - logpwz
+        # Simple Monte Carlo, over batches of samples from the joint.
+        terms = []
+        start = time.time()
+        while True:
+            XWZ_samples = self.simulate(bdb, genid, modelno, X+W+Z,
+                Y, numpredictions=numsamples)
+            for s in XWZ_samples:
+                Qx = [(r,c,v) for ((r,c),v) in zip(X, s[:len(X)])]
+                Qw = [(r,c,v) for ((r,c),v) in
+                    zip(W, s[len(X):len(X)+len(W)])]
+                Qz = [(r,c,v) for ((r,c),v) in zip(Z, s[len(X)+len(W):])]
+                if Z:
+                    logpz = self._joint_logpdf(bdb, genid, modelno, Qz, Y)
+                else:
+                    logpz = 0
+                logpxwz = self._joint_logpdf(bdb, genid, modelno,
+                    Qx+Qw+Qz, Y)
+                logpxz = self._joint_logpdf(bdb, genid, modelno, Qx+Qz, Y)
+                logpwz = self._joint_logpdf(bdb, genid, modelno, Qw+Qz, Y)
+                terms.append(logpz + logpxwz - logpxz - logpwz)
+            stderr = _mean_stderr(terms)
+            if self._sampling_done(stderr, len(terms), start):
+                break
         # TODO: linfoot?
         # TODO: If negative, report to user that reliable answer cannot be
         # returned with current `numsamples`.
         # Averaging is in direct space is correct.
-        return mi/numsamples
+        return np.mean(terms), stderr
 
-    def logpdf_joint(self, bdb, generator_id, targets, constraints, modelno):
+    def logpdf_joint(self, bdb, generator_id, targets, constraints, modelno,
+            return_stderr=False):
         if modelno is None:
             modelnos = core.bayesdb_generator_modelnos(bdb, generator_id)
         else:
             modelnos = [modelno]
-        with bdb.savepoint():
-            return logmeanexp([self._joint_logpdf(bdb, generator_id, modelno,
-                targets, constraints) for modelno in modelnos])
+        with bdb.savepoint(), self._evidence_memo(bdb):
+            logps, stderrs = zip(*[self._joint_logpdf_stderr(bdb,
+                generator_id, modelno, targets, constraints)
+                for modelno in modelnos])
+        if return_stderr:
+            return logmeanexp(logps), _log_mean_exp_stderr(logps, stderrs)
+        return logmeanexp(logps)
 
     def _joint_logpdf(self, bdb, genid, modelno, Q, Y, n_samples=None):
+        return self._joint_logpdf_stderr(bdb, genid, modelno, Q, Y,
+            n_samples=n_samples)[0]
+
+    def _joint_logpdf_stderr(self, bdb, genid, modelno, Q, Y,
+            n_samples=None):
         # XXX Computes the joint probability of query Q given evidence Y
-        # for a single model. The function is a likelihood weighted
-        # integrator.
+        # for a single model, and the standard error of its log, which is
+        # zero when the density is exact. The function is a likelihood
+        # weighted integrator.
         # XXX Determine.
         if n_samples is None:
             n_samples = self.n_samples
@@ -521,20 +913,136 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
         # Ensure consistency of any duplicates in Q and Y.
         Q = self._queries_consistent_with_constraints(Q, Y)
         if Q is None:
-            return float('-inf')
+            return float('-inf'), 0.
         for r, _, _ in Q+Y:
             assert r == Q[0][0], "Cannot assess more than one row, "\
                 "%s and %s requested" % (Q[0][0], r)
-        # (Q,Y) marginal joint density.
-        _, QY_weights = self._weighted_sample(bdb, genid, modelno,
-            Q[0][0], Q+Y, n_samples=n_samples)
-        # Y marginal density.
-        _, Y_weights = self._weighted_sample(bdb, genid, modelno,
-            Q[0][0], Y, n_samples=n_samples)
+        # Exact density when the query factorizes over foreign columns.
+        if self._factorizes(bdb, genid, Q, Y):
+            return self._factorized_logpdf(bdb, genid, modelno, Q, Y), 0.
+        # Y marginal and (Q,Y) joint densities, from batches of weighted
+        # samples.  The Y samples are shared by all queries with this
+        # evidence.
+        extends = self._extends_evidence(bdb, genid, Q, Y)
+        Y_weights = []
+        QY_weights = []
+        start = time.time()
+        while True:
+            samples, weights, _ = self._evidence_sample(bdb, genid,
+                modelno, Q[0][0], Y, n_samples, batch=len(Y_weights))
+            Y_weights.append(weights)
+            if extends:
+                # Both estimates come from the same samples.
+                QY_weights.append(weights + self._query_weights(bdb, genid,
+                    modelno, Q, samples))
+                stderr = _log_ratio_stderr(np.concatenate(QY_weights),
+                    np.concatenate(Y_weights))
+            else:
+                QY_weights.append(self._weighted_sample(bdb, genid, modelno,
+                    Q[0][0], Q+Y, n_samples=n_samples)[1])
+                stderr = np.hypot(
+                    _log_mean_stderr(np.concatenate(QY_weights)),
+                    _log_mean_stderr(np.concatenate(Y_weights)))
+            if self._sampling_done(stderr, n_samples * len(Y_weights),
+                    start):
+                break
         # XXX TODO Keep sampling until logpQY <= logpY
-        logpQY = logmeanexp(QY_weights)
-        logpY = logmeanexp(Y_weights)
-        return logpQY - logpY
+        logpQY = logmeanexp(np.concatenate(QY_weights))
+        logpY = logmeanexp(np.concatenate(Y_weights))
+        return logpQY - logpY, stderr
+
+    def _sampling_done(self, stderr, n_drawn, start):
+        # Whether an estimate with standard error stderr from n_drawn
+        # samples, begun at time start, should stop drawing batches.
+        if self.tolerance is None:
+            return True
+        return stderr <= self.tolerance or n_drawn >= self.max_samples or \
+            (self.max_seconds is not None and
+                self.max_seconds <= time.time() - start)
+
+    def _factorizes(self, bdb, genid, Q, Y):
+        # True if the density of Q given Y is the product of the densities
+        # of its cells given their parents: Q only fixes foreign columns,
+        # all their parents are fixed too, and none of them is an ancestor
+        # of a column in Y, which would make Y evidence about Q.
+        fcols = self.fcols(bdb, genid)
+        fixed = set(c for _, c, _ in Q + Y)
+        if not all(c in fcols and self.pcols(bdb, genid, c) <= fixed
+                for _, c, _ in Q):
+            return False
+        ancestors = self._catalog(bdb, genid)['ancestors']
+        return not any(c in ancestors.get(d, ()) for _, c, _ in Q
+            for _, d, _ in Y)
+
+    def _factorized_logpdf(self, bdb, genid, modelno, Q, Y):
+        colnames = self._catalog(bdb, genid)['colnames']
+        values = {c: v for _, c, v in Q + Y}
+        return sum(self.predictor(bdb, genid, fcol, modelno).logpdf(value,
+                {colnames[c]: values[c] for c in self.pcols(bdb, genid, fcol)})
+            for _, fcol, value in Q)
+
+    def _evidence_sample(self, bdb, genid, modelno, row_id, Y, n_samples,
+            batch=0):
+        # Returns the batch-th batch of weighted samples for evidence Y and
+        # the estimate of its log density.  Within an _evidence_memo, they
+        # are memoized: every term of a mutual information or a density
+        # ratio with the same evidence reuses them.
+        key = (genid, modelno, row_id, n_samples, tuple(sorted(Y)), batch)
+        memo = bdb.cache.get('composer_evidence') \
+            if bdb.cache is not None else None
+        if memo is None or key not in memo:
+            samples, weights = self._weighted_sample(bdb, genid, modelno,
+                row_id, Y, n_samples=n_samples)
+            if memo is None:
+                return samples, weights, logmeanexp(weights)
+            memo[key] = (samples, weights, logmeanexp(weights))
+        return memo[key]
+
+    @contextlib.contextmanager
+    def _evidence_memo(self, bdb):
+        # Memoizes the samples of _evidence_sample for the duration of one
+        # query, in a savepoint, and forgets them when the outermost query
+        # returns so that they neither accumulate over the transaction nor
+        # outlive the models they were drawn from.
+        assert bdb.cache is not None
+        owner = 'composer_evidence' not in bdb.cache
+        if owner:
+            bdb.cache['composer_evidence'] = {}
+        try:
+            yield
+        finally:
+            if owner:
+                bdb.cache.pop('composer_evidence', None)
+
+    def _extends_evidence(self, bdb, genid, Q, Y):
+        # True if the weighted samples for evidence Y also serve for
+        # evidence Q+Y, reweighted by the density of Q.  This holds when Q
+        # only fixes foreign columns which are not ancestors of any column
+        # in Q or Y, as fixing them leaves the distribution of every other
+        # column that bears on the weights unchanged.
+        fcols = self.fcols(bdb, genid)
+        if not all(c in fcols for _, c, _ in Q):
+            return False
+        ancestors = self._catalog(bdb, genid)['ancestors']
+        fixed = set(c for _, c, _ in Q + Y)
+        return not any(c in ancestors.get(d, ()) for _, c, _ in Q
+            for d in fixed)
+
+    def _query_weights(self, bdb, genid, modelno, Q, samples):
+        # Returns the log density of the foreign cells Q under each of the
+        # samples of their parents.
+        colnames = self._catalog(bdb, genid)['colnames']
+        n_samples = len(samples.itervalues().next())
+        weights = np.zeros(n_samples)
+        for _, fcol, value in Q:
+            pcols = sorted(self.pcols(bdb, genid, fcol))
+            conditions = pd.DataFrame(
+                {colnames[c]:samples[c] for c in pcols},
+                index=np.arange(n_samples),
+                columns=[colnames[c] for c in pcols])
+            weights += _logpdf_many(self.predictor(bdb, genid, fcol, modelno),
+                _constant_column(value, n_samples), conditions)
+        return weights
 
     def _queries_consistent_with_constraints(self, Q, Y):
         queries = dict()
@@ -613,7 +1121,7 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
                     parent_conf = min(parent_conf, imp_conf)
                     conditions[colname] = imp_val
             assert all(v is not None for c,v in conditions.iteritems())
-            predictor = self.predictor(bdb, genid, colno)
+            predictor = self.predictor(bdb, genid, colno, modelno)
             samples = predictor.simulate(numsamples, conditions)
         # Since foreign predictor does not know how to impute, imputation
         # shall occur here in the composer by simulate/logpdf calls.
@@ -648,6 +1156,15 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
                 constraints, numpredictions=num_predictions)
 
     def simulate(self, bdb, genid, modelno, targets, constraints,
+            numpredictions=1, return_ess=False):
+        # If return_ess, also returns the mean effective sample size of the
+        # particle sets the predictions were resampled from, or None if
+        # crosscat simulated them.
+        predictions, ess = self._simulate(bdb, genid, modelno, targets,
+            constraints, numpredictions=numpredictions)
+        return (predictions, ess) if return_ess else predictions
+
+    def _simulate(self, bdb, genid, modelno, targets, constraints,
             numpredictions=1):
         # Delegate to crosscat if colnos+constraints all lcols.
         colnos = [c for _,c in targets]
@@ -658,21 +1175,49 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
             Q_cc = [(r, self.cc_colno(bdb, genid, c)) for r,c in targets]
             return self.cc(bdb, genid).simulate_joint(bdb,
                 self.cc_id(bdb, genid), Q_cc, Y_cc, modelno,
-                num_predictions=numpredictions)
+                num_predictions=numpredictions), None
         # Solve inference problem by sampling-importance resampling.
-        result = []
         for r,_ in targets:
             assert r == targets[0][0], "Cannot simulate more than one row, "\
                 "%s and %s requested" % (targets[0][0], r)
-        for _ in xrange(numpredictions):
-            samples, weights = self._weighted_sample(bdb, genid, modelno,
-                targets[0][0], constraints)
-            p = np.exp(np.asarray(weights) - np.max(weights))
-            p /= np.sum(p)
-            draw = np.nonzero(bdb.np_prng.multinomial(1,p))[0][0]
-            s = [samples[draw].get(col) for col in colnos]
-            result.append(s)
-        return result
+        samples, [(draws, ess)] = self._resample_particles(bdb, genid,
+            modelno, [(targets[0][0], constraints)], numpredictions)
+        return [[samples[col][draw] for col in colnos] for draw in draws], ess
+
+    def _resample_particles(self, bdb, genid, modelno, rows,
+            numpredictions):
+        # Draws weighted particles for each (row_id, Y) pair in rows, in a
+        # single pass, and resamples numpredictions of them by weight.
+        # Returns (samples, [(draws, ess), ..]), where samples is as
+        # returned by _weighted_sample_blocks, and for each row draws are
+        # the indices of its predictions in samples and ess the mean
+        # effective sample size of the particle sets they came from.
+        # By default each prediction is resampled from a set of n_samples
+        # particles of its own, so predictions are independent; with
+        # n_particles set, all predictions of a row are resampled from one
+        # set of n_particles particles.
+        if self.n_particles is None:
+            n_sets, n_particles, n_draws = numpredictions, self.n_samples, 1
+        else:
+            n_sets, n_particles, n_draws = 1, self.n_particles, numpredictions
+        shares = self._model_shares(bdb, genid, modelno, n_particles)
+        blocks = [(m, row_id, Y, n) for row_id, Y in rows
+            for _ in xrange(n_sets) for m, n in shares]
+        samples, weights = self._weighted_sample_blocks(bdb, genid, blocks)
+        # Particle sets are contiguous.
+        sets = np.arange(len(weights)).reshape((len(rows), n_sets, -1))
+        results = []
+        for row_sets in sets:
+            draws = []
+            ess = []
+            for particles in row_sets:
+                p = np.exp(weights[particles] - np.max(weights[particles]))
+                p /= np.sum(p)
+                draws.extend(bdb.np_prng.choice(particles, size=n_draws,
+                    p=p))
+                ess.append(effective_sample_size(weights[particles]))
+            results.append((draws, np.mean(ess)))
+        return samples, results
 
     def row_similarity(self, bdb, genid, modelno, rowid, target_rowid,
             colnos):
@@ -681,125 +1226,303 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
         return self.cc(bdb, genid).row_similarity(bdb, self.cc_id(bdb, genid),
             modelno, rowid, target_rowid, cc_colnos)
 
+    def simulate_rows(self, bdb, genid, modelno, queries, numpredictions=1,
+            return_ess=False):
+        """Simulate from the joint distribution of cells in many rows.
+
+        Equivalent to calling :meth:`simulate` once per row, but the
+        foreign predictors are queried once for the samples of all rows,
+        and rows with the same constraints that are not in the table share
+        their crosscat calls.
+
+        Parameters
+        ----------
+        queries : list<tuple<int, list<int>, list<tuple<int, object>>>>
+            One (rowid, colnos, constraints) triple per row, where
+            `constraints` is a list of (colno, value) pairs in that row.
+        numpredictions : int
+            Number of simulations for each row.
+        return_ess : bool
+            If true, also return the effective sample sizes of the rows.
+
+        Returns
+        -------
+        list<list<list>>
+            For each query, `numpredictions` lists of values of its
+            `colnos`.
+        list<float>
+            Only if `return_ess`: for each query, the mean effective sample
+            size of the particle sets its simulations were resampled from,
+            or None if crosscat simulated them.
+        """
+        results = [None] * len(queries)
+        ess = [None] * len(queries)
+        foreign = []
+        fcols = self.fcols(bdb, genid)
+        for i, (rowid, colnos, constraints) in enumerate(queries):
+            # Delegate to crosscat, which can only simulate one row at a
+            # time, if colnos+constraints all lcols.
+            if all(c not in fcols for c in
+                    list(colnos) + [c for c, _ in constraints]):
+                results[i] = self.simulate(bdb, genid, modelno,
+                    [(rowid, c) for c in colnos],
+                    [(rowid, c, v) for c, v in constraints],
+                    numpredictions=numpredictions)
+            else:
+                foreign.append(i)
+        if foreign:
+            samples, resampled = self._resample_particles(bdb, genid,
+                modelno, [(queries[i][0],
+                        [(queries[i][0], c, v) for c, v in queries[i][2]])
+                    for i in foreign], numpredictions)
+            for i, (draws, row_ess) in zip(foreign, resampled):
+                results[i] = [[samples[c][d] for c in queries[i][1]]
+                    for d in draws]
+                ess[i] = row_ess
+        return (results, ess) if return_ess else results
+
+    def logpdf_rows(self, bdb, genid, modelno, queries, n_samples=None):
+        """Evaluate the joint log density of cells in many rows.
+
+        Equivalent to calling :meth:`logpdf_joint` once per row, with the
+        weighted samples of all rows drawn together as in
+        :meth:`simulate_rows`.
+
+        Parameters
+        ----------
+        queries : list<tuple<int, list<tuple<int, object>>,
+                list<tuple<int, object>>>>
+            One (rowid, targets, constraints) triple per row, where
+            `targets` and `constraints` are lists of (colno, value) pairs
+            in that row.
+
+        Returns
+        -------
+        numpy.ndarray
+            The log density of the targets of each query given its
+            constraints.
+        """
+        if n_samples is None:
+            n_samples = self.n_samples
+        if modelno is None:
+            modelnos = core.bayesdb_generator_modelnos(bdb, genid)
+            with bdb.savepoint():
+                logps = [self.logpdf_rows(bdb, genid, m, queries,
+                    n_samples=n_samples) for m in modelnos]
+            return np.array([logmeanexp(row) for row in zip(*logps)])
+        results = np.zeros(len(queries))
+        blocks = []
+        sampled = []
+        with bdb.savepoint():
+            for i, (rowid, targets, constraints) in enumerate(queries):
+                Q = self._queries_consistent_with_constraints(
+                    [(rowid, c, v) for c, v in targets],
+                    [(rowid, c, v) for c, v in constraints])
+                Y = [(rowid, c, v) for c, v in constraints]
+                if Q is None:
+                    results[i] = float('-inf')
+                elif self._factorizes(bdb, genid, Q, Y):
+                    results[i] = self._factorized_logpdf(bdb, genid, modelno,
+                        Q, Y)
+                else:
+                    blocks.append((modelno, rowid, Q+Y, n_samples))
+                    blocks.append((modelno, rowid, Y, n_samples))
+                    sampled.append(i)
+            if blocks:
+                _, weights = self._weighted_sample_blocks(bdb, genid, blocks)
+                weights = weights.reshape((len(sampled), 2, n_samples))
+                for i, (QY_weights, Y_weights) in zip(sampled, weights):
+                    results[i] = logmeanexp(QY_weights) - \
+                        logmeanexp(Y_weights)
+        return results
+
     def _weighted_sample(self, bdb, genid, modelno, row_id, Y, n_samples=None):
-        # Returns a pairs of parallel lists ([sample ...], [weight ...])
-        # Each `sample` is a dict {col:v} of values for all nodes in
-        # the network for one row. Y specifies evidence nodes as (row,
-        # col, value) triples: all returned samples have constrained
+        # Returns a pair (samples, weights) of n_samples weighted samples of
+        # all nodes in the network for one row, drawn as a batch.
+        # `samples` is a dict {col:array} of the n_samples values of each
+        # node, and `weights` an array of the log likelihood of the
+        # evidence Y under each sample s\Y. Y specifies evidence nodes as
+        # (row, col, value) triples: all returned samples have constrained
         # values at the evidence nodes.
-        # `weight` is the likelihood of the evidence Y under s\Y.
         if n_samples is None:
             n_samples = self.n_samples
-        # Create n_samples dicts, each entry is weighted sample from joint.
-        samples = [{c:v for r,c,v in Y if r == row_id}
-                   for _ in xrange(n_samples)]
-        weights = []
-        w0 = 0
-        # Assess likelihood of evidence at root.
-        Y_cc = [(r, c, v) for r,c,v in Y if c in self.lcols(bdb, genid)]
-        if Y_cc:
-            w0 += self.cc(bdb, genid).logpdf_joint(bdb, self.cc_id(bdb, genid),
-                Y_cc, [], modelno)
-        # Simulate unobserved ccs.
-        Q_cc = [(row_id, c)
-                for c in self.lcols(bdb, genid) if c not in samples[0]]
-        V_cc = self.cc(bdb, genid).simulate_joint(bdb, self.cc_id(bdb, genid),
-            Q_cc, Y_cc, modelno, num_predictions=n_samples)
-        for k in xrange(n_samples):
-            w = w0
-            # Add simulated Q_cc.
-            samples[k].update({c:v for (_, c), v in zip(Q_cc, V_cc[k])})
-            for fcol in self.topo(bdb, genid):
-                pcols = self.pcols(bdb, genid, fcol)
-                predictor = self.predictor(bdb, genid, fcol)
-                # All parents of FP known (evidence or simulated)?
-                assert pcols.issubset(set(samples[k]))
-                conditions = {core.bayesdb_generator_column_name(
-                    bdb, genid, c):v for c,v in samples[k].iteritems()
-                        if c in pcols}
-                if fcol in samples[k]:
-                    # f is evidence: compute likelihood weight.
-                    w += predictor.logpdf(samples[k][fcol], conditions)
-                else:
-                    # f is latent: simulate from conditional distribution.
-                    samples[k][fcol] = predictor.simulate(1, conditions)[0]
-            weights.append(w)
+        return self._weighted_sample_blocks(bdb, genid,
+            [(m, row_id, Y, n) for m, n in
+                self._model_shares(bdb, genid, modelno, n_samples)])
+
+    def _model_shares(self, bdb, genid, modelno, n_samples):
+        # Returns how to split n_samples among models, as (modelno, n)
+        # pairs.  If the models have predictors of their own, samples over
+        # all models are drawn in equal shares from each model.
+        if modelno is None and \
+                self._model_state(bdb, genid)['model_predictors']:
+            modelnos = core.bayesdb_generator_modelnos(bdb, genid)
+            return [(m, len(share)) for m, share in zip(modelnos,
+                    np.array_split(np.arange(n_samples), len(modelnos)))
+                if len(share) > 0]
+        return [(modelno, n_samples)]
+
+    def _weighted_sample_blocks(self, bdb, genid, blocks):
+        # Returns (samples, weights) as _weighted_sample does, for the
+        # concatenation of blocks of weighted samples given as (modelno,
+        # row_id, Y, n_samples) tuples, possibly for different rows,
+        # models and evidence.  Blocks with the same model and crosscat
+        # evidence for the same row, or for rows not in the table, share
+        # their crosscat calls, and each foreign predictor is queried once
+        # for the samples of each model.
+        lcols = self.lcols(bdb, genid)
+        colnames = self._catalog(bdb, genid)['colnames']
+        sizes = [n for _, _, _, n in blocks]
+        starts = np.cumsum([0] + sizes)
+        n_total = starts[-1]
+        samples = {c: np.empty(n_total, dtype=object)
+            for c in list(lcols) + self.topo(bdb, genid)}
+        observed = {c: np.zeros(n_total, dtype=bool) for c in samples}
+        weights = np.zeros(n_total)
+        # Fill in the evidence.
+        for b, (_, row_id, Y, _) in enumerate(blocks):
+            for r, c, v in Y:
+                if r == row_id:
+                    samples[c][starts[b]:starts[b+1]] = _constant_column(v,
+                        sizes[b])
+                    observed[c][starts[b]:starts[b+1]] = True
+        # Group the blocks which can share crosscat calls.
+        fresh_row_id = None
+        if len(blocks) > 1:
+            fresh_row_id = core.bayesdb_generator_fresh_row_id(bdb, genid)
+        groups = collections.OrderedDict()
+        for b, (modelno, row_id, Y, _) in enumerate(blocks):
+            row_key = row_id
+            if fresh_row_id is not None and fresh_row_id <= row_id:
+                row_key = fresh_row_id
+            Y_cc = tuple(sorted((row_key if r == row_id else r, c, v)
+                for r, c, v in Y if c in lcols))
+            groups.setdefault((modelno, row_key, Y_cc), []).append(b)
+        for (modelno, row_key, Y_cc), members in groups.iteritems():
+            # Assess likelihood of evidence at root.
+            Y_cc = list(Y_cc)
+            if Y_cc:
+                logp = self.cc(bdb, genid).logpdf_joint(bdb,
+                    self.cc_id(bdb, genid), Y_cc, [], modelno)
+                for b in members:
+                    weights[starts[b]:starts[b+1]] += logp
+            # Simulate unobserved ccs.
+            Q_cc = [(row_key, c) for c in lcols
+                if not observed[c][starts[members[0]]]]
+            if Q_cc:
+                V_cc = self.cc(bdb, genid).simulate_joint(bdb,
+                    self.cc_id(bdb, genid), Q_cc, Y_cc, modelno,
+                    num_predictions=sum(sizes[b] for b in members))
+                offset = 0
+                for b in members:
+                    for i, (_, c) in enumerate(Q_cc):
+                        samples[c][starts[b]:starts[b+1]] = _column(
+                            [v[i] for v in V_cc[offset:offset+sizes[b]]])
+                    offset += sizes[b]
+        # Visit the foreign columns in order, each for all samples of each
+        # model at once.
+        models = collections.OrderedDict()
+        for b, (modelno, _, _, _) in enumerate(blocks):
+            models.setdefault(modelno, []).append(
+                np.arange(starts[b], starts[b+1]))
+        for fcol in self.topo(bdb, genid):
+            pcols = sorted(self.pcols(bdb, genid, fcol))
+            for modelno, indices in models.iteritems():
+                predictor = self.predictor(bdb, genid, fcol, modelno)
+                indices = np.concatenate(indices)
+                evidence = observed[fcol][indices]
+                for select, is_evidence in [(indices[evidence], True),
+                        (indices[~evidence], False)]:
+                    if len(select) == 0:
+                        continue
+                    conditions = pd.DataFrame(
+                        {colnames[c]:samples[c][select] for c in pcols},
+                        index=np.arange(len(select)),
+                        columns=[colnames[c] for c in pcols])
+                    if is_evidence:
+                        # f is evidence: compute likelihood weights.
+                        weights[select] += _logpdf_many(predictor,
+                            samples[fcol][select], conditions)
+                    else:
+                        # f is latent: simulate from conditional
+                        # distribution.
+                        samples[fcol][select] = _column(
+                            _simulate_many(predictor, conditions))
         return samples, weights
 
     def cc_colno(self, bdb, genid, colno):
         return self.cc_colnos(bdb, genid, [colno])[0]
 
     def cc_colnos(self, bdb, genid, colnos):
-        lcolnames = [bayeslite.core.bayesdb_generator_column_name(bdb,
-            genid, colno) for colno in colnos]
-        return [bayeslite.core.bayesdb_generator_column_number(bdb,
-            self.cc_id(bdb, genid), lcolname) for lcolname in lcolnames]
+        cc_colnos = self._catalog(bdb, genid)['cc_colnos']
+        return [cc_colnos[colno] if colno in cc_colnos else
+            bayeslite.core.bayesdb_generator_column_number(bdb,
+                self.cc_id(bdb, genid),
+                bayeslite.core.bayesdb_generator_column_name(bdb, genid,
+                    colno))
+            for colno in colnos]
 
     def cc_id(self, bdb, genid):
-        cursor = bdb.sql_execute('''
-            SELECT crosscat_generator_id FROM bayesdb_composer_cc_id
-                WHERE generator_id = ?
-        ''', (genid,))
-        return cursor.fetchall()[0][0]
+        return self._catalog(bdb, genid)['cc_id']
 
     def cc(self, bdb, genid):
-        return core.bayesdb_generator_metamodel(bdb, self.cc_id(bdb, genid))
+        name = self._catalog(bdb, genid)['cc_metamodel']
+        if name not in bdb.metamodels:
+            # Let bayeslite report the missing metamodel.
+            return core.bayesdb_generator_metamodel(bdb,
+                self.cc_id(bdb, genid))
+        return bdb.metamodels[name]
 
     def lcols(self, bdb, genid):
-        cursor = bdb.sql_execute('''
-            SELECT colno FROM bayesdb_composer_column_owner
-                WHERE generator_id = ? AND local = 1
-                ORDER BY colno ASC
-        ''', (genid,))
-        return set([row[0] for row in cursor])
+        return self._catalog(bdb, genid)['lcols']
 
     def fcols(self, bdb, genid):
-        cursor = bdb.sql_execute('''
-            SELECT colno FROM bayesdb_composer_column_owner
-                WHERE generator_id = ? AND local = 0
-                ORDER BY colno ASC
-        ''', (genid,))
-        return set([row[0] for row in cursor])
+        return self._catalog(bdb, genid)['fcols']
 
     def pcols(self, bdb, genid, fcolno):
-        cursor = bdb.sql_execute('''
-            SELECT pcolno FROM bayesdb_composer_column_parents
-                WHERE generator_id = ? AND fcolno = ?
-                ORDER BY pcolno ASC
-        ''', (genid, fcolno))
-        return set([row[0] for row in cursor])
+        return self._catalog(bdb, genid)['pcols'].get(fcolno, frozenset())
 
     def topo(self, bdb, genid):
-        cursor = bdb.sql_execute('''
-            SELECT colno FROM bayesdb_composer_column_toposort
-                WHERE generator_id = ?
-                ORDER BY position ASC
-            ''', (genid,))
-        return [row[0] for row in cursor]
+        return list(self._catalog(bdb, genid)['topo'])
 
     def predictor_name(self, bdb, genid, fcol):
-        cursor = bdb.sql_execute('''
-            SELECT predictor_name FROM bayesdb_composer_column_foreign_predictor
-                WHERE generator_id = ? AND colno = ?
-        ''', (genid, fcol))
-        return cursor.fetchall()[0][0]
-
-    def predictor(self, bdb, genid, fcol):
-        if (genid, fcol) not in self._predictor_cache(bdb):
+        return self._catalog(bdb, genid)['predictor_names'][fcol]
+
+    def predictor(self, bdb, genid, fcol, modelno=None):
+        # Returns the predictor of fcol for modelno, which is the instance
+        # trained for that model if there is one, and otherwise the
+        # instance trained on the full table that all models share.
+        # Within a savepoint, each predictor is looked up once.  Across
+        # savepoints, deserialized predictors are shared through the
+        # persistent cache, keyed by a hash of the stored binary so that
+        # retrained predictors are never confused with stale ones.
+        if not self._model_state(bdb, genid)['model_predictors']:
+            modelno = None
+        if (genid, fcol, modelno) not in self._predictor_cache(bdb):
             cursor = bdb.sql_execute('''
-                SELECT predictor_name, predictor_binary
-                    FROM bayesdb_composer_column_foreign_predictor
-                    WHERE generator_id = ? AND colno = ?
-            ''', (genid, fcol))
+                SELECT p.predictor_name,
+                        COALESCE(m.predictor_binary, p.predictor_binary)
+                    FROM bayesdb_composer_column_foreign_predictor AS p
+                    LEFT OUTER JOIN bayesdb_composer_model_foreign_predictor
+                        AS m
+                        ON m.generator_id = p.generator_id
+                            AND m.colno = p.colno AND m.modelno = ?
+                    WHERE p.generator_id = ? AND p.colno = ?
+            ''', (modelno, genid, fcol))
             name, binary = cursor.fetchall()[0]
             builder = self.predictor_builder.get(name, None)
             if builder is None:
                 raise BLE(LookupError('Foreign predictor for column "{}" '
                     'not registered: "{}".'.format(name,
                         core.bayesdb_generator_column_name(bdb, genid, fcol))))
-            self._predictor_cache(bdb)[(genid, fcol)] = \
-                builder.deserialize(bdb, binary)
-        return self._predictor_cache(bdb)[(genid, fcol)]
+            key = (genid, fcol, hashlib.sha1(binary).hexdigest())
+            cache = self._persistent_predictor_cache(bdb)
+            predictor = cache.get(key)
+            if predictor is None:
+                predictor = builder.deserialize(bdb, binary)
+                cache.put(key, predictor, len(binary))
+            self._predictor_cache(bdb)[(genid, fcol, modelno)] = predictor
+        return self._predictor_cache(bdb)[(genid, fcol, modelno)]
 
     def parse(self, schema):
         """Parse the given `schema` for a `composer` metamodel.
@@ -1038,3 +1761,162 @@ class Composer(bayeslite.metamodel.IBayesDBMetamodel):
                 raise BLE(ValueError(
                     'A cyclic dependency occurred in topological_sort.'))
         return graph_sorted
+
+
+class PredictorCache(object):
+    """Bounded least-recently-used cache of deserialized foreign predictors.
+
+    Entries are keyed by (generator_id, colno, hash of the serialized
+    predictor).  The footprint of each entry is the size of its serialized
+    form, a proxy for the memory the deserialized predictor holds; least
+    recently used entries are evicted once the total exceeds `max_bytes`.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """Return the predictor cached under `key`, or None."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries[key] = entry
+        return entry[0]
+
+    def put(self, key, predictor, nbytes):
+        """Cache `predictor` under `key`, evicting as needed.
+
+        A predictor larger than the whole cache is not kept.
+        """
+        self._discard(key)
+        if nbytes > self.max_bytes:
+            return
+        self._entries[key] = (predictor, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            self._discard(next(iter(self._entries)))
+
+    def evict_generator(self, generator_id):
+        """Drop all predictors of the generator `generator_id`."""
+        for key in [k for k in self._entries if k[0] == generator_id]:
+            self._discard(key)
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[1]
+
+# The table being trained on, in a foreign predictor training worker.
+_TRAINING_DF = None
+
+def _init_training_worker(df):
+    global _TRAINING_DF
+    _TRAINING_DF = df
+
+def _train_predictor(job):
+    return _fit_predictor(_TRAINING_DF, *job)
+
+def _fit_predictor(df, builder, targets, conditions, seed):
+    """Train a predictor from builder on df, or on a bootstrap resample of
+    its rows drawn with seed if seed is not None."""
+    if seed is not None:
+        rows = np.random.RandomState(seed).randint(len(df), size=len(df))
+        df = df.iloc[rows].reset_index(drop=True)
+    return builder.create_from_df(df, targets, conditions)
+
+def _log_mean_stderr(log_weights):
+    """Standard error of the log of the mean of exp(log_weights), by the
+    delta method: the standard error of the mean relative to the mean."""
+    w_max = np.max(log_weights)
+    if not np.isfinite(w_max):
+        return 0.
+    if len(log_weights) < 2:
+        return float('inf')
+    w = np.exp(log_weights - w_max)
+    return np.std(w, ddof=1) / (np.sqrt(len(w)) * np.mean(w))
+
+def _log_ratio_stderr(log_weights_a, log_weights_b):
+    """Standard error of the log of the ratio of the means of exp(log_weights_a)
+    and exp(log_weights_b), estimated from the same samples, by the delta
+    method applied to the paired weights."""
+    a_max, b_max = np.max(log_weights_a), np.max(log_weights_b)
+    if not (np.isfinite(a_max) and np.isfinite(b_max)):
+        return 0.
+    if len(log_weights_a) < 2:
+        return float('inf')
+    a = np.exp(log_weights_a - a_max)
+    b = np.exp(log_weights_b - b_max)
+    z = a / np.mean(a) - b / np.mean(b)
+    return np.std(z, ddof=1) / np.sqrt(len(z))
+
+def _log_mean_exp_stderr(logps, stderrs):
+    """Standard error of logmeanexp(logps), by the delta method, given the
+    standard errors of independent estimates logps."""
+    logps = np.asarray(logps, dtype=float)
+    p_max = np.max(logps)
+    if not np.isfinite(p_max):
+        return 0.
+    p = np.exp(logps - p_max)
+    terms = [w * se for w, se in zip(p, stderrs) if w > 0]
+    return np.sqrt(np.sum(np.square(terms))) / np.sum(p)
+
+def _mean_stderr(values):
+    """Standard error of the mean of values."""
+    if len(values) < 2:
+        return float('inf')
+    return np.std(values, ddof=1) / np.sqrt(len(values))
+
+def effective_sample_size(log_weights):
+    """Return the effective sample size of a set of importance weights.
+
+    Kish's estimate (sum w)^2 / sum w^2, computed from log weights.  It
+    ranges from 1, when a single particle carries all the weight, to the
+    number of particles, when the weights are uniform.
+    """
+    log_weights = np.asarray(log_weights, dtype=float)
+    w = np.exp(log_weights - np.max(log_weights))
+    return np.sum(w)**2 / np.sum(w**2)
+
+def _column(values):
+    """Return the values of one node in a batch of samples as an array."""
+    column = np.empty(len(values), dtype=object)
+    column[:] = values
+    return column
+
+def _constant_column(value, n_samples):
+    """Return a column of n_samples copies of an observed value."""
+    column = np.empty(n_samples, dtype=object)
+    column.fill(value)
+    return column
+
+def _simulate_many(predictor, conditions):
+    """Simulate a value from predictor for each row of conditions, a
+    DataFrame with a column of values for each of its conditions.
+
+    Predictors which do not implement the batch interface of
+    IBayesDBForeignPredictor are queried one row at a time."""
+    if hasattr(predictor, 'simulate_many'):
+        return predictor.simulate_many(conditions)
+    return [predictor.simulate(1, row)[0]
+            for row in conditions.to_dict('records')]
+
+def _logpdf_many(predictor, values, conditions):
+    """Evaluate the log density of predictor for each of values, given the
+    conditions in the matching row of the DataFrame conditions."""
+    if hasattr(predictor, 'logpdf_many'):
+        return np.asarray(predictor.logpdf_many(values, conditions),
+            dtype=float)
+    return np.array([predictor.logpdf(value, row)
+            for value, row in zip(values, conditions.to_dict('records'))])
@@ -27,10 +27,16 @@ become intractable.  Splitting the processing up among multiple cores can
 greatly reduce computation time; this module provides functionality to assist
 this multiprocessing.
 
-Currently, a multiprocessing equivalent is provided only for
-``ESTIMATE PAIRWISE SIMILARITY``. In fact, this is a query that is most likely
-to require multiprocessing, as datasets frequently have many more rows than
-columns.
+A multiprocessing equivalent is provided for ``ESTIMATE PAIRWISE
+SIMILARITY``, by :func:`estimate_pairwise_similarity`. In fact, this is a
+query that is most likely to require multiprocessing, as datasets frequently
+have many more rows than columns. When only the most similar rows to each
+row are wanted, it can also skip the pairs of rows which crosscat's models
+never put in the same cluster. Other row-wise ``ESTIMATE`` and ``INFER``
+queries, such as ``PREDICTIVE PROBABILITY OF`` or ``INFER EXPLICIT PREDICT``
+over a whole table, can be split by rows with :func:`execute`, and queries
+which are slow because of many models rather than many rows can be split by
+model with :func:`execute_by_model`.
 
 Example
 -------
@@ -73,39 +79,383 @@ machines.
 ----
 """
 
+from apsw import BusyError
 from bayeslite.exception import BayesLiteException as BLE
 from bdbcontrib.bql_utils import cursor_to_df
 import multiprocessing as mp
+import Queue
+import errno
+import itertools
+import numpy as np
+from numpy.lib.format import open_memmap
+import os
+import pandas as pd
+import uuid
+from bayeslite import ast
 from bayeslite import bayesdb_open, bql_quote_name
+from bayeslite import core
+from bayeslite.bql import execute_phrase
+from bayeslite.parse import parse_bql_string
+from bayeslite.txn import bayesdb_caching
 from bayeslite.util import cursor_value
 
+# Largest number of pairwise similarities a worker hands back at once.  The
+# parent holds at most one such chunk, and the queue at most one per core.
+_MAX_CHUNKSIZE = 100000
 
-def _query_into_queue(query_string, params, queue, bdb_file):
+# Blocks of rows to split the similarity matrix into per core by default, so
+# that cores which finish early can take over work from the slower ones.
+_BLOCKS_PER_CORE = 4
+
+# Seconds the parent waits on the result queue before checking whether a
+# worker has died.
+_POLL_SECONDS = 1
+
+
+# The BayesDB handle of a worker process in a ParallelBdb pool, opened once by
+# _open_worker_bdb when the process starts.
+_WORKER_BDB = None
+
+# The bayesdb_caching context which keeps _WORKER_BDB's bdb.cache between
+# tasks, entered by _start_worker_cache and left only to start it afresh.
+_WORKER_CACHING = None
+
+# The (generator_id, modelno, iterations) of every model in the database when
+# the worker's bdb.cache was started, so that it can be restarted once the
+# models change.
+_WORKER_MODELS = None
+
+# The job id and crosscat_utils.RowClusters of the last nearest-neighbor job
+# this worker ran a task of, so that the models are indexed once per job
+# rather than once per block.
+_WORKER_CLUSTERS = None
+
+
+def _open_worker_bdb(bdb_file, workers):
+    """
+    Open the BayesDB handle which every task run by this worker process
+    shares.
+
+    bayeslite keeps bdb.cache only for one query, so the metamodels would
+    reload the models (e.g. crosscat thetas) for every task.  Entering
+    bayeslite's bayesdb_caching context here, and staying in it, keeps
+    bdb.cache between tasks instead.  The context issues no SQL, so no
+    SQLite transaction is held open between tasks and the parent can still
+    write: each query still runs in a SAVEPOINT of its own, which, outside
+    of BEGIN, commits when it is released.
+
+    The process id is first registered in the Manager dict `workers`, so
+    that the parent can tell if this worker dies.
+    """
+    workers[os.getpid()] = True
+    global _WORKER_BDB
+    _WORKER_BDB = bayesdb_open(pathname=bdb_file)
+    _start_worker_cache()
+
+
+def _start_worker_cache():
+    """Enter a fresh bayesdb_caching context on this worker's bdb."""
+    global _WORKER_CACHING
+    _WORKER_CACHING = bayesdb_caching(_WORKER_BDB)
+    _WORKER_CACHING.__enter__()
+
+
+def _refresh_worker_cache():
+    """
+    Start this worker's bdb.cache afresh if any model has been initialized,
+    analyzed or dropped since it was started, e.g. by the parent while the
+    pool was open.
+    """
+    global _WORKER_MODELS
+    models = _WORKER_BDB.sql_execute('''
+        SELECT generator_id, modelno, iterations FROM bayesdb_generator_model
+            ORDER BY generator_id, modelno
+    ''').fetchall()
+    if _WORKER_MODELS is not None and models != _WORKER_MODELS:
+        # Leaving the context drops bdb.cache, and entering it again starts
+        # an empty one.
+        _WORKER_CACHING.__exit__(None, None, None)
+        _start_worker_cache()
+    _WORKER_MODELS = models
+
+
+def _run_task(key, func, args, queue, running):
+    """
+    Run func(*args) on this worker and place ``(key, result)`` in the
+    multiprocessing Manager.Queue().
+
+    Multiprocessing workers must be pickleable, and thus must be declared as
+    toplevel functions.  While func runs, the task is listed in the Manager
+    dict `running` under this process's id, so that the parent can tell if
+    the process dies under it.
+    """
+    running[key] = os.getpid()
+    try:
+        _refresh_worker_cache()
+        queue.put((key, func(*args)))
+    finally:
+        running.pop(key, None)
+
+
+def _query_df(query_string, params):
+    """
+    Execute the BQL query_string with params and return its results as a
+    DataFrame.
+
+    Multiple processes cannot share a bdb handle, so the query runs on the
+    handle this worker process opened in _open_worker_bdb.
+    """
+    return cursor_to_df(_WORKER_BDB.execute(query_string, params))
+
+
+def _similarity_arrays(query_string, params):
+    """
+    Estimate pairwise similarities according to query_string and return
+    them as arrays: an n x 2 integer array of rowid0 and rowid1, and an
+    array of the n similarities.
+    """
+    res = _WORKER_BDB.execute(query_string, params)
+    data = np.fromiter(
+        itertools.chain.from_iterable(res), dtype=float).reshape(-1, 3)
+    return data[:, :2].astype(np.int64), data[:, 2]
+
+
+def _neighbor_arrays(generator, job, params, top_k):
     """
-    Estimate pairwise similarity of a certain subset of the bdb according to
-    query_string; place it in the multiprocessing Manager.Queue().
+    Find the top_k most similar rows to each of the rows of the generator
+    with rowid between the first two params, among those with rowid at most
+    the third, from crosscat's cluster assignments, and return them in the
+    arrays of _similarity_arrays.
+    """
+    # Imported here, as crosscat_utils brings pyplot with it.
+    from bdbcontrib.crosscat_utils import RowClusters
+    global _WORKER_CLUSTERS
+    if _WORKER_CLUSTERS is None or _WORKER_CLUSTERS[0] != job:
+        generator_id = core.bayesdb_get_generator(_WORKER_BDB, generator)
+        _WORKER_CLUSTERS = (job, RowClusters(_WORKER_BDB, generator_id))
+    clusters = _WORKER_CLUSTERS[1]
+    first, last, last_rowid = params
+    rowids = clusters.rowids[
+        (clusters.rowids >= first) & (clusters.rowids <= last)]
+    candidates = clusters.rowids <= last_rowid
+    pairs = [np.zeros((0, 2), dtype=np.int64)]
+    values = [np.zeros(0)]
+    for rowid in rowids:
+        neighbors, similarities = clusters.neighbors(
+            rowid, top_k, candidates)
+        pairs.append(np.column_stack(
+            (np.repeat(rowid, len(neighbors)), neighbors)))
+        values.append(similarities)
+    return np.concatenate(pairs), np.concatenate(values)
+
 
-    For two technical reasons, this function is defined as a toplevel class and
-    independently creates a bdb handle:
+def _executemany(bdb, sql, rows):
+    """
+    Execute the SQL statement sql on bdb once for each of the rows of
+    bindings, all in one savepoint.
+
+    The rows are handed to the SQLite cursor's executemany, which prepares
+    sql once and steps it through every row in C, rather than going through
+    bdb.sql_execute once per row.
+    """
+    with bdb.savepoint():
+        bdb._sqlite3.cursor().executemany(sql, rows)
+
+
+def _phrase_df(phrase, bindings):
+    """
+    Execute the parsed BQL phrase on this worker's bdb handle and return its
+    results as a DataFrame.
+    """
+    return cursor_to_df(execute_phrase(_WORKER_BDB, phrase, bindings))
 
-    1) Multiprocessing workers must be pickleable, and thus must be
-       declared as toplevel functions;
-    2) Multiple threads cannot access the same bdb handle, lest concurrency
-       issues arise with corrupt data.
+
+class ParallelBdb(object):
+    """
+    A pool of worker processes which each keep a BayesDB handle open.
+
+    Opening a BayesDB and loading its models is expensive, so rather than
+    doing both for every task, each worker opens the database once when it
+    starts and keeps its models cached, and the pool can be reused across
+    queries::
+
+        with parallel.ParallelBdb(bdb_file) as pbdb:
+            parallel.estimate_pairwise_similarity(
+                bdb_file, 't', 't_cc', pool=pbdb)
+            parallel.estimate_pairwise_similarity(
+                bdb_file, 'u', 'u_cc', pool=pbdb)
+
+    Before each task, a worker compares the iterations of every model with
+    those when it started its cache, and starts it afresh if models have
+    been initialized, analyzed or dropped since, e.g. by ANALYZE in the
+    parent while the pool is open.  Models dropped and initialized again
+    to the same numbers, and not yet analyzed, look unchanged, so close the
+    pool and open a new one after re-initializing models.
+
+    By default, the database is switched to SQLite's write-ahead logging
+    journal mode, so that the workers can read while the parent writes
+    their results.  The journal mode is stored in the database file, so
+    closing the pool switches it back to the previous mode, unless another
+    connection still has the database open, in which case it stays in
+    write-ahead logging mode.
 
     Parameters
     ----------
-    query_string : str
-        Name of the query to execute, determined by estimate_similarity_mp.
-    queue : multiprocessing.Manager.Queue
-        Queue to place results into
     bdb_file : str
-        File location of the BayesDB database. This function will
-        independently open a new BayesDB handler.
+        File location of the BayesDB database object.
+    cores : int
+        Number of worker processes. Defaults to the number of cores as
+        identified by multiprocessing.num_cores.
+    wal : bool
+        Whether to switch the database to write-ahead logging while the
+        pool is open. Without it, writing results while the workers read,
+        e.g. by estimate_pairwise_similarity into a table, may fail with
+        the database locked. Default True.
     """
-    bdb = bayesdb_open(pathname=bdb_file)
-    res = bdb.execute(query_string, params)
-    queue.put(cursor_to_df(res))
+
+    def __init__(self, bdb_file, cores=None, wal=True):
+        if cores is None:
+            cores = mp.cpu_count()
+        if cores < 1:
+            raise BLE(ValueError(
+                "Invalid number of cores {}".format(cores)))
+        self.bdb_file = bdb_file
+        self.cores = cores
+
+        # Readers do not block the writer, nor vice versa, in WAL mode.
+        # Switch before the workers connect.
+        self._journal_mode = None
+        if wal:
+            bdb = bayesdb_open(pathname=bdb_file)
+            try:
+                self._journal_mode = cursor_value(
+                    bdb.sql_execute('PRAGMA journal_mode'))
+                bdb.sql_execute('PRAGMA journal_mode = WAL')
+            finally:
+                bdb.close()
+
+        self._manager = mp.Manager()
+        # Process ids of the workers, registered by each as it starts.
+        self._workers = self._manager.dict()
+        self._pool = self._start_pool()
+
+    def _start_pool(self):
+        return mp.Pool(processes=self.cores, initializer=_open_worker_bdb,
+                       initargs=(self.bdb_file, self._workers))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def stream(self, query_string, params_list, consume):
+        """
+        Run query_string once for each of params_list across the workers,
+        passing each result, as a DataFrame, to consume as soon as it
+        arrives.
+
+        The queue between the workers and the parent holds at most one
+        result per core, so a slow consume makes the workers wait rather
+        than pile up results in memory.  Results arrive in no particular
+        order.
+
+        If a query fails, the others still run; once they are done, the
+        error is re-raised.
+        """
+        self._stream(
+            _query_df,
+            [(query_string, params) for params in params_list],
+            lambda key, df: consume(df))
+
+    def _stream(self, func, args_list, consume, retries=0):
+        """
+        Run func(*args) for each of args_list across the workers, passing
+        the index of args in args_list and the result to consume as each
+        arrives.
+
+        A task which raises, or whose worker process dies, is run again up
+        to retries more times.  Tasks which fail every time do not stop the
+        others: once those are done, the first failure is re-raised.
+
+        If anything else goes wrong, e.g. consume raises, the workers are
+        restarted, since tasks still running cannot be cancelled.
+        """
+        queue = self._manager.Queue(maxsize=self.cores)
+        running = self._manager.dict()
+        submitted = []
+
+        def submit(key):
+            result = self._pool.apply_async(
+                _run_task, args=(key, func, args_list[key], queue, running))
+            submitted.append(result)
+            return result
+
+        def dead_workers():
+            # The pool replaces its workers which exit, but does not say
+            # so.  Report each dead one once.
+            dead = set(pid for pid in self._workers.keys()
+                       if not _process_alive(pid))
+            for pid in dead:
+                self._workers.pop(pid, None)
+            return dead
+
+        def restart():
+            self._restart_pool()
+            running.clear()
+            del submitted[:]
+
+        try:
+            failures = _drain_queue(
+                queue, running, submit, len(args_list), consume, retries,
+                dead_workers=dead_workers, restart=restart)
+        except BaseException:
+            self._restart_pool()
+            raise
+        # The pool waits forever for the results of tasks whose workers
+        # died, so it cannot be closed cleanly any more.
+        if not all(result.ready() for result in submitted):
+            self._restart_pool()
+        if failures:
+            raise failures[0][1]
+
+    def _restart_pool(self):
+        self._pool.terminate()
+        self._pool.join()
+        self._workers.clear()
+        self._pool = self._start_pool()
+
+    def close(self):
+        """Wait for the workers to finish and shut them down."""
+        self._pool.close()
+        self._pool.join()
+        self._manager.shutdown()
+        self._restore_journal_mode()
+
+    def terminate(self):
+        """Shut down the workers without waiting for them to finish."""
+        self._pool.terminate()
+        self._pool.join()
+        self._manager.shutdown()
+        self._restore_journal_mode()
+
+    def _restore_journal_mode(self):
+        """Switch the database back to the journal mode it had before the
+        pool switched it to write-ahead logging, if no other connection
+        has it open."""
+        if self._journal_mode is None or self._journal_mode == 'wal':
+            return
+        bdb = bayesdb_open(pathname=self.bdb_file)
+        try:
+            bdb.sql_execute(
+                'PRAGMA journal_mode = {}'.format(self._journal_mode))
+        except BusyError:
+            pass
+        finally:
+            bdb.close()
 
 
 def _chunks(l, n):
@@ -114,8 +464,143 @@ def _chunks(l, n):
         yield l[i:i+n]
 
 
+def _row_blocks(rowids, chunksize, symmetric):
+    """
+    Split the sorted `rowids` into consecutive blocks of rowid0 values and
+    return the first and last rowid of each block.
+
+    A block grows until its rows own at least `chunksize` pairs: every rowid0
+    pairs with all len(rowids) rowids, or with symmetric=True only with those
+    at or after it, so that blocks near the end of the upper triangle take
+    more rows.
+    """
+    n = len(rowids)
+    blocks = []
+    start = 0
+    pairs = 0
+    for i in xrange(n):
+        pairs += n - i if symmetric else n
+        if pairs >= chunksize or i == n - 1:
+            blocks.append((rowids[start], rowids[i]))
+            start = i + 1
+            pairs = 0
+    return blocks
+
+
+def _drain_queue(queue, running, submit, ntasks, consume, retries,
+                 dead_workers=None, restart=None):
+    """
+    Submit the tasks 0, ..., ntasks - 1 with `submit`, which returns a
+    `multiprocessing.AsyncResult`, and pass each ``(key, result)`` in
+    `queue` to `consume` as soon as it arrives, until every task has
+    delivered its result or failed retries + 1 times.
+
+    A task which raises, or whose worker process dies, never delivers its
+    result, so while the queue is empty we check the AsyncResults, and the
+    process ids in the Manager dict `running` of the tasks still running,
+    and submit the failed tasks again instead of waiting forever.
+
+    A worker may also die after taking a task but before listing it in
+    `running`, which leaves no trace of which task was lost.  So if
+    `dead_workers`, which returns the process ids of the workers which died
+    since it was last called, shows one with no task listed under it,
+    `restart` replaces all the workers and every unfinished task is
+    submitted again.  After retries
+    + 1 such restarts, the unfinished tasks are reported as failed.
+
+    Return the list of ``(key, exception)`` of the tasks which failed every
+    time.
+    """
+    results = dict((key, submit(key)) for key in xrange(ntasks))
+    attempts = dict.fromkeys(results, 1)
+    failures = []
+    restarts = 0
+    while results:
+        try:
+            key, item = queue.get(timeout=_POLL_SECONDS)
+        except Queue.Empty:
+            # Snapshot the running tasks before the workers: a worker which
+            # lists a task after the snapshot and then dies only costs a
+            # needless restart.
+            listed = running.copy()
+            dead = dead_workers() if dead_workers is not None else set()
+            unlisted = dead - set(listed.itervalues())
+            if unlisted:
+                restarts += 1
+                if restarts > retries:
+                    error = BLE(RuntimeError(
+                        "Worker process {} died before its task started"
+                        .format(min(unlisted))))
+                    failures.extend(
+                        (key, error) for key in sorted(results))
+                    results.clear()
+                    break
+                restart()
+                for key in results:
+                    results[key] = submit(key)
+                continue
+            errors = {}
+            for key, result in results.iteritems():
+                if result.ready() and not result.successful():
+                    try:
+                        result.get()
+                    except Exception as e:
+                        errors[key] = e
+            for key, pid in listed.iteritems():
+                if key in results and key not in errors and \
+                        not _process_alive(pid):
+                    errors[key] = BLE(RuntimeError(
+                        "Worker process {} died".format(pid)))
+            for key, error in sorted(errors.iteritems()):
+                running.pop(key, None)
+                if attempts[key] <= retries:
+                    attempts[key] += 1
+                    results[key] = submit(key)
+                else:
+                    failures.append((key, error))
+                    del results[key]
+            continue
+        # A task which died after delivering its result may have been run
+        # again, so ignore all but the first result.
+        if key in results:
+            del results[key]
+            consume(key, item)
+    return failures
+
+
+def _process_alive(pid):
+    """True if the process with id pid has not exited."""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def _drop_sim_table(bdb, sim_table):
+    """
+    Drop sim_table, whether it is a plain table or the view over the upper
+    triangle written by a symmetric estimate_pairwise_similarity.
+    """
+    cursor = bdb.sql_execute('''
+        SELECT type FROM sqlite_master WHERE name = ?
+    ''', (sim_table,))
+    if 'view' in [row[0] for row in cursor]:
+        bdb.sql_execute('DROP VIEW {}'.format(bql_quote_name(sim_table)))
+        bdb.sql_execute('DROP TABLE IF EXISTS {}'.format(
+            bql_quote_name(sim_table + '_triangle')))
+    else:
+        bdb.sql_execute('DROP TABLE IF EXISTS {}'.format(
+            bql_quote_name(sim_table)))
+    _delete_similarity_job(bdb, sim_table)
+
+
 def estimate_pairwise_similarity(bdb_file, table, model, sim_table=None,
-                                 cores=None, N=None, overwrite=False):
+                                 cores=None, N=None, overwrite=False,
+                                 chunksize=None, symmetric=False, pool=None,
+                                 output='table', path=None, threshold=None,
+                                 top_k=None, resume=False, retries=2,
+                                 use_clusters=False):
     """
     Estimate pairwise similarity from the given model, splitting processing
     across multiple processors, and save results into sim_table.
@@ -124,6 +609,31 @@ def estimate_pairwise_similarity(bdb_file, table, model, sim_table=None,
     instances, this function accepts a BayesDB filename, rather than an actual
     bayeslite.BayesDB object.
 
+    Results are streamed: the parent inserts each chunk into sim_table as soon
+    as a worker delivers it, while the other workers keep computing.  The
+    queue between them holds at most one chunk per core, so a slow insert
+    makes the workers wait rather than pile up results in memory.  To let
+    the workers read while the parent writes, the database is switched to
+    SQLite's write-ahead logging journal mode.  Once every pair is in, the
+    table is indexed on (rowid0, rowid1).
+
+    With output='table', the blocks of rows the work is split into are
+    recorded in the database, and each block is marked done in the same
+    transaction as its similarities are inserted.  A block which fails is
+    run again; if it fails every time, the other blocks still finish before
+    the error is raised, and the job can be completed later with
+    resume=True.
+
+    The workers are those of pool, if given, or else of a ParallelBdb
+    started for this call and shut down at its end.
+
+    Similarity is symmetric in its two rows, so with symmetric=True only the
+    pairs with rowid0 <= rowid1 are estimated, roughly halving the work.
+    They are stored in the table sim_table + '_triangle', and sim_table is
+    created as a view which also reads the mirror image of the off-diagonal
+    pairs from it, so queries against sim_table see the full matrix either
+    way.
+
     Parameters
     ----------
     bdb_file : str
@@ -134,116 +644,1029 @@ def estimate_pairwise_similarity(bdb_file, table, model, sim_table=None,
     model : str
         Name of the metamodel to estimate from.
     sim_table : str
-        Name of the table to insert similarity results into. Defaults to
-        table name + '_similarity'.
+        Name of the table to insert similarity results into, with
+        output='table'. Defaults to table name + '_similarity'.
     cores : int
         Number of processors to use. Defaults to the number of cores as
         identified by multiprocessing.num_cores.
     N : int
         Number of rows for which to estimate pairwise similarities (so
-        N^2 calculations are done). Should be used just to test small
-        batches; currently, there is no control over what specific pairwise
-        similarities are estimated with this parameter.
+        N^2 calculations are done, or N(N+1)/2 with symmetric=True). The
+        pairs estimated are those among the N rows with the smallest rowids.
+        Should be used just to test small batches.
     overwrite : bool
         Whether to overwrite the sim_table if it already exists. If
         overwrite=False and the table exists, function will raise
         sqlite3.OperationalError. Default True.
+    chunksize : int
+        Approximate number of pairwise similarities each worker computes and
+        hands back at a time. Work is split into blocks of whole rows, so a
+        chunk may exceed this by up to one row of pairs. Peak memory is
+        roughly one chunk per core. Defaults to splitting the N^2
+        similarities into four chunks per core, but no more than 100000 per
+        chunk.
+    symmetric : bool
+        Whether to estimate only the upper triangle of the similarity matrix
+        and present the rest through a view. Default False.
+    pool : ParallelBdb
+        Workers on bdb_file to run the queries on, which are left running
+        for later queries. If given, cores is ignored.
+    output : str
+        Where to save the similarities: 'table' for sim_table, 'dense' for
+        an N x N float32 NumPy file in path, or 'sparse' for the
+        similarities of at least threshold, or the top_k of each row, as a
+        float32 CSR matrix in path. Read the files with SimilarityMatrix.
+        Default 'table'.
+    path : str
+        Directory to save the similarity matrix in, with output='dense' or
+        output='sparse'. It is created if need be. If it already holds a
+        similarity matrix and overwrite=False, BayesLiteException is
+        raised.
+    threshold : float
+        With output='sparse', the least similarity to keep.
+    top_k : int
+        With output='sparse', the number of greatest similarities of each
+        row to keep.
+    resume : bool
+        Whether to finish the job which last wrote into sim_table but did
+        not complete, estimating only the blocks of rows not yet in the
+        table. Only output='table' can be resumed. Default False.
+    retries : int
+        Number of times to run again a block of rows whose estimate fails
+        or whose worker dies. Default 2.
+    use_clusters : bool
+        With output='sparse' and top_k, find the top_k of each row from the
+        cluster assignments of a crosscat model, comparing each row only
+        with the rows it shares a cluster with, instead of estimating every
+        pair (see crosscat_utils.similar_rows). Rows which share no cluster
+        have similarity 0 and are left out, as are any rows the generator
+        does not model. symmetric is ignored, since each row's neighbors
+        are found whole. Default False.
     """
+    if output not in ('table', 'dense', 'sparse'):
+        raise BLE(ValueError(
+            "Unknown output {!r}, expected 'table', 'dense' or 'sparse'"
+            .format(output)))
+    if output != 'table' and path is None:
+        raise BLE(ValueError(
+            "output={!r} needs a path".format(output)))
+    if output == 'sparse':
+        if threshold is None and top_k is None:
+            raise BLE(ValueError(
+                "output='sparse' needs a threshold or top_k"))
+        if top_k is not None and top_k < 1:
+            raise BLE(ValueError(
+                "Invalid top_k {}".format(top_k)))
+    elif threshold is not None or top_k is not None:
+        raise BLE(ValueError(
+            "threshold and top_k apply only to output='sparse'"))
+    if use_clusters:
+        if top_k is None:
+            raise BLE(ValueError(
+                "use_clusters needs output='sparse' and a top_k"))
+        symmetric = False
+
     bdb = bayesdb_open(pathname=bdb_file)
+    own_pool = None
+    done = False
+    try:
+        if pool is not None:
+            cores = pool.cores
+        elif cores is None:
+            cores = mp.cpu_count()
 
-    if cores is None:
-        cores = mp.cpu_count()
+        if cores < 1:
+            raise BLE(ValueError(
+                "Invalid number of cores {}".format(cores)))
 
-    if cores < 1:
-        raise BLE(ValueError(
-            "Invalid number of cores {}".format(cores)))
+        if sim_table is None:
+            sim_table = table + '_similarity'
 
-    if sim_table is None:
-        sim_table = table + '_similarity'
+        if resume:
+            if output != 'table':
+                raise BLE(ValueError(
+                    "Only output='table' can be resumed"))
+            if overwrite:
+                raise BLE(ValueError(
+                    "Cannot both resume and overwrite {}".format(sim_table)))
+            writer = _SimilarityTableWriter(
+                bdb, sim_table, symmetric, resume=True)
+            blocks, last_rowid = writer.resume(model)
+        else:
+            # Get number of occurrences in the database
+            count_cursor = bdb.execute(
+                'SELECT COUNT(*) FROM {}'.format(bql_quote_name(table))
+            )
+            table_count = cursor_value(count_cursor)
+            if N is None:
+                N = table_count
+            elif N > table_count:
+                raise BLE(ValueError(
+                    "Asked for N={} rows but {} rows in table".format(
+                        N, table_count)))
 
-    # Get number of occurrences in the database
-    count_cursor = bdb.execute(
-        'SELECT COUNT(*) FROM {}'.format(bql_quote_name(table))
-    )
-    table_count = cursor_value(count_cursor)
-    if N is None:
-        N = table_count
-    elif N > table_count:
-        raise BLE(ValueError(
-            "Asked for N={} rows but {} rows in table".format(N, table_count)))
-
-    # Calculate the size (# of similarities to compute) and
-    # offset (where to start) calculation for each worker query.
-
-    # Divide sizes evenly, and make the last job finish the remainder
-    sizes = [(N * N) / cores for i in range(cores)]
-    sizes[-1] += (N * N) % cores
-
-    total = 0
-    offsets = [total]
-    for size in sizes[:-1]:
-        total += size
-        offsets.append(total)
-
-    # Create the similarity table. Assumes original table has rowid column.
-    # XXX: tables don't necessarily have an autoincrementing primary key
-    # other than rowid, which is implicit and can't be set as a foreign key.
-    # We ought to ask for an optional user-specified foreign key, but
-    # ESTIMATE SIMILARITY returns numerical values rather than row names, so
-    # changing numerical rownames into that foreign key would be finicky. For
-    # now, we eliminate REFERENCE {table}(foreign_key) from the rowid0 and
-    # rowid1 specs.
-    sim_table_q = bql_quote_name(sim_table)
-    if overwrite:
-        bdb.sql_execute('DROP TABLE IF EXISTS {}'.format(sim_table_q))
-
-    bdb.sql_execute('''
-        CREATE TABLE {} (
-            rowid0 INTEGER NOT NULL,
-            rowid1 INTEGER NOT NULL,
-            value DOUBLE NOT NULL
-        )
-    '''.format(sim_table_q))
+            # The upper triangle of an N x N matrix, diagonal included.
+            npairs = N * (N + 1) // 2 if symmetric else N * N
+
+            if chunksize is None:
+                chunksize = min(
+                    max(1, -(-npairs // (cores * _BLOCKS_PER_CORE))),
+                    _MAX_CHUNKSIZE)
+            elif chunksize < 1:
+                raise BLE(ValueError(
+                    "Invalid chunksize {}".format(chunksize)))
+
+            # Hand each worker query a block of rowid0 values, for which it
+            # computes the pairs with all of the first N rows.  Unlike
+            # LIMIT ... OFFSET, which makes every query walk past all of the
+            # pairs before its own, a rowid range lets SQLite start right at
+            # the block.
+            rowids = [row[0] for row in bdb.sql_execute('''
+                SELECT _rowid_ FROM {} ORDER BY _rowid_ LIMIT ?
+            '''.format(bql_quote_name(table)), (N,))]
+            blocks = _row_blocks(rowids, chunksize, symmetric)
+            last_rowid = rowids[-1] if rowids else None
+
+            if use_clusters:
+                generator_id = core.bayesdb_get_generator(bdb, model)
+                metamodel = core.bayesdb_generator_metamodel(bdb, generator_id)
+                if metamodel.name() != 'crosscat':
+                    raise BLE(ValueError(
+                        "use_clusters needs a crosscat generator, not {}"
+                        .format(metamodel.name())))
+
+            if output == 'table':
+                writer = _SimilarityTableWriter(
+                    bdb, sim_table, symmetric, overwrite=overwrite)
+                writer.start(model, blocks, last_rowid)
+            elif output == 'dense':
+                writer = _DenseSimilarityWriter(
+                    path, rowids, symmetric, overwrite)
+            else:
+                writer = _SparseSimilarityWriter(
+                    path, rowids, symmetric, overwrite, threshold, top_k)
+
+        # Construct the estimate query template.
+        q_template = '''
+            ESTIMATE SIMILARITY FROM PAIRWISE {}
+                WHERE rowid0 >= ? AND rowid0 <= ? AND rowid1 <= ? {}
+        ''' .format(bql_quote_name(model),
+                    'AND rowid0 <= rowid1' if symmetric else '')
+
+        if use_clusters:
+            # Each worker indexes the models once for all of its blocks of this
+            # job, and tells the job apart from earlier ones on the same pool,
+            # whose models may since have changed, by a fresh id.
+            job = uuid.uuid4().hex
+            func = _neighbor_arrays
+            args_list = [(model, job, (first, last, last_rowid), top_k)
+                         for first, last in blocks]
+        else:
+            func = _similarity_arrays
+            args_list = [(q_template, (first, last, last_rowid))
+                         for first, last in blocks]
+
+        if pool is None:
+            pool = own_pool = ParallelBdb(bdb_file, cores=cores)
+        # The pool hands out blocks one at a time as workers become free, so
+        # there are several blocks per core: a core whose blocks happen to be
+        # cheap picks up more of them instead of idling.  Each chunk is
+        # written as it arrives rather than after every worker has
+        # finished, so at most a few chunks are in memory at once.
+        pool._stream(
+            func, args_list,
+            lambda key, chunk: writer.write(blocks[key], chunk),
+            retries=retries)
+        writer.close()
+        done = True
+    finally:
+        # Close the parent's handle before the pool, so that shutting the
+        # pool down can switch the journal mode back.
+        bdb.close()
+        if own_pool is not None:
+            if done:
+                own_pool.close()
+            else:
+                own_pool.terminate()
+
+
+class _SimilarityTableWriter(object):
+    """
+    Write chunks of similarities into the table sim_table, or with
+    symmetric=True into sim_table + '_triangle' under a view named sim_table
+    which also shows their mirror image.
+
+    The job's blocks of rows are recorded in the bdb, and each is marked
+    done in the same transaction as its similarities are inserted, so that
+    an interrupted job can be resumed with only the blocks not done.
+    """
+
+    def __init__(self, bdb, sim_table, symmetric, overwrite=False,
+                 resume=False):
+        self.bdb = bdb
+        self.sim_table = sim_table
+        self.symmetric = symmetric
+        if symmetric:
+            self.storage_table = sim_table + '_triangle'
+        else:
+            self.storage_table = sim_table
+        if resume:
+            return
 
-    # Define the helper which inserts data into table in batches
-    def insert_into_sim(df):
+        # Create the similarity table. Assumes original table has rowid
+        # column.
+        # XXX: tables don't necessarily have an autoincrementing primary key
+        # other than rowid, which is implicit and can't be set as a foreign
+        # key. We ought to ask for an optional user-specified foreign key,
+        # but ESTIMATE SIMILARITY returns numerical values rather than row
+        # names, so changing numerical rownames into that foreign key would
+        # be finicky. For now, we eliminate REFERENCE {table}(foreign_key)
+        # from the rowid0 and rowid1 specs.
+        if overwrite:
+            _drop_sim_table(bdb, sim_table)
+
+        # Create the table and the view together, so that an existing
+        # sim_table leaves neither behind.
+        storage_table_q = bql_quote_name(self.storage_table)
+        with bdb.savepoint():
+            bdb.sql_execute('''
+                CREATE TABLE {} (
+                    rowid0 INTEGER NOT NULL,
+                    rowid1 INTEGER NOT NULL,
+                    value DOUBLE NOT NULL
+                )
+            '''.format(storage_table_q))
+            if symmetric:
+                bdb.sql_execute('''
+                    CREATE VIEW {} AS
+                        SELECT rowid0, rowid1, value FROM {}
+                        UNION ALL
+                        SELECT rowid1 AS rowid0, rowid0 AS rowid1, value
+                            FROM {} WHERE rowid0 != rowid1
+                '''.format(bql_quote_name(sim_table), storage_table_q,
+                           storage_table_q))
+
+    def start(self, model, blocks, last_rowid):
+        """Record a new job estimating the blocks of rows from model."""
+        with self.bdb.transaction():
+            for sql in _SIMILARITY_JOB_SCHEMA:
+                self.bdb.sql_execute(sql)
+            _delete_similarity_job(self.bdb, self.sim_table)
+            self.bdb.sql_execute('''
+                INSERT INTO bdbcontrib_similarity_job
+                    (sim_table, model, symmetric, last_rowid)
+                    VALUES (?, ?, ?, ?)
+            ''', (self.sim_table, model, self.symmetric, last_rowid))
+            _executemany(self.bdb, '''
+                INSERT INTO bdbcontrib_similarity_chunk
+                    (sim_table, first_rowid, last_rowid)
+                    VALUES (?, ?, ?)
+            ''', [(self.sim_table, first, last) for first, last in blocks])
+
+    def resume(self, model):
+        """
+        Return the blocks of rows of the job recorded for sim_table which
+        are not done yet, and the last rowid of the job.
         """
-        Use the main thread bdb handle to successively insert results of
-        ESTIMATEs into the table.
+        job = None
+        if core.bayesdb_has_table(self.bdb, 'bdbcontrib_similarity_job'):
+            job = self.bdb.sql_execute('''
+                SELECT model, symmetric, last_rowid
+                    FROM bdbcontrib_similarity_job WHERE sim_table = ?
+            ''', (self.sim_table,)).fetchall()
+        if not job:
+            raise BLE(ValueError(
+                "No unfinished similarity job for {}".format(self.sim_table)))
+        job_model, job_symmetric, last_rowid = job[0]
+        if job_model != model or bool(job_symmetric) != self.symmetric:
+            raise BLE(ValueError(
+                "Similarity job for {} was for model {} with symmetric={}"
+                .format(self.sim_table, job_model, bool(job_symmetric))))
+        blocks = self.bdb.sql_execute('''
+            SELECT first_rowid, last_rowid FROM bdbcontrib_similarity_chunk
+                WHERE sim_table = ? AND NOT done
+                ORDER BY first_rowid
+        ''', (self.sim_table,)).fetchall()
+        return blocks, last_rowid
+
+    def write(self, block, chunk):
+        """
+        Use the main thread bdb handle to insert a chunk of results of
+        ESTIMATEs, as arrays from _similarity_arrays, into the table, and
+        mark its block done.
         """
-        rows = map(list, df.values)
+        pairs, values = chunk
         insert_sql = '''
             INSERT INTO {} (rowid0, rowid1, value) VALUES (?, ?, ?)
-        '''.format(sim_table_q)
-        # Avoid sqlite3 500-insert limit by grouping insert statements
-        # into one transaction.
-        with bdb.transaction():
-            for row in rows:
-                bdb.sql_execute(insert_sql, row)
-
-    pool = mp.Pool(processes=cores)
-
-    manager = mp.Manager()
-    queue = manager.Queue()
-
-    # Construct the estimate query template.
-    q_template = '''
-        ESTIMATE SIMILARITY FROM PAIRWISE {} LIMIT ? OFFSET ?
-    ''' .format(bql_quote_name(model))
-
-    for so in zip(sizes, offsets):
-        pool.apply_async(
-            _query_into_queue, args=(q_template, so, queue, bdb_file)
-        )
+        '''.format(bql_quote_name(self.storage_table))
+        # Insert the whole chunk in one executemany in one transaction,
+        # binding each row from the arrays as it is stepped.
+        with self.bdb.transaction():
+            _executemany(self.bdb, insert_sql,
+                         itertools.izip(pairs[:, 0], pairs[:, 1], values))
+            self.bdb.sql_execute('''
+                UPDATE bdbcontrib_similarity_chunk SET done = 1
+                    WHERE sim_table = ? AND first_rowid = ?
+            ''', (self.sim_table, block[0]))
+
+    def close(self):
+        with self.bdb.transaction():
+            # Index the pairs once they are all in, which is cheaper than
+            # keeping an index up to date through every insert.
+            self.bdb.sql_execute(
+                'CREATE INDEX {} ON {} (rowid0, rowid1)'.format(
+                    bql_quote_name(self.storage_table + '_rowids'),
+                    bql_quote_name(self.storage_table)))
+            _delete_similarity_job(self.bdb, self.sim_table)
+
+
+# Unfinished estimate_pairwise_similarity jobs writing into tables, and
+# their blocks of rows, so that they can be resumed.
+_SIMILARITY_JOB_SCHEMA = ('''
+    CREATE TABLE IF NOT EXISTS bdbcontrib_similarity_job (
+        sim_table TEXT NOT NULL PRIMARY KEY,
+        model TEXT NOT NULL,
+        symmetric BOOLEAN NOT NULL,
+        last_rowid INTEGER
+    )
+''', '''
+    CREATE TABLE IF NOT EXISTS bdbcontrib_similarity_chunk (
+        sim_table TEXT NOT NULL
+            REFERENCES bdbcontrib_similarity_job(sim_table),
+        first_rowid INTEGER NOT NULL,
+        last_rowid INTEGER NOT NULL,
+        done BOOLEAN NOT NULL DEFAULT 0,
+        PRIMARY KEY (sim_table, first_rowid)
+    )
+''')
+
+
+def _delete_similarity_job(bdb, sim_table):
+    """Forget any job recorded for sim_table."""
+    if core.bayesdb_has_table(bdb, 'bdbcontrib_similarity_job'):
+        bdb.sql_execute('''
+            DELETE FROM bdbcontrib_similarity_chunk WHERE sim_table = ?
+        ''', (sim_table,))
+        bdb.sql_execute('''
+            DELETE FROM bdbcontrib_similarity_job WHERE sim_table = ?
+        ''', (sim_table,))
+
+
+# Files of a similarity matrix saved by estimate_pairwise_similarity with
+# output='dense' or output='sparse'.
+_ROWIDS_FILE = 'rowids.npy'
+_DENSE_FILE = 'similarity.npy'
+_SPARSE_FILES = ('indptr.npy', 'indices.npy', 'data.npy')
 
-    # Close pool and wait for processes to finish
-    # FIXME: This waits for all processes to finish before inserting
-    # into the table, which means that memory usage is potentially very
-    # high!
-    pool.close()
-    pool.join()
-
-    # Process returned results
-    while not queue.empty():
-        df = queue.get()
-        insert_into_sim(df)
+
+def _prepare_similarity_dir(path, overwrite):
+    """
+    Make sure the directory path exists and holds no similarity matrix,
+    removing any there if overwrite is true.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+        return
+    existing = [name for name in (_ROWIDS_FILE, _DENSE_FILE) + _SPARSE_FILES
+                if os.path.exists(os.path.join(path, name))]
+    if existing and not overwrite:
+        raise BLE(ValueError(
+            "Similarity matrix already exists in {}".format(path)))
+    for name in existing:
+        os.remove(os.path.join(path, name))
+
+
+class _DenseSimilarityWriter(object):
+    """
+    Write chunks of similarities into an N x N float32 NumPy file in the
+    directory path, memory-mapped so that only the pages written to need be
+    in memory.  With symmetric=True each pair is written to both halves.
+    """
+
+    def __init__(self, path, rowids, symmetric, overwrite):
+        _prepare_similarity_dir(path, overwrite)
+        self.rowids = np.asarray(rowids, dtype=np.int64)
+        self.symmetric = symmetric
+        n = len(self.rowids)
+        self.matrix = open_memmap(
+            os.path.join(path, _DENSE_FILE), mode='w+', dtype=np.float32,
+            shape=(n, n))
+        np.save(os.path.join(path, _ROWIDS_FILE), self.rowids)
+
+    def write(self, block, chunk):
+        pairs, values = chunk
+        i = np.searchsorted(self.rowids, pairs[:, 0])
+        j = np.searchsorted(self.rowids, pairs[:, 1])
+        self.matrix[i, j] = values
+        if self.symmetric:
+            self.matrix[j, i] = values
+
+    def close(self):
+        self.matrix.flush()
+        del self.matrix
+
+
+class _SparseSimilarityWriter(object):
+    """
+    Keep the similarities of at least threshold, and of those the top_k of
+    each row, and write them as a CSR matrix of float32 in the directory
+    path.  With symmetric=True each pair counts in both of its rows.
+
+    With top_k, each row keeps a bounded set of its best entries as chunks
+    arrive, so memory is N x top_k however many pairs there are; otherwise
+    it is the number of similarities kept.
+    """
+
+    def __init__(self, path, rowids, symmetric, overwrite, threshold, top_k):
+        _prepare_similarity_dir(path, overwrite)
+        self.path = path
+        self.rowids = np.asarray(rowids, dtype=np.int64)
+        self.symmetric = symmetric
+        self.threshold = threshold
+        self.top_k = top_k
+        n = len(self.rowids)
+        if top_k is None:
+            self.entries = []
+        else:
+            # The best top_k similarities of each row so far, and their
+            # columns, -1 where a row has fewer.
+            self.best_values = np.full((n, top_k), -np.inf)
+            self.best_columns = np.full((n, top_k), -1, dtype=np.int64)
+
+    def write(self, block, chunk):
+        pairs, values = chunk
+        i = np.searchsorted(self.rowids, pairs[:, 0])
+        j = np.searchsorted(self.rowids, pairs[:, 1])
+        if self.symmetric:
+            mirror = i != j
+            i, j = (np.concatenate((i, j[mirror])),
+                    np.concatenate((j, i[mirror])))
+            values = np.concatenate((values, values[mirror]))
+        if self.threshold is not None:
+            keep = values >= self.threshold
+            i, j, values = i[keep], j[keep], values[keep]
+        if self.top_k is None:
+            self.entries.append((i, j, values.astype(np.float32)))
+        else:
+            self._merge_best(i, j, values)
+
+    def _merge_best(self, i, j, values):
+        """Merge the entries (i, j, values) into each row's best top_k."""
+        # Most entries cannot beat the worst of their row's best so far.
+        keep = values > self.best_values.min(axis=1)[i]
+        i, j, values = i[keep], j[keep], values[keep]
+        if len(i) == 0:
+            return
+        k = self.top_k
+        rows = np.unique(i)
+        i = np.concatenate((np.repeat(rows, k), i))
+        j = np.concatenate((self.best_columns[rows].ravel(), j))
+        values = np.concatenate((self.best_values[rows].ravel(), values))
+        # Sort by row, best first within each row, and take each row's
+        # first k, of which there are at least k.
+        order = np.lexsort((-values, i))
+        i, j, values = i[order], j[order], values[order]
+        rank = np.arange(len(i)) - np.searchsorted(i, i)
+        best = rank < k
+        self.best_columns[i[best], rank[best]] = j[best]
+        self.best_values[i[best], rank[best]] = values[best]
+
+    def close(self):
+        n = len(self.rowids)
+        if self.top_k is None:
+            if self.entries:
+                i, j, values = [np.concatenate(parts)
+                                for parts in zip(*self.entries)]
+            else:
+                i = j = np.zeros(0, dtype=np.int64)
+                values = np.zeros(0, dtype=np.float32)
+        else:
+            found = self.best_columns >= 0
+            i = np.nonzero(found)[0]
+            j = self.best_columns[found]
+            values = self.best_values[found]
+        order = np.lexsort((j, i))
+        indptr = np.concatenate(
+            ([0], np.cumsum(np.bincount(i, minlength=n)))).astype(np.int64)
+        arrays = (indptr, j[order].astype(np.int32),
+                  values[order].astype(np.float32))
+        for name, array in zip(_SPARSE_FILES, arrays):
+            np.save(os.path.join(self.path, name), array)
+        np.save(os.path.join(self.path, _ROWIDS_FILE), self.rowids)
+
+
+class SimilarityMatrix(object):
+    """
+    Pairwise similarities saved by estimate_pairwise_similarity with
+    output='dense' or output='sparse', read from disk as needed.
+
+    The files are memory-mapped, so looking up a row reads only that row
+    rather than the whole matrix::
+
+        parallel.estimate_pairwise_similarity(
+            bdb_file, 't', 't_cc', output='sparse', path='t_sim', top_k=20)
+        sim = parallel.SimilarityMatrix('t_sim')
+        sim.neighbors(42, k=5)
+
+    Parameters
+    ----------
+    path : str
+        Directory the similarity matrix was saved in.
+
+    Attributes
+    ----------
+    rowids : numpy.ndarray
+        Rowids of the rows of the matrix, in order.
+    sparse : bool
+        Whether the matrix was saved with output='sparse', holding only some
+        similarities of each row.
+    """
+
+    def __init__(self, path):
+        if os.path.exists(os.path.join(path, _DENSE_FILE)):
+            self.sparse = False
+            self._matrix = np.load(
+                os.path.join(path, _DENSE_FILE), mmap_mode='r')
+        elif os.path.exists(os.path.join(path, _SPARSE_FILES[0])):
+            self.sparse = True
+            self._indptr, self._indices, self._data = [
+                np.load(os.path.join(path, name), mmap_mode='r')
+                for name in _SPARSE_FILES]
+        else:
+            raise BLE(ValueError(
+                "No similarity matrix in {}".format(path)))
+        self.rowids = np.load(os.path.join(path, _ROWIDS_FILE))
+
+    def __len__(self):
+        return len(self.rowids)
+
+    def row(self, rowid):
+        """
+        Return the similarities of the row with the given rowid to other
+        rows, as an array of their rowids and an array of the similarities.
+        For a sparse matrix, only the similarities kept are returned.
+        """
+        i = np.searchsorted(self.rowids, rowid)
+        if i == len(self.rowids) or self.rowids[i] != rowid:
+            raise BLE(ValueError(
+                "No row with rowid {} in similarity matrix".format(rowid)))
+        if not self.sparse:
+            return self.rowids, np.array(self._matrix[i])
+        start, end = self._indptr[i], self._indptr[i + 1]
+        return (self.rowids[self._indices[start:end]],
+                np.array(self._data[start:end]))
+
+    def neighbors(self, rowid, k=None):
+        """
+        Return the k rows most similar to the row with the given rowid, or
+        all with k=None, most similar first.  The row itself is included.
+
+        Returns
+        -------
+        df : pandas.DataFrame
+            Columns rowid1 and value, the similarity of rowid to rowid1.
+        """
+        rowids, values = self.row(rowid)
+        if k is not None and k < len(values):
+            top = np.argpartition(-values, k)[:k]
+            rowids, values = rowids[top], values[top]
+        order = np.argsort(-values, kind='mergesort')
+        return pd.DataFrame({'rowid1': rowids[order], 'value': values[order]},
+                            columns=['rowid1', 'value'])
+
+
+# Row-wise BQL queries which execute can split across workers by rows of the
+# generator's table.
+_SHARDABLE_PHRASES = (ast.Estimate, ast.InferAuto, ast.InferExplicit)
+
+# SQLite's aggregate functions, which combine the rows of a query.  min and
+# max are aggregates only when given a single argument.
+_AGGREGATES = ('avg', 'count', 'group_concat', 'max', 'min', 'sum', 'total')
+
+
+def _has_aggregate(node):
+    """
+    True if the BQL AST node calls an aggregate function, or any function
+    on DISTINCT arguments, outside of subqueries.
+    """
+    if isinstance(node, ast.ExpAppStar):
+        return True
+    if isinstance(node, ast.ExpApp):
+        operator = node.operator.lower()
+        if node.distinct or (operator in _AGGREGATES and not (
+                operator in ('max', 'min') and len(node.operands) > 1)):
+            return True
+    if isinstance(node, (ast.SelColSub, ast.ExpSub, ast.ExpExists)):
+        return False
+    if isinstance(node, ast.ExpIn):
+        return _has_aggregate(node.expression)
+    if isinstance(node, (tuple, list)):
+        return any(_has_aggregate(child) for child in node)
+    return False
+
+
+def _literal(value):
+    """Return a BQL AST literal for a value of the partitioning column."""
+    if isinstance(value, (int, long)):
+        return ast.ExpLit(ast.LitInt(value))
+    elif isinstance(value, float):
+        return ast.ExpLit(ast.LitFloat(value))
+    elif isinstance(value, basestring):
+        return ast.ExpLit(ast.LitString(value))
+    else:
+        raise BLE(ValueError(
+            "Cannot partition by value {!r}".format(value)))
+
+
+def _shard_ranges(values, chunksize):
+    """
+    Split the sorted `values` of the partitioning column into consecutive
+    ranges of about `chunksize` rows each, and return their (lo, hi)
+    bounds, hi being None for the last, open-ended range.
+
+    Bounds are taken from the values themselves, so rows sharing a value are
+    never split across ranges.
+    """
+    bounds = []
+    for i in xrange(0, len(values), chunksize):
+        if not bounds or values[i] != bounds[-1]:
+            bounds.append(values[i])
+    return zip(bounds, bounds[1:] + [None])
+
+
+def _shard_condition(condition, column, lo, hi):
+    """
+    Return `condition`, which may be None, restricted to the rows with lo
+    <= `column` < hi, or lo <= `column` if hi is None.
+    """
+    col = ast.ExpCol(None, column)
+    shard = ast.op(ast.OP_GEQ, col, _literal(lo))
+    if hi is not None:
+        shard = ast.op(ast.OP_BOOLAND, shard,
+                       ast.op(ast.OP_LT, col, _literal(hi)))
+    if condition is None:
+        return shard
+    return ast.op(ast.OP_BOOLAND, condition, shard)
+
+
+def execute(bdb_file, bql, bindings=None, partition_by='_rowid_',
+            chunksize=None, cores=None, into=None, overwrite=False,
+            pool=None):
+    """
+    Execute a row-wise BQL query, splitting its rows across multiple
+    processors, and return the results as a DataFrame or save them into a
+    table.
+
+    The query must be an ESTIMATE, INFER or INFER EXPLICIT query which
+    yields one result per row of the generator's table, such as::
+
+        ESTIMATE _rowid_, PREDICTIVE PROBABILITY OF x FROM t_cc
+        ESTIMATE _rowid_, SIMILARITY TO (_rowid_ = 1) FROM t_cc
+        INFER EXPLICIT _rowid_, PREDICT x CONFIDENCE x_conf FROM t_cc
+
+    The rows of the table are split into consecutive ranges of partition_by
+    values, and each worker runs the query restricted to one range at a
+    time, by adding the range to the query's WHERE condition.  Queries which
+    combine results across rows, with GROUP BY, ORDER BY, LIMIT, DISTINCT or
+    aggregates such as AVG, cannot be split this way and are rejected.
+
+    Parameters
+    ----------
+    bdb_file : str
+        File location of the BayesDB database object. This function will
+        handle opening the file with bayeslite.bayesdb_open.
+    bql : str
+        The BQL query to execute.
+    bindings : tuple
+        Values to fill in for the parameters of bql.
+    partition_by : str
+        Name of the column of the generator's table whose ranges of values
+        split the rows. Rows where it is NULL are not estimated. Defaults to
+        _rowid_.
+    chunksize : int
+        Approximate number of rows in each range. Defaults to splitting the
+        rows into four ranges per core, but no more than 100000 per range.
+    cores : int
+        Number of processors to use. Defaults to the number of cores as
+        identified by multiprocessing.num_cores. Ignored if pool is given.
+    into : str
+        Name of a table to insert the results into as they arrive, instead
+        of returning them. The table is created with one column for each
+        result column, when the first results arrive, so no table is created
+        if the query returns no rows.
+    overwrite : bool
+        Whether to overwrite the into table if it already exists. Default
+        False.
+    pool : ParallelBdb
+        Workers on bdb_file to run the query on, which are left running for
+        later queries.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        The results in order of partition_by, or None if into is given.
+    """
+    if bindings is None:
+        bindings = ()
+
+    phrases = list(parse_bql_string(bql))
+    if len(phrases) != 1:
+        raise BLE(ValueError(
+            "Expected one BQL phrase but got {}".format(len(phrases))))
+    phrase = phrases[0]
+    query = phrase.phrase if isinstance(phrase, ast.Parametrized) else phrase
+    if not isinstance(query, _SHARDABLE_PHRASES):
+        raise BLE(ValueError(
+            "Only ESTIMATE and INFER queries can be split by rows: {}"
+            .format(bql)))
+    if query.grouping is not None or query.order is not None or \
+            query.limit is not None:
+        raise BLE(ValueError(
+            "Queries with GROUP BY, ORDER BY or LIMIT cannot be split by "
+            "rows: {}".format(bql)))
+    if getattr(query, 'quantifier', None) == ast.SELQUANT_DISTINCT or \
+            _has_aggregate(query.columns):
+        raise BLE(ValueError(
+            "Queries with DISTINCT or aggregates cannot be split by rows: {}"
+            .format(bql)))
+
+    if chunksize is not None and chunksize < 1:
+        raise BLE(ValueError(
+            "Invalid chunksize {}".format(chunksize)))
+
+    bdb = bayesdb_open(pathname=bdb_file)
+    own_pool = None
+    done = False
+    try:
+        if pool is not None:
+            cores = pool.cores
+        elif cores is None:
+            cores = mp.cpu_count()
+
+        if cores < 1:
+            raise BLE(ValueError(
+                "Invalid number of cores {}".format(cores)))
+
+        if not core.bayesdb_has_generator_default(bdb, query.generator):
+            raise BLE(ValueError(
+                "No such generator: {}".format(query.generator)))
+        generator_id = core.bayesdb_get_generator_default(bdb, query.generator)
+        table = core.bayesdb_generator_table(bdb, generator_id)
+
+        if into is not None:
+            if overwrite:
+                bdb.sql_execute('DROP TABLE IF EXISTS {}'.format(
+                    bql_quote_name(into)))
+            elif core.bayesdb_has_table(bdb, into):
+                raise BLE(ValueError(
+                    "Table {} already exists".format(into)))
+
+        partition_by_q = bql_quote_name(partition_by)
+        values = [row[0] for row in bdb.sql_execute('''
+            SELECT {} FROM {} WHERE {} IS NOT NULL ORDER BY {}
+        '''.format(partition_by_q, bql_quote_name(table), partition_by_q,
+                   partition_by_q))]
+        if chunksize is None:
+            chunksize = min(
+                max(1, -(-len(values) // (cores * _BLOCKS_PER_CORE))),
+                _MAX_CHUNKSIZE)
+        ranges = _shard_ranges(values, chunksize)
+        del values
+
+        shards = []
+        for index, (lo, hi) in enumerate(ranges):
+            shard = query._replace(condition=_shard_condition(
+                query.condition, partition_by, lo, hi))
+            if isinstance(phrase, ast.Parametrized):
+                shard = phrase._replace(phrase=shard)
+            shards.append((shard, bindings))
+
+        results = {}
+
+        def consume(index, df):
+            if into is None:
+                results[index] = df
+            elif not df.empty:
+                insert_into(df)
+
+        def insert_into(df):
+            """Insert a range's results into the into table, creating it first
+            if this is the first range to return any."""
+            into_q = bql_quote_name(into)
+            with bdb.transaction():
+                if not core.bayesdb_has_table(bdb, into):
+                    bdb.sql_execute('CREATE TABLE {} ({})'.format(
+                        into_q, ', '.join(map(bql_quote_name, df.columns))))
+                insert_sql = 'INSERT INTO {} VALUES ({})'.format(
+                    into_q, ', '.join('?' * len(df.columns)))
+                _executemany(bdb, insert_sql, df.itertuples(index=False))
+
+        if pool is None:
+            pool = own_pool = ParallelBdb(bdb_file, cores=cores)
+        pool._stream(_phrase_df, shards, consume)
+        done = True
+    finally:
+        # Close the parent's handle before the pool, so that shutting the
+        # pool down can switch the journal mode back.
+        bdb.close()
+        if own_pool is not None:
+            if done:
+                own_pool.close()
+            else:
+                own_pool.terminate()
+
+    if into is not None:
+        return None
+    frames = [results[index] for index in sorted(results)
+              if not results[index].empty]
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
+
+
+# BQL queries which can be evaluated USING MODEL, one model at a time.
+_MODEL_PHRASES = (ast.Estimate, ast.EstBy, ast.EstCols, ast.EstPairCols,
+                  ast.EstPairRow, ast.InferAuto, ast.InferExplicit,
+                  ast.Simulate)
+
+
+def _logmeanexp(arrays):
+    """Elementwise log of the mean of the exponentials of `arrays`."""
+    arrays = np.asarray(arrays, dtype=float)
+    top = np.max(arrays, axis=0)
+    # Where every term is -inf, or some term is +inf, so is the result.
+    finite = np.isfinite(top)
+    shifted = arrays - np.where(finite, top, 0)
+    with np.errstate(divide='ignore'):
+        return np.where(
+            finite, top + np.log(np.mean(np.exp(shifted), axis=0)), top)
+
+
+# Ways execute_by_model can combine the models' results, elementwise.
+_MODEL_REDUCTIONS = {
+    'mean': lambda arrays: np.mean(arrays, axis=0),
+    'logmeanexp': _logmeanexp,
+}
+
+
+def execute_by_model(bdb_file, bql, bindings=None, modelnos=None,
+                     reduce=None, cores=None, pool=None):
+    """
+    Execute a BQL query once per model, splitting the models across
+    multiple processors, and return the results for each model or their
+    mean or logmeanexp.
+
+    This speeds up queries whose cost grows with the number of models
+    rather than rows, such as the per-model mutual information of
+    bdbcontrib.plot_utils.mi_hist::
+
+        ESTIMATE MUTUAL INFORMATION OF x WITH y USING 100 SAMPLES
+            FROM t_cc LIMIT 1
+
+    Each task evaluates the query USING MODEL one model number.  Each worker
+    keeps the models it has loaded, so a worker given several models only
+    loads each once.  The models' results are matched up by column position
+    and named after the first model's columns, so give expressions names
+    with AS to keep them readable.
+
+    Parameters
+    ----------
+    bdb_file : str
+        File location of the BayesDB database object. This function will
+        handle opening the file with bayeslite.bayesdb_open.
+    bql : str
+        The BQL query to execute. It must not say USING MODEL itself.
+    bindings : tuple
+        Values to fill in for the parameters of bql.
+    modelnos : list of int
+        Model numbers to evaluate. Defaults to all models of the generator.
+    reduce : str
+        How to combine the models' results, if at all: 'mean' or
+        'logmeanexp' of each numeric value, e.g. 'logmeanexp' for log
+        densities. Every model must return the same rows, in the same
+        order; non-numeric columns must agree across models and are kept.
+        Default None, to return the results of every model.
+    cores : int
+        Number of processors to use. Defaults to the number of cores as
+        identified by multiprocessing.num_cores. Ignored if pool is given.
+    pool : ParallelBdb
+        Workers on bdb_file to run the query on, which are left running for
+        later queries.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        With reduce=None, the results of every model, in order of model
+        number, with the model number in a leading modelno column.
+        Otherwise, the reduced results.
+    """
+    if bindings is None:
+        bindings = ()
+    if reduce is not None and reduce not in _MODEL_REDUCTIONS:
+        raise BLE(ValueError(
+            "Unknown reduction {!r}, expected one of {}".format(
+                reduce, sorted(_MODEL_REDUCTIONS))))
+
+    phrases = list(parse_bql_string(bql))
+    if len(phrases) != 1:
+        raise BLE(ValueError(
+            "Expected one BQL phrase but got {}".format(len(phrases))))
+    phrase = phrases[0]
+    query = phrase.phrase if isinstance(phrase, ast.Parametrized) else phrase
+    if not isinstance(query, _MODEL_PHRASES):
+        raise BLE(ValueError(
+            "Only queries on a generator's models can be split by model: {}"
+            .format(bql)))
+    if query.modelno not in (None, ast.ExpLit(ast.LitNull(None))):
+        raise BLE(ValueError(
+            "Query already names a model: {}".format(bql)))
+
+    bdb = bayesdb_open(pathname=bdb_file)
+    own_pool = None
+    done = False
+    try:
+        if pool is not None:
+            cores = pool.cores
+        elif cores is None:
+            cores = mp.cpu_count()
+
+        if cores < 1:
+            raise BLE(ValueError(
+                "Invalid number of cores {}".format(cores)))
+
+        if not core.bayesdb_has_generator_default(bdb, query.generator):
+            raise BLE(ValueError(
+                "No such generator: {}".format(query.generator)))
+        generator_id = core.bayesdb_get_generator_default(bdb, query.generator)
+        if modelnos is None:
+            modelnos = [row[0] for row in bdb.sql_execute('''
+                SELECT modelno FROM bayesdb_generator_model
+                    WHERE generator_id = ? ORDER BY modelno
+            ''', (generator_id,))]
+        if not modelnos:
+            raise BLE(ValueError(
+                "No models of generator {}".format(query.generator)))
+
+        tasks = []
+        for modelno in modelnos:
+            shard = query._replace(modelno=_literal(modelno))
+            if isinstance(phrase, ast.Parametrized):
+                shard = phrase._replace(phrase=shard)
+            tasks.append((shard, bindings))
+
+        results = {}
+
+        def consume(index, df):
+            results[modelnos[index]] = df
+
+        if pool is None:
+            pool = own_pool = ParallelBdb(bdb_file, cores=cores)
+        pool._stream(_phrase_df, tasks, consume)
+        done = True
+    finally:
+        # Close the parent's handle before the pool, so that shutting the
+        # pool down can switch the journal mode back.
+        bdb.close()
+        if own_pool is not None:
+            if done:
+                own_pool.close()
+            else:
+                own_pool.terminate()
+
+    # Unnamed expressions are named after their SQL, which names the model,
+    # so match the columns up by position.
+    frames = [results[modelno] for modelno in modelnos]
+    for df in frames[1:]:
+        if df.shape[1] != frames[0].shape[1]:
+            raise BLE(ValueError(
+                "Models returned {} and {} columns".format(
+                    frames[0].shape[1], df.shape[1])))
+        df.columns = frames[0].columns
+    if reduce is None:
+        for modelno, df in zip(modelnos, frames):
+            df.insert(0, 'modelno', modelno)
+        return pd.concat(frames, ignore_index=True)
+    return _reduce_frames(frames, _MODEL_REDUCTIONS[reduce])
+
+
+def _reduce_frames(frames, reduction):
+    """
+    Combine DataFrames of the same shape elementwise, applying reduction to
+    the stacked values of each numeric column.
+    """
+    first = frames[0]
+    for df in frames[1:]:
+        if df.shape != first.shape:
+            raise BLE(ValueError(
+                "Cannot reduce results of different shapes: {} and {}"
+                .format(first.shape, df.shape)))
+    reduced = first.copy()
+    for col in first.columns:
+        if np.issubdtype(first[col].dtype, np.number):
+            reduced[col] = reduction([df[col].values for df in frames])
+        elif any((df[col].values != first[col].values).any()
+                 for df in frames[1:]):
+            raise BLE(ValueError(
+                "Cannot reduce non-numeric column {} which differs across "
+                "models".format(col)))
+    return reduced
@@ -34,9 +34,14 @@ class KeplersLaw(predictor.IBayesDBForeignPredictor):
     def create(cls, bdb, table, targets, conditions):
         cols = [c for c,_ in targets+conditions]
         df = bdbcontrib.bql_utils.table_to_df(bdb, table, cols)
+        kl = cls.create_from_df(df, targets, conditions)
+        kl.prng = bdb.np_prng
+        return kl
+
+    @classmethod
+    def create_from_df(cls, df, targets, conditions):
         kl = cls()
         kl.train(df, targets, conditions)
-        kl.prng = bdb.np_prng
         return kl
 
     @classmethod
@@ -122,6 +127,28 @@ class KeplersLaw(predictor.IBayesDBForeignPredictor):
         period_minutes = satellite_period_minutes(apogee_km, perigee_km)
         return logpdfGaussian(value, period_minutes, self.noise)
 
+    def _conditions_many(self, conditions_matrix):
+        if not set(self.conditions).issubset(set(conditions_matrix.columns)):
+            raise BLE(ValueError(
+                'Must specify values for all the conditionals.\n'
+                'Received: {}\n'
+                'Expected: {}'.format(list(conditions_matrix.columns),
+                self.conditions)))
+        X = conditions_matrix[self.conditions].as_matrix().astype(float)
+        return X[:,0], X[:,1]
+
+    def simulate_many(self, conditions_matrix):
+        apogee_km, perigee_km = self._conditions_many(conditions_matrix)
+        period_minutes = satellite_period_minutes(apogee_km, perigee_km)
+        return list(period_minutes + self.prng.normal(scale=self.noise,
+            size=len(period_minutes)))
+
+    def logpdf_many(self, values, conditions_matrix):
+        apogee_km, perigee_km = self._conditions_many(conditions_matrix)
+        period_minutes = satellite_period_minutes(apogee_km, perigee_km)
+        return logpdfGaussian(np.asarray(values, dtype=float),
+            period_minutes, self.noise)
+
 HALF_LOG2PI = 0.5 * math.log(2 * math.pi)
 def logpdfGaussian(x, mu, sigma):
     deviation = x - mu
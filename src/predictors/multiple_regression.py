@@ -38,9 +38,14 @@ class MultipleRegression(predictor.IBayesDBForeignPredictor):
     def create(cls, bdb, table, targets, conditions):
         cols = [c for c,_ in targets+conditions]
         df = bdbcontrib.bql_utils.table_to_df(bdb, table, cols)
+        mr = cls.create_from_df(df, targets, conditions)
+        mr.prng = bdb.np_prng
+        return mr
+
+    @classmethod
+    def create_from_df(cls, df, targets, conditions):
         mr = cls()
         mr.train(df, targets, conditions)
-        mr.prng = bdb.np_prng
         return mr
 
     @classmethod
@@ -53,7 +58,9 @@ class MultipleRegression(predictor.IBayesDBForeignPredictor):
             'mr_partial': pred.mr_partial,
             'mr_full_noise': pred.mr_full_noise,
             'mr_partial_noise': pred.mr_partial_noise,
-            'categories_to_val_map': pred.categories_to_val_map
+            'categories_to_val_map': pred.categories_to_val_map,
+            'numerical_mean': pred.numerical_mean,
+            'numerical_scale': pred.numerical_scale,
         }
         return pickle.dumps(state)
 
@@ -66,7 +73,10 @@ class MultipleRegression(predictor.IBayesDBForeignPredictor):
             mr_full=state['mr_full'], mr_partial=state['mr_partial'],
             mr_full_noise=state['mr_full_noise'],
             mr_partial_noise=state['mr_partial_noise'],
-            categories_to_val_map=state['categories_to_val_map'])
+            categories_to_val_map=state['categories_to_val_map'],
+            # Predictors serialized before standardization use raw features.
+            numerical_mean=state.get('numerical_mean', 0),
+            numerical_scale=state.get('numerical_scale', 1))
         mr.prng = bdb.np_prng
         return mr
 
@@ -77,7 +87,8 @@ class MultipleRegression(predictor.IBayesDBForeignPredictor):
     def __init__(self, targets=None, conditions_numerical=None,
             conditions_categorical=None, mr_full=None, mr_partial=None,
             mr_full_noise=None, mr_partial_noise=None,
-            categories_to_val_map=None):
+            categories_to_val_map=None, numerical_mean=None,
+            numerical_scale=None):
         self.targets = targets
         self.conditions_numerical = conditions_numerical
         self.conditions_categorical = conditions_categorical
@@ -90,6 +101,8 @@ class MultipleRegression(predictor.IBayesDBForeignPredictor):
         self.mr_full_noise = mr_full_noise
         self.mr_partial_noise = mr_partial_noise
         self.categories_to_val_map = categories_to_val_map
+        self.numerical_mean = numerical_mean
+        self.numerical_scale = numerical_scale
 
     def train(self, df, targets, conditions):
         # Obtain the targets column.
@@ -136,7 +149,7 @@ class MultipleRegression(predictor.IBayesDBForeignPredictor):
             self.conditions_categorical, self.dataset)
         self.X_categorical = utils.extract_sklearn_features_categorical(
             self.conditions_categorical, self.categories_to_val_map,
-            self.dataset)
+            self.dataset, sparse=True)
         self.X_numerical = utils.extract_sklearn_features_numerical(
             self.conditions_numerical, self.dataset)
         self.Y = utils.extract_sklearn_univariate_target(self.targets,
@@ -154,18 +167,33 @@ class MultipleRegression(predictor.IBayesDBForeignPredictor):
         This safe-guard feature is critical for querying; otherwise sklearn
         would crash whenever a categorical value unseen in training due to
         filtering (but existant in df nevertheless) was passed in.
+
+        The features of `full` are kept sparse, so that high-cardinality
+        categoricals cost memory in proportion to the number of rows only.
+        sklearn does not center sparse features before solving the least
+        squares, so the numerical features are standardized instead.
         """
         self.mr_partial.fit(self.X_numerical, self.Y)
-        self.mr_full.fit(np.hstack((self.X_numerical, self.X_categorical)),
-            self.Y)
+        self.numerical_mean = np.mean(self.X_numerical, axis=0)
+        self.numerical_scale = np.std(self.X_numerical, axis=0)
+        self.numerical_scale[self.numerical_scale == 0] = 1
+        X_full = self._full_features(self.X_numerical, self.X_categorical)
+        self.mr_full.fit(X_full, self.Y)
 
         self.mr_partial_noise = \
             np.linalg.norm(self.Y-self.mr_partial.predict(
                 self.X_numerical))/len(self.Y)
 
         self.mr_full_noise = \
-            np.linalg.norm(self.Y-self.mr_full.predict(
-                np.hstack((self.X_numerical, self.X_categorical))))/len(self.Y)
+            np.linalg.norm(self.Y-self.mr_full.predict(X_full))/len(self.Y)
+
+    def _full_features(self, X_numerical, X_categorical):
+        """Returns the sparse features of `mr_full` for the numerical and
+        binary categorical features of the same rows.
+        """
+        return utils.stack_sklearn_features(
+            (np.asarray(X_numerical, dtype=float) - self.numerical_mean)
+                / self.numerical_scale, X_categorical)
 
     def _compute_targets_distribution(self, conditions):
         """Given conditions dict {feature_col:val}, returns the conditional
@@ -195,15 +223,50 @@ class MultipleRegression(predictor.IBayesDBForeignPredictor):
                 self.conditions_categorical]
             X_categorical = utils.binarize_categorical_row(
                 self.conditions_categorical, self.categories_to_val_map,
-                X_categorical)
-            inputs = np.concatenate(([X_numerical], [X_categorical]), axis=1)
+                X_categorical, sparse=True)
+            inputs = self._full_features(X_numerical, X_categorical)
             assert inputs.shape == \
-                (1, len(self.conditions_numerical) + len(X_categorical))
+                (1, len(self.conditions_numerical) + X_categorical.shape[1])
             predictions = self.mr_full.predict(inputs)
             noise = self.mr_full_noise
 
         return predictions[0], noise
 
+    def _compute_targets_distributions(self, conditions_matrix):
+        """Given a DataFrame of conditions with one row per query, returns
+        the conditional means of the `targets` and the scales of the
+        Gaussian noise, as arrays with one entry per query.
+
+        Rows whose categorical conditions were all seen in training go
+        through `mr_full` in a single call, and the rest through
+        `mr_partial`.
+        """
+        missing = set(self.conditions) - set(conditions_matrix.columns)
+        if missing:
+            raise BLE(ValueError(
+                'Must specify values for all the conditionals.\n'
+                'Received: {}\n'
+                'Expected: {}'.format(list(conditions_matrix.columns),
+                self.conditions_numerical + self.conditions_categorical)))
+        n_rows = len(conditions_matrix)
+        seen = np.ones(n_rows, dtype=bool)
+        for cat in self.conditions_categorical:
+            seen &= np.array([value in self.categories_to_val_map[cat]
+                for value in conditions_matrix[cat]], dtype=bool)
+        X_numerical = conditions_matrix[self.conditions_numerical]\
+            .as_matrix().astype(float)
+        predictions = np.zeros(n_rows)
+        noise = np.where(seen, self.mr_full_noise, self.mr_partial_noise)
+        if np.any(~seen):
+            predictions[~seen] = self.mr_partial.predict(X_numerical[~seen])
+        if np.any(seen):
+            X_categorical = utils.extract_sklearn_features_categorical(
+                self.conditions_categorical, self.categories_to_val_map,
+                conditions_matrix[seen], sparse=True)
+            predictions[seen] = self.mr_full.predict(
+                self._full_features(X_numerical[seen], X_categorical))
+        return predictions, noise
+
     def simulate(self, n_samples, conditions):
         prediction, noise = self._compute_targets_distribution(conditions)
         return list(prediction + self.prng.normal(scale=noise, size=n_samples))
@@ -212,8 +275,20 @@ class MultipleRegression(predictor.IBayesDBForeignPredictor):
         prediction, noise = self._compute_targets_distribution(conditions)
         return logpdfGaussian(value, prediction, noise)
 
+    def simulate_many(self, conditions_matrix):
+        predictions, noise = self._compute_targets_distributions(
+            conditions_matrix)
+        return list(predictions + noise * self.prng.normal(
+            size=len(predictions)))
+
+    def logpdf_many(self, values, conditions_matrix):
+        predictions, noise = self._compute_targets_distributions(
+            conditions_matrix)
+        return logpdfGaussian(np.asarray(values, dtype=float), predictions,
+            noise)
+
 HALF_LOG2PI = 0.5 * math.log(2 * math.pi)
 def logpdfGaussian(x, mu, sigma):
     deviation = x - mu
-    return - math.log(sigma) - HALF_LOG2PI \
+    return - np.log(sigma) - HALF_LOG2PI \
         - (0.5 * deviation * deviation / (sigma * sigma))
@@ -14,6 +14,8 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import numpy as np
+
 class IBayesDBForeignPredictorFactory(object):
     """PRELIMINARY BayesDB foreign predictor factory interface.
 
@@ -25,6 +27,15 @@ class IBayesDBForeignPredictorFactory(object):
     foreign predictor be a singleton factory by defining these methods
     as `@classmethod`, instead of creating a separate class.  See, for
     example, :class:`bdbcontrib.predictors.keplers_law.KeplersLaw`.
+
+    A factory may also define `create_from_df(df, targets, conditions)`,
+    which trains a predictor like :meth:`create` but from a
+    pandas.DataFrame already holding the columns, and without access to
+    the BayesDB.  The :class:`.Composer` metamodel then reads the table
+    once for all its foreign columns and trains them in parallel
+    processes, so the factory and the trained predictor must be
+    picklable.  The BayesDB is available again when the predictor is
+    serialized.
     """
 
     def name(self):
@@ -40,11 +51,10 @@ class IBayesDBForeignPredictorFactory(object):
         The `targets` and `conditions` ultimately come from the schema
         the client indicates.
 
-        TODO `create` is currently assumed to be deterministic.  To
-        support FPs whose training is stochastic, the :class:`.Composer`
-        metamodel will need to be extended with options for
-        maintaining ensembles of independently trained instances of
-        such FPs.
+        The :class:`.Composer` metamodel shares one instance, trained
+        on the full table, across all its models, unless it is asked
+        to train an ensemble of instances on bootstrap resamples of the
+        table, one per model, through `create_from_df`.
 
         Parameters
         ----------
@@ -117,6 +127,12 @@ class IBayesDBForeignPredictor(object):
 
     Simulate and logpdf both require a full realization of all `conditions`.
 
+    A foreign predictor may also override :meth:`simulate_many` and
+    :meth:`logpdf_many`, which answer one query per row of a matrix of
+    conditions.  The defaults call :meth:`simulate` and :meth:`logpdf`
+    once per row; predictors backed by a vectorized model should
+    override them to evaluate the whole matrix at once.
+
     TODO We do not yet support referring to row-specific training
     results or querying predictive distributions for observed rows.
 
@@ -174,3 +190,44 @@ class IBayesDBForeignPredictor(object):
             given the conditions.
         """
         raise NotImplementedError
+
+    def simulate_many(self, conditions_matrix):
+        """Simulate one value of `target` for each row of `conditions_matrix`.
+
+        Parameters
+        ----------
+        conditions_matrix : pandas.DataFrame
+            One row per query, with a column of values for each of the
+            `conditions` required by the FP.  The FP may signal an error
+            if any `conditions` are missing, and should ignore any
+            additional columns.
+
+        Returns
+        -------
+        list
+            A list of the simulated values, one per row of
+            `conditions_matrix`.
+        """
+        return [self.simulate(1, row)[0]
+            for row in conditions_matrix.to_dict('records')]
+
+    def logpdf_many(self, values, conditions_matrix):
+        """Evaluate the log-density of {`target`=`value`}|{`conditions`} for
+        each of `values` and the matching row of `conditions_matrix`.
+
+        Parameters
+        ----------
+        values : sequence
+            The values of `target` to query, one per row of
+            `conditions_matrix`.
+
+        conditions_matrix : pandas.DataFrame
+            One row per query, as in :meth:`simulate_many`.
+
+        Returns
+        -------
+        numpy.ndarray
+            The log probability densities, one per row.
+        """
+        return np.array([self.logpdf(value, row) for value, row
+            in zip(values, conditions_matrix.to_dict('records'))])
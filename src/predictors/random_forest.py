@@ -14,6 +14,7 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import collections
 import pickle
 
 import numpy as np
@@ -30,15 +31,27 @@ class RandomForest(predictor.IBayesDBForeignPredictor):
 
     The `targets` must be a single categorical stattype.  The `conditions`
     may be arbitrary numerical or categorical columns.
+
+    Predictions do not go through sklearn: the trained forests are
+    compiled into a `CompiledForest` on first use (or on deserialization),
+    and the distributions of the last `cache_size` distinct conditions are
+    kept for repeated queries.
     """
 
+    cache_size = 128
+
     @classmethod
     def create(cls, bdb, table, targets, conditions):
         cols = [c for c,_ in targets+conditions]
         df = bdbcontrib.bql_utils.table_to_df(bdb, table, cols)
+        rf = cls.create_from_df(df, targets, conditions)
+        rf.prng = bdb.np_prng
+        return rf
+
+    @classmethod
+    def create_from_df(cls, df, targets, conditions):
         rf = cls()
         rf.train(df, targets, conditions)
-        rf.prng = bdb.np_prng
         return rf
 
     @classmethod
@@ -62,6 +75,7 @@ class RandomForest(predictor.IBayesDBForeignPredictor):
             rf_full=state['rf_full'], rf_partial=state['rf_partial'],
             categories_to_val_map=state['categories_to_val_map'])
         rf.prng = bdb.np_prng
+        rf._compiled_forests()
         return rf
 
     @classmethod
@@ -81,6 +95,8 @@ class RandomForest(predictor.IBayesDBForeignPredictor):
         self.rf_full = rf_full
         self.rf_partial = rf_partial
         self.categories_to_val_map = categories_to_val_map
+        self.compiled = None
+        self.distributions = collections.OrderedDict()
 
     def train(self, df, targets, conditions):
         # Obtain the targets column.
@@ -122,7 +138,7 @@ class RandomForest(predictor.IBayesDBForeignPredictor):
             self.conditions_categorical, self.dataset)
         self.X_categorical = utils.extract_sklearn_features_categorical(
             self.conditions_categorical, self.categories_to_val_map,
-            self.dataset)
+            self.dataset, sparse=True)
         self.X_numerical = utils.extract_sklearn_features_numerical(
             self.conditions_numerical, self.dataset)
         self.Y = utils.extract_sklearn_univariate_target(self.targets,
@@ -140,43 +156,107 @@ class RandomForest(predictor.IBayesDBForeignPredictor):
         This safe-guard feature is critical for querying; otherwise sklearn
         would crash whenever a categorical value unseen in training due to
         filtering (but existant in df nevertheless) was passed in.
+
+        The features of `full` are kept sparse, so that high-cardinality
+        categoricals cost memory in proportion to the number of rows only.
         """
         # pylint: disable=no-member
-        self.rf_partial.fit_transform(self.X_numerical, self.Y)
-        self.rf_full.fit_transform(
-            np.hstack((self.X_numerical, self.X_categorical)), self.Y)
+        self.rf_partial.fit(self.X_numerical, self.Y)
+        self.rf_full.fit(utils.stack_sklearn_features(self.X_numerical,
+            self.X_categorical), self.Y)
+        self.compiled = None
+        self.distributions.clear()
+
+    def _compiled_forests(self):
+        """Returns `rf_partial` and `rf_full` compiled, whose inputs are
+        the numerical conditions, followed by the codes of the categorical
+        conditions for `rf_full`.
+        """
+        if self.compiled is None:
+            n_numerical = len(self.conditions_numerical)
+            columns = range(n_numerical)
+            codes = [-1] * n_numerical
+            for j, cat in enumerate(self.conditions_categorical):
+                K = len(self.categories_to_val_map[cat])
+                columns.extend([n_numerical + j] * K)
+                codes.extend(range(K))
+            self.compiled = (
+                CompiledForest(self.rf_partial, range(n_numerical),
+                    [-1] * n_numerical),
+                CompiledForest(self.rf_full, columns, codes))
+        return self.compiled
 
     def _compute_targets_distribution(self, conditions):
         """Given conditions dict {feature_col:val}, returns the
         distribution and (class mapping for lookup) of the random label
         self.targets|conditions.
         """
-        if not set(self.conditions).issubset(set(conditions.keys())):
+        try:
+            key = tuple(conditions[col] for col in self.conditions)
+        except KeyError:
             raise BLE(ValueError(
                 'Must specify values for all the conditionals.\n'
                 'Received: {}\n'
                 'Expected: {}'.format(conditions, self.conditions_numerical +
                 self.conditions_categorical)))
+        classes = self.rf_partial.classes_
+        if key in self.distributions:
+            distribution = self.distributions.pop(key)
+            self.distributions[key] = distribution
+            return distribution, classes
 
         # Are there any category values in conditions which never appeared during
         # training? If yes, we need to run the partial RF.
-        unseen = any([conditions[cat] not in self.categories_to_val_map[cat]
-            for cat in self.conditions_categorical])
-
-        X_numerical = [conditions[col] for col in self.conditions_numerical]
-        if unseen:
-            distribution = self.rf_partial.predict_proba(X_numerical)
-            classes = self.rf_partial.classes_
+        n_numerical = len(self.conditions_numerical)
+        codes = [self.categories_to_val_map[cat].get(value)
+            for cat, value in zip(self.conditions_categorical,
+                key[n_numerical:])]
+        partial, full = self._compiled_forests()
+        if None in codes:
+            distribution = partial.predict_proba([key[:n_numerical]])[0]
         else:
-            X_categorical = [conditions[col] for col in
-                self.conditions_categorical]
-            X_categorical = utils.binarize_categorical_row(
-                self.conditions_categorical, self.categories_to_val_map,
-                X_categorical)
-            distribution = self.rf_full.predict_proba(
-                np.hstack((X_numerical, X_categorical)))
-            classes = self.rf_partial.classes_
-        return distribution[0], classes
+            distribution = full.predict_proba(
+                [list(key[:n_numerical]) + codes])[0]
+        self.distributions[key] = distribution
+        if len(self.distributions) > self.cache_size:
+            self.distributions.popitem(last=False)
+        return distribution, classes
+
+    def _compute_targets_distributions(self, conditions_matrix):
+        """Given a DataFrame of conditions with one row per query, returns
+        the distributions (one row per query) and class mapping for lookup
+        of the random label self.targets|conditions.
+
+        Rows whose categorical conditions were all seen in training go
+        through `rf_full` in a single call, and the rest through
+        `rf_partial`.
+        """
+        missing = set(self.conditions) - set(conditions_matrix.columns)
+        if missing:
+            raise BLE(ValueError(
+                'Must specify values for all the conditionals.\n'
+                'Received: {}\n'
+                'Expected: {}'.format(list(conditions_matrix.columns),
+                self.conditions_numerical + self.conditions_categorical)))
+        n_rows = len(conditions_matrix)
+        seen = np.ones(n_rows, dtype=bool)
+        for cat in self.conditions_categorical:
+            seen &= np.array([value in self.categories_to_val_map[cat]
+                for value in conditions_matrix[cat]], dtype=bool)
+        X_numerical = conditions_matrix[self.conditions_numerical]\
+            .as_matrix().astype(float)
+        classes = self.rf_partial.classes_
+        distributions = np.zeros((n_rows, len(classes)))
+        partial, full = self._compiled_forests()
+        if np.any(~seen):
+            distributions[~seen] = partial.predict_proba(X_numerical[~seen])
+        if np.any(seen):
+            codes = [utils.categorical_codes(self.categories_to_val_map[cat],
+                    conditions_matrix[cat][seen])
+                for cat in self.conditions_categorical]
+            distributions[seen] = full.predict_proba(
+                np.column_stack([X_numerical[seen]] + codes))
+        return distributions, classes
 
     def simulate(self, n_samples, conditions):
         distribution, classes = self._compute_targets_distribution(conditions)
@@ -188,3 +268,91 @@ class RandomForest(predictor.IBayesDBForeignPredictor):
         if value not in classes:
             return -float('inf')
         return np.log(distribution[np.where(classes==value)[0][0]])
+
+    def simulate_many(self, conditions_matrix):
+        distributions, classes = self._compute_targets_distributions(
+            conditions_matrix)
+        # Invert each row's CDF at a uniform draw.
+        u = self.prng.uniform(size=(len(distributions), 1))
+        draws = np.sum(np.cumsum(distributions, axis=1) < u, axis=1)
+        return list(classes[np.minimum(draws, len(classes) - 1)])
+
+    def logpdf_many(self, values, conditions_matrix):
+        distributions, classes = self._compute_targets_distributions(
+            conditions_matrix)
+        lookup = {c: i for i, c in enumerate(classes)}
+        logpdfs = np.empty(len(distributions))
+        logpdfs.fill(-float('inf'))
+        known = np.array([value in lookup for value in values], dtype=bool)
+        codes = np.array([lookup[value] for value in values
+            if value in lookup], dtype=int)
+        with np.errstate(divide='ignore'):
+            logpdfs[known] = np.log(
+                distributions[np.flatnonzero(known), codes])
+        return logpdfs
+
+class CompiledForest(object):
+    """A trained sklearn forest classifier flattened into contiguous arrays,
+    which evaluates all trees on a batch of rows at once.
+
+    The trees of the forest are concatenated node by node; each step of the
+    traversal moves every (row, tree) pair one level down, so the cost per
+    call is a few numpy operations per level instead of sklearn's per-tree
+    overhead.
+
+    Each feature of the forest reads a column of the input rows: numerical
+    features its value, and one-hot features whether it equals their code.
+
+    Parameters
+    ----------
+    forest : sklearn.ensemble.RandomForestClassifier
+        A trained forest with a single output.
+    columns : list<int>
+        The input column of each feature of `forest`.
+    codes : list<int>
+        The code of each one-hot feature of `forest`, or -1 for numerical
+        features.
+    """
+
+    def __init__(self, forest, columns, codes):
+        trees = [estimator.tree_ for estimator in forest.estimators_]
+        offsets = np.cumsum([0] + [tree.node_count for tree in trees])
+        self.roots = offsets[:-1]
+        left = np.concatenate([tree.children_left for tree in trees])
+        right = np.concatenate([tree.children_right for tree in trees])
+        self.leaf = left < 0
+        shift = np.repeat(self.roots, [tree.node_count for tree in trees])
+        self.left = np.where(self.leaf, 0, left + shift)
+        self.right = np.where(self.leaf, 0, right + shift)
+        # Leaves have no feature; any column will do.
+        feature = np.concatenate([tree.feature for tree in trees])
+        feature[self.leaf] = 0
+        self.column = np.asarray(columns, dtype=int)[feature]
+        self.code = np.asarray(codes, dtype=int)[feature]
+        self.threshold = np.concatenate([tree.threshold for tree in trees])
+        value = np.concatenate([tree.value[:, 0, :] for tree in trees])
+        self.proba = value / np.sum(value, axis=1)[:, np.newaxis]
+        # Unpickled sklearn trees report a max_depth of 0, so measure it.
+        self.depth = 0
+        nodes = self.roots
+        while not np.all(self.leaf[nodes]):
+            nodes = nodes[~self.leaf[nodes]]
+            nodes = np.concatenate((self.left[nodes], self.right[nodes]))
+            self.depth += 1
+
+    def predict_proba(self, X):
+        """Returns the class probabilities of each row of `X`, averaged
+        over the trees as by sklearn.
+        """
+        # sklearn compares single precision features to the thresholds.
+        X = np.asarray(X, dtype=np.float32)
+        rows = np.arange(len(X))[:, np.newaxis]
+        nodes = np.tile(self.roots, (len(X), 1))
+        for _depth in xrange(self.depth):
+            values = X[rows, self.column[nodes]]
+            code = self.code[nodes]
+            values = np.where(code < 0, values, values == code)
+            nodes = np.where(self.leaf[nodes], nodes,
+                np.where(values <= self.threshold[nodes], self.left[nodes],
+                    self.right[nodes]))
+        return np.mean(self.proba[nodes], axis=1)
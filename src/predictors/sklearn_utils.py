@@ -16,6 +16,7 @@
 
 import numpy as np
 import pandas as pd
+import scipy.sparse
 
 from sklearn.preprocessing import Imputer
 
@@ -59,7 +60,7 @@ def extract_sklearn_features_numerical(columns, dataset):
     return Imputer().fit_transform(X_numerical)
 
 def extract_sklearn_features_categorical(categories,  categories_to_val_map,
-        dataset):
+        dataset, sparse=False):
     """Converts each categorical column i (Ki categories, N rows) into an
     N x Ki matrix. Each row in the matrix is a binary vector.
 
@@ -87,28 +88,89 @@ def extract_sklearn_features_categorical(categories,  categories_to_val_map,
     dataset : pandas.DataFrame
         The matrix stored as a pandas dataframe. The `categories` must appear
         as columns in the dataframe.
+    sparse : bool, optional
+        If True, return a scipy.sparse.csr_matrix instead of a dense array,
+        which stores only the N*J nonzero entries.
 
     Returns
     -------
-    dataset_binary : np.array
+    dataset_binary : np.array or scipy.sparse.csr_matrix
         Refined dataset with the same number of rows and appropriate number
         of columns representing the binary version of dataset.
     """
-    dataset_binary = []
-    for row in dataset.iterrows():
-        row = list(row[1][categories])
-        row_binary = binarize_categorical_row(
-            categories, categories_to_val_map, row)
-        dataset_binary.append(row_binary)
-    return np.asarray(dataset_binary)
-
-def binarize_categorical_row(categories, categories_to_val_map, row):
+    N = len(dataset)
+    rows = np.arange(N)
+    offset = 0
+    indices = []
+    for categorical in categories:
+        codes = categorical_codes(categories_to_val_map[categorical],
+            dataset[categorical])
+        indices.append(offset + codes)
+        offset += len(categories_to_val_map[categorical])
+    if sparse:
+        columns = np.concatenate(indices) if indices else np.zeros(0, int)
+        return scipy.sparse.csr_matrix(
+            (np.ones(len(columns), dtype=int),
+                (np.tile(rows, len(categories)), columns)),
+            shape=(N, offset))
+    dataset_binary = np.zeros((N, offset), dtype=int)
+    for columns in indices:
+        dataset_binary[rows, columns] = 1
+    return dataset_binary
+
+def categorical_codes(val_map, values):
+    """Looks up the code in `val_map` of every entry of `values` at once,
+    using pandas categorical codes in place of a dictionary lookup per
+    entry.
+
+    Raises KeyError if some entry of `values` has no code.
+
+    Parameters
+    ----------
+    val_map : dict<cat:code>
+        The code lookup dictionary of a categorical column, whose codes are
+        0, ..., K-1, as built by `build_categorical_to_value_map`.
+    values : pandas.Series
+
+    Returns
+    -------
+    codes : np.array<int>
+    """
+    # Categorical categories cannot be null, so code missing values apart.
+    present = [val for val in val_map if pd.notnull(val)]
+    categorical = pd.Categorical(values, categories=present)
+    # Code -1 of the categorical picks the placeholder at the end.
+    codes = np.asarray([val_map[val] for val in present] + [-1],
+        dtype=int)[categorical.codes]
+    missing = categorical.codes == -1
+    if np.any(missing):
+        null_codes = [code for val, code in val_map.iteritems()
+            if pd.isnull(val)]
+        unknown = missing & np.asarray(pd.notnull(values))
+        if np.any(unknown) or not null_codes:
+            raise KeyError(np.asarray(values)[missing][0])
+        codes[missing] = null_codes[0]
+    return codes
+
+def binarize_categorical_row(categories, categories_to_val_map, row,
+        sparse=False):
     """Unrolls a row of categorical data into the corresponding binary
     vector version. The order of the entries in `row` must be the same as those
     in the list `categories`. The `row` must be a list of strings corresponding
     to the value of each categorical column.
+
+    If `sparse` is True, the binary vector is returned as a 1 x sum(Ki)
+    scipy.sparse.csr_matrix.
     """
     assert len(row) == len(categories)
+    if sparse:
+        offsets = np.cumsum([0] + [len(categories_to_val_map[categorical])
+            for categorical in categories])
+        columns = [offset + categories_to_val_map[categorical][value]
+            for offset, categorical, value in zip(offsets, categories, row)]
+        return scipy.sparse.csr_matrix(
+            (np.ones(len(columns), dtype=int), columns, [0, len(columns)]),
+            shape=(1, offsets[-1]))
     binary_data = []
     for categorical, value in zip(categories, row):
         K = len(categories_to_val_map[categorical])
@@ -117,6 +179,30 @@ def binarize_categorical_row(categories, categories_to_val_map, row):
         binary_data.extend(encoding)
     return binary_data
 
+def stack_sklearn_features(X_numerical, X_categorical):
+    """Concatenates the numerical and binary categorical features of the
+    same rows into one scipy.sparse.csr_matrix for sklearn, without
+    densifying the categorical features.
+
+    Parameters
+    ----------
+    X_numerical : np.array
+        N x M matrix of numerical features, or a list of the M numerical
+        features of a single row.
+    X_categorical : scipy.sparse matrix
+        N x sum(Ki) binary matrix, as returned by
+        `extract_sklearn_features_categorical` with `sparse=True`.
+
+    Returns
+    -------
+    features : scipy.sparse.csr_matrix
+    """
+    X_numerical = np.asarray(X_numerical, dtype=float)
+    if X_numerical.ndim == 1:
+        X_numerical = X_numerical.reshape((1, -1))
+    return scipy.sparse.hstack(
+        (scipy.sparse.csr_matrix(X_numerical), X_categorical), format='csr')
+
 def build_categorical_to_value_map(columns, dataset):
     """Builds a dictionary of dictionaries.
 
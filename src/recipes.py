@@ -99,7 +99,8 @@ def quick_explore_vars(self, varnames, plotfile=None, nsimilar=20):
                        "strongest dependents:\n%s\n\n", col, neighborhood)
 
 @population_method(population=0)
-def quick_similar_rows(self, identify_row_by, nsimilar=10):
+def quick_similar_rows(self, identify_row_by, nsimilar=10,
+                       use_clusters=False):
   """Explore rows similar to the identified one.
 
   identify_row_by : dict
@@ -107,6 +108,10 @@ def quick_similar_rows(self, identify_row_by, nsimilar=10):
       a WHERE clause in BQL, and must identify one unique row.
   nsimilar : positive integer
       The number of similar rows to retrieve.
+  use_clusters : bool
+      Find the similar rows from crosscat's cluster assignments, comparing
+      the identified row only with the rows it shares a cluster with, rather
+      than estimating its similarity to every row.
   """
   import hashlib
   table_name = 'tmptbl_' + hashlib.md5('\x00'.join(
@@ -122,11 +127,14 @@ def quick_similar_rows(self, identify_row_by, nsimilar=10):
 
   with self.bdb.savepoint():
     row_exists = self.query('SELECT COUNT(*) FROM %s WHERE %s;' %
-                            (self.name, query_attrs))
+                            (self.name, query_attrs), query_params)
     if row_exists.ix[0][0] != 1:
       raise BLE(NotImplementedError(
           'identify_row_by found %d rows instead of exactly 1 in %s.' %
           (row_exists.ix[0][0], self.csv_path)))
+    if use_clusters:
+      return _similar_rows_by_clusters(self, query_attrs, query_params,
+                                       column_name, nsimilar)
     creation_query = ('''CREATE TEMP TABLE IF NOT EXISTS %s AS ESTIMATE *,
                          SIMILARITY TO (%s) AS %s FROM %%g LIMIT %d;''' %
                       (table_name, query_attrs, column_name, nsimilar))
@@ -134,3 +142,23 @@ def quick_similar_rows(self, identify_row_by, nsimilar=10):
     result = self.query('''SELECT * FROM %s ORDER BY %s DESC;''' %
                         (table_name, column_name))
   return result
+
+def _similar_rows_by_clusters(population, query_attrs, query_params,
+                              column_name, nsimilar):
+  """The rows of quick_similar_rows, found by crosscat_utils.similar_rows."""
+  from bdbcontrib import crosscat_utils
+  from bdbcontrib.bql_utils import cursor_to_df
+  rowid = population.query('SELECT _rowid_ FROM %s WHERE %s;' %
+                           (population.name, query_attrs),
+                           query_params).ix[0][0]
+  neighbors = crosscat_utils.similar_rows(
+      population.bdb, population.generator_name, rowids=[rowid], k=nsimilar)
+  # BQL has no IN (...) lists, so ask SQLite for the rows.
+  rows = cursor_to_df(population.bdb.sql_execute(
+      'SELECT _rowid_, * FROM %s WHERE _rowid_ IN (%s);' %
+      (bayeslite.bql_quote_name(population.name),
+       ','.join('?' * len(neighbors))),
+      [int(r) for r in neighbors['rowid1']]))
+  result = rows.set_index(rows.columns[0]).loc[neighbors['rowid1']]
+  result[column_name] = neighbors['value'].values
+  return result.reset_index(drop=True)
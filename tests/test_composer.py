@@ -15,7 +15,10 @@
 #   limitations under the License.
 
 import os
+import numpy as np
 import pytest
+import sqlite3
+import tempfile
 
 import bayeslite
 from bayeslite.exception import BayesLiteException as BLE
@@ -395,6 +398,611 @@ def test_drop_generator():
     assert not bayeslite.core.bayesdb_has_generator(bdb, 't1_cc')
     bdb.close()
 
+KEPLER_GENERATOR = '''
+    CREATE GENERATOR {} FOR satellites USING composer(
+        default (
+            Apogee_km NUMERICAL, Perigee_km NUMERICAL,
+            Eccentricity NUMERICAL
+        ),
+        keplers_law (
+            Period_minutes NUMERICAL
+                GIVEN Perigee_km, Apogee_km
+        )
+    );'''
+
+def kepler_bdb(generator=KEPLER_GENERATOR,
+        predictors=(keplers_law.KeplersLaw,), models=1, **kwargs):
+    # A small composer generator t1, with one model by default, for the
+    # faster tests.  kwargs are passed on to the Composer.
+    bdb = bayeslite.bayesdb_open()
+    bayeslite.bayesdb_read_csv_file(bdb, 'satellites', PATH_SATELLITES_CSV,
+        header=True, create=True)
+    bdbcontrib.bql_utils.nullify(bdb, 'satellites', 'NaN')
+    kwargs.setdefault('n_samples', 5)
+    composer = Composer(**kwargs)
+    bayeslite.bayesdb_register_metamodel(bdb, composer)
+    for predictor in predictors:
+        composer.register_foreign_predictor(predictor)
+    bdb.execute(generator.format('t1'))
+    if models:
+        bdb.execute('INITIALIZE {} MODELS FOR t1'.format(models))
+    return bdb, composer
+
+def test_catalog_cache():
+    bdb, composer = kepler_bdb()
+    genid = bayeslite.core.bayesdb_get_generator(bdb, 't1')
+    period = bayeslite.core.bayesdb_generator_column_number(
+        bdb, genid, 'Period_minutes')
+    simulate = '''
+        SIMULATE Period_minutes, Eccentricity FROM t1
+            GIVEN Apogee_km = 1000 LIMIT 10
+    '''
+    bdb.execute(simulate).fetchall()
+    # Once read, the catalog is not queried again.
+    queries = []
+    tracer = lambda sql, _bindings: queries.append(sql)
+    bdb.sql_trace(tracer)
+    assert len(bdb.execute(simulate).fetchall()) == 10
+    bdb.sql_untrace(tracer)
+    # Only what changes with the models is looked up again.
+    catalog = [q for q in queries if 'bayesdb_composer' in q and
+        'predictor_binary' not in q and
+        'bayesdb_composer_model_foreign_predictor' not in q]
+    assert catalog == []
+    assert composer.topo(bdb, genid) == [period]
+    assert composer.fcols(bdb, genid) == set([period])
+    assert composer.predictor_name(bdb, genid, period) == 'keplers_law'
+    # DROP GENERATOR forgets it.
+    bdb.execute('DROP GENERATOR t1')
+    assert genid not in composer.catalog_cache[bdb]
+    bdb.execute(KEPLER_GENERATOR.format('t2'))
+    genid = bayeslite.core.bayesdb_get_generator(bdb, 't2')
+    assert composer.fcols(bdb, genid) == set([period])
+    assert composer.cc_id(bdb, genid) == \
+        bayeslite.core.bayesdb_get_generator(bdb, 't2_cc')
+    bdb.close()
+
+def test_rename_column():
+    bdb, _composer = kepler_bdb()
+    # The foreign predictors know their conditions by name, so renaming
+    # one is refused, and the generator still simulates.
+    with pytest.raises(BLE):
+        bdb.execute('ALTER TABLE satellites RENAME COLUMN Apogee_km TO apogee')
+    assert len(bdb.execute('''
+        SIMULATE Period_minutes FROM t1 GIVEN Apogee_km = 1000 LIMIT 2
+    ''').fetchall()) == 2
+    bdb.close()
+
+def test_parallel_training():
+    generator = '''
+        CREATE GENERATOR {} FOR satellites USING composer(
+            default (
+                Apogee_km NUMERICAL, Perigee_km NUMERICAL,
+                Class_of_Orbit CATEGORICAL
+            ),
+            keplers_law (
+                Period_minutes NUMERICAL
+                    GIVEN Perigee_km, Apogee_km
+            ),
+            multiple_regression (
+                Launch_Mass_kg NUMERICAL
+                    GIVEN Apogee_km, Class_of_Orbit
+            )
+        );'''
+    # Training forks no workers unless asked to.
+    assert Composer().training_processes == 1
+    logpdfs = []
+    for processes in [1, 2]:
+        bdb, composer = kepler_bdb(generator=generator,
+            predictors=(keplers_law.KeplersLaw,
+                multiple_regression.MultipleRegression),
+            models=0, training_processes=processes)
+        queries = []
+        tracer = lambda sql, _bindings: queries.append(sql)
+        bdb.sql_trace(tracer)
+        bdb.execute('INITIALIZE 1 MODEL FOR t1')
+        bdb.sql_untrace(tracer)
+        # The training data is read once for both foreign columns.
+        reads = [q for q in queries if '"Period_minutes"' in q
+            and 'SELECT' in q]
+        assert len(reads) == 1 and '"Launch_Mass_kg"' in reads[0]
+        genid = bayeslite.core.bayesdb_get_generator(bdb, 't1')
+        colno = lambda name: bayeslite.core.bayesdb_generator_column_number(
+            bdb, genid, name)
+        conditions = {'Apogee_km': 1000, 'Perigee_km': 900,
+            'Class_of_Orbit': 'LEO'}
+        with bdb.savepoint():
+            logpdfs.append([
+                composer.predictor(bdb, genid, colno('Period_minutes'))
+                    .logpdf(100, conditions),
+                composer.predictor(bdb, genid, colno('Launch_Mass_kg'))
+                    .logpdf(1000, conditions)])
+        bdb.close()
+    assert np.allclose(logpdfs[0], logpdfs[1])
+
+def test_bootstrap_predictors():
+    bdb, composer = kepler_bdb(models=3, n_samples=6,
+        bootstrap_predictors=True, training_processes=2)
+    genid = bayeslite.core.bayesdb_get_generator(bdb, 't1')
+    period = bayeslite.core.bayesdb_generator_column_number(
+        bdb, genid, 'Period_minutes')
+    def stored_modelnos():
+        return [row[0] for row in bdb.sql_execute('''
+            SELECT modelno FROM bayesdb_composer_model_foreign_predictor
+                WHERE generator_id = ? AND colno = ? ORDER BY modelno
+        ''', (genid, period))]
+    assert stored_modelnos() == [0, 1, 2]
+    with bdb.savepoint():
+        # Each model has its own replicate, and the full-data instance
+        # remains for queries without a model.
+        noises = [composer.predictor(bdb, genid, period, modelno).noise
+            for modelno in [None, 0, 1, 2]]
+        assert len(set(noises)) == 4
+    assert len(bdb.execute('''
+        SIMULATE Period_minutes FROM t1 USING MODEL 1
+            GIVEN Apogee_km = 1000 LIMIT 4
+    ''').fetchall()) == 4
+    # Without a model, the samples are spread over all models' replicates.
+    row_id = bayeslite.core.bayesdb_generator_fresh_row_id(bdb, genid)
+    apogee, perigee = [bayeslite.core.bayesdb_generator_column_number(
+        bdb, genid, name) for name in ['Apogee_km', 'Perigee_km']]
+    with bdb.savepoint():
+        samples, weights = composer._weighted_sample(bdb, genid, None,
+            row_id, [(row_id, period, 100)], n_samples=6)
+        assert len(samples[period]) == 6 and len(weights) == 6
+        for k, modelno in enumerate([0, 0, 1, 1, 2, 2]):
+            predictor = composer.predictor(bdb, genid, period, modelno)
+            assert abs(weights[k] - predictor.logpdf(100,
+                {'Apogee_km': samples[apogee][k],
+                    'Perigee_km': samples[perigee][k]})) < 1e-9
+    bdb.execute('DROP MODEL 1 FROM t1')
+    assert stored_modelnos() == [0, 2]
+    bdb.execute('DROP GENERATOR t1')
+    assert stored_modelnos() == []
+    bdb.close()
+
+def test_predictor_cache_across_queries():
+    bdb, composer = kepler_bdb()
+    genid = bayeslite.core.bayesdb_get_generator(bdb, 't1')
+    calls = []
+    class CountingKeplersLaw(keplers_law.KeplersLaw):
+        @classmethod
+        def deserialize(cls, bdb, binary):
+            calls.append(binary)
+            return keplers_law.KeplersLaw.deserialize(bdb, binary)
+    composer.predictor_builder['keplers_law'] = CountingKeplersLaw
+    simulate = '''
+        SIMULATE Period_minutes FROM t1 GIVEN Apogee_km = 1000 LIMIT 5
+    '''
+    bdb.execute(simulate).fetchall()
+    bdb.execute(simulate).fetchall()
+    assert len(calls) == 1
+    cache = composer.predictor_cache[bdb]
+    assert len(cache) == 1 and cache.hits >= 1
+    # A new binary for the same column is deserialized afresh.
+    bdb.sql_execute('''
+        UPDATE bayesdb_composer_column_foreign_predictor
+            SET predictor_binary = ?
+    ''', (sqlite3.Binary(str(calls[0]) + '.'),))
+    bdb.execute(simulate).fetchall()
+    assert len(calls) == 2
+    bdb.execute('DROP GENERATOR t1')
+    assert len(cache) == 0 and cache.nbytes == 0
+    bdb.close()
+
+def test_predictor_cache_eviction():
+    from bdbcontrib.metamodels.composer import PredictorCache
+    cache = PredictorCache(10)
+    cache.put((1, 1, 'a'), 'A', 4)
+    cache.put((1, 2, 'b'), 'B', 4)
+    assert cache.get((1, 1, 'a')) == 'A'
+    # The least recently used entry goes first.
+    cache.put((2, 1, 'c'), 'C', 4)
+    assert (1, 2, 'b') not in cache and cache.get((1, 2, 'b')) is None
+    assert cache.nbytes == 8 and len(cache) == 2
+    # Too large to keep at all.
+    cache.put((2, 2, 'd'), 'D', 11)
+    assert (2, 2, 'd') not in cache and len(cache) == 2
+    cache.evict_generator(2)
+    assert len(cache) == 1 and cache.nbytes == 4
+    assert (cache.hits, cache.misses) == (1, 1)
+
+def test_weighted_sample():
+    bdb, composer = kepler_bdb()
+    genid = bayeslite.core.bayesdb_get_generator(bdb, 't1')
+    colno = lambda name: bayeslite.core.bayesdb_generator_column_number(
+        bdb, genid, name)
+    apogee, perigee, period = (colno('Apogee_km'), colno('Perigee_km'),
+        colno('Period_minutes'))
+    row_id = bayeslite.core.bayesdb_generator_fresh_row_id(bdb, genid)
+    calls = []
+    with bdb.savepoint():
+        predictor = composer.predictor(bdb, genid, period)
+        logpdf_many = predictor.logpdf_many
+        def counting_logpdf_many(values, conditions):
+            calls.append(conditions)
+            return logpdf_many(values, conditions)
+        predictor.logpdf_many = counting_logpdf_many
+        # Latent foreign column: simulated for every sample, given its
+        # parents.
+        samples, weights = composer._weighted_sample(bdb, genid, 0, row_id,
+            [(row_id, apogee, 1000)], n_samples=20)
+        assert sorted(samples) == sorted([apogee, perigee, period,
+            colno('Eccentricity')])
+        assert all(len(column) == 20 for column in samples.itervalues())
+        assert list(samples[apogee]) == [1000] * 20
+        assert len(weights) == 20 and len(set(weights)) == 1
+        # Observed foreign column: its likelihood weights each sample.
+        Y = [(row_id, perigee, 980), (row_id, period, 100)]
+        samples, weights = composer._weighted_sample(bdb, genid, 0, row_id,
+            Y, n_samples=20)
+        assert list(samples[period]) == [100] * 20
+        # One batch call covers every sample.
+        assert len(calls) == 1
+        assert list(calls[0]['Perigee_km']) == [980] * 20
+        for k in xrange(20):
+            conditions = {'Apogee_km': samples[apogee][k],
+                'Perigee_km': 980}
+            assert calls[0].iloc[k].to_dict() == conditions
+            expected = predictor.logpdf(100, conditions) + \
+                composer.cc(bdb, genid)\
+                .logpdf_joint(bdb, composer.cc_id(bdb, genid),
+                    [(row_id, perigee, 980)], [], 0)
+            assert abs(weights[k] - expected) < 1e-9
+    bdb.close()
+
+def test_simulate_particles():
+    bdb, composer = kepler_bdb()
+    genid = bayeslite.core.bayesdb_get_generator(bdb, 't1')
+    colno = lambda name: bayeslite.core.bayesdb_generator_column_number(
+        bdb, genid, name)
+    apogee, period = colno('Apogee_km'), colno('Period_minutes')
+    row_id = bayeslite.core.bayesdb_generator_fresh_row_id(bdb, genid)
+    weighted_sample_blocks = composer._weighted_sample_blocks
+    calls = []
+    def counting_weighted_sample_blocks(bdb, genid, blocks):
+        calls.append(sum(n for _, _, _, n in blocks))
+        return weighted_sample_blocks(bdb, genid, blocks)
+    composer._weighted_sample_blocks = counting_weighted_sample_blocks
+    # A constrained foreign child skews the weights.
+    targets = [(row_id, apogee)]
+    constraints = [(row_id, period, 100)]
+    with bdb.savepoint():
+        # By default, one weighted pass with a particle set of n_samples
+        # for each prediction, which are independent.
+        samples, ess = composer.simulate(bdb, genid, 0, targets,
+            constraints, numpredictions=30, return_ess=True)
+        assert len(samples) == 30 and all(len(s) == 1 for s in samples)
+        assert calls == [30 * 5]
+        assert len(set(s[0] for s in samples)) == 30
+        assert 1 <= ess <= 5
+        # A fixed number of particles resamples all predictions from one
+        # particle set.
+        composer.n_particles = 7
+        samples, ess = composer.simulate(bdb, genid, 0, targets,
+            constraints, numpredictions=30, return_ess=True)
+        assert calls == [30 * 5, 7]
+        assert len(set(s[0] for s in samples)) <= 7
+        assert 1 <= ess <= 7
+        # Rows of simulate_rows are resampled alike.
+        composer.n_particles = None
+        del calls[:]
+        results, ess = composer.simulate_rows(bdb, genid, 0,
+            [(row_id, [apogee], [(period, 100)]),
+                (row_id + 1, [apogee], [(period, 90)]),
+                (row_id + 2, [apogee], [])],
+            numpredictions=4, return_ess=True)
+        assert calls == [2 * 4 * 5]
+        assert all(len(set(s[0] for s in r)) == 4 for r in results[:2])
+        assert all(1 <= e <= 5 for e in ess[:2]) and ess[2] is None
+    # Crosscat simulates unconstrained local columns without particles.
+    assert composer.simulate(bdb, genid, 0, targets, [], return_ess=True)[1] \
+        is None
+    bdb.close()
+
+def test_effective_sample_size():
+    from bdbcontrib.metamodels.composer import effective_sample_size
+    assert abs(effective_sample_size([0, 0, 0, 0]) - 4) < 1e-9
+    assert abs(effective_sample_size([0, -1e3, -1e3]) - 1) < 1e-9
+    assert abs(effective_sample_size([1e3, 1e3]) - 2) < 1e-9
+
+def test_evidence_sample_reuse():
+    bdb, composer = kepler_bdb()
+    genid = bayeslite.core.bayesdb_get_generator(bdb, 't1')
+    colno = lambda name: bayeslite.core.bayesdb_generator_column_number(
+        bdb, genid, name)
+    apogee, perigee, period = (colno('Apogee_km'), colno('Perigee_km'),
+        colno('Period_minutes'))
+    row_id = bayeslite.core.bayesdb_generator_fresh_row_id(bdb, genid)
+    weighted_sample = composer._weighted_sample
+    calls = []
+    def counting_weighted_sample(bdb, genid, modelno, row_id, Y, **kwargs):
+        calls.append(sorted(c for _, c, _ in Y))
+        return weighted_sample(bdb, genid, modelno, row_id, Y, **kwargs)
+    composer._weighted_sample = counting_weighted_sample
+    with bdb.savepoint(), composer._evidence_memo(bdb):
+        # A foreign query reuses the samples for the evidence, which are
+        # drawn once per query.
+        Y = [(row_id, apogee, 1000)]
+        composer._joint_logpdf(bdb, genid, 0, [(row_id, period, 100)], Y)
+        composer._joint_logpdf(bdb, genid, 0, [(row_id, period, 90)], Y)
+        assert calls == [[apogee]]
+        # Queries fixing local columns still need a pass of their own.
+        composer._joint_logpdf(bdb, genid, 0, [(row_id, apogee, 900)],
+            [(row_id, perigee, 980)])
+        assert calls[1:] == [[perigee], sorted([apogee, perigee])]
+    with bdb.savepoint():
+        # Mutual information: one for the empty evidence, and one for
+        # each term with a local column per sample (the simulation pass
+        # draws its particle sets as blocks).
+        del calls[:]
+        composer.conditional_mutual_information(bdb, genid, 0,
+            [(row_id, period)], [(row_id, apogee)], [], [], numsamples=5)
+        assert len(calls) == 1 + 2*5
+        # The samples are forgotten once the query returns.
+        assert 'composer_evidence' not in bdb.cache
+        del calls[:]
+        composer.logpdf_joint(bdb, genid, [(row_id, period, 100)], Y, 0)
+        composer.logpdf_joint(bdb, genid, [(row_id, period, 100)], Y, 0)
+        assert calls == [[apogee], [apogee]]
+    bdb.close()
+
+def test_factorized_logpdf():
+    bdb, composer = kepler_bdb()
+    genid = bayeslite.core.bayesdb_get_generator(bdb, 't1')
+    colno = lambda name: bayeslite.core.bayesdb_generator_column_number(
+        bdb, genid, name)
+    apogee, perigee, period = (colno('Apogee_km'), colno('Perigee_km'),
+        colno('Period_minutes'))
+    row_id = bayeslite.core.bayesdb_generator_fresh_row_id(bdb, genid)
+    def weighted_sample(*args, **kwargs):
+        assert False, 'sampled a factorized query'
+    with bdb.savepoint():
+        predictor = composer.predictor(bdb, genid, period)
+        composer._weighted_sample = weighted_sample
+        # A foreign column given all its parents has an exact density.
+        Y = [(row_id, apogee, 1000), (row_id, perigee, 980)]
+        for value in [90, 100, 110]:
+            logp = composer._joint_logpdf(bdb, genid, 0,
+                [(row_id, period, value)], Y)
+            expected = predictor.logpdf(value,
+                {'Apogee_km': 1000, 'Perigee_km': 980})
+            assert logp == expected
+        # So does the model average.
+        logp = composer.logpdf_joint(bdb, genid, [(row_id, period, 100)], Y,
+            None)
+        assert abs(logp - predictor.logpdf(100,
+            {'Apogee_km': 1000, 'Perigee_km': 980})) < 1e-9
+        # But not given only some of its parents.
+        with pytest.raises(AssertionError):
+            composer._joint_logpdf(bdb, genid, 0, [(row_id, period, 100)],
+                Y[:1])
+    bdb.close()
+
+def test_adaptive_sampling():
+    bdb, composer = kepler_bdb()
+    genid = bayeslite.core.bayesdb_get_generator(bdb, 't1')
+    colno = lambda name: bayeslite.core.bayesdb_generator_column_number(
+        bdb, genid, name)
+    apogee, perigee, period = (colno('Apogee_km'), colno('Perigee_km'),
+        colno('Period_minutes'))
+    row_id = bayeslite.core.bayesdb_generator_fresh_row_id(bdb, genid)
+    weighted_sample = composer._weighted_sample
+    calls = []
+    def counting_weighted_sample(*args, **kwargs):
+        calls.append(kwargs['n_samples'])
+        return weighted_sample(*args, **kwargs)
+    composer._weighted_sample = counting_weighted_sample
+    Q = [(row_id, period, 100)]
+    Y = [(row_id, apogee, 1000)]
+    # A single batch by default.
+    with bdb.savepoint():
+        _logp, stderr = composer.logpdf_joint(bdb, genid, Q, Y, 0,
+            return_stderr=True)
+        # The standard error belongs to the estimate it is returned with,
+        # not to the inner estimates of later queries.
+        composer.logpdf_joint(bdb, genid, Q, Y + [(row_id, perigee, 980)], 0)
+        assert composer.logpdf_joint(bdb, genid, Q,
+            Y + [(row_id, perigee, 980)], 0, return_stderr=True)[1] == 0
+    assert calls == [5]
+    assert 0 < stderr
+    # The densities of a query extending its evidence are estimated from
+    # the same samples, whose errors cancel in their ratio.
+    from bdbcontrib.metamodels.composer import _log_ratio_stderr
+    log_weights = np.log(np.arange(1., 11.))
+    assert _log_ratio_stderr(log_weights, log_weights + 2) < 1e-12
+    assert 0 < _log_ratio_stderr(log_weights, log_weights[::-1])
+    # An unreachable tolerance samples up to the bound.
+    composer.tolerance = 0
+    composer.max_samples = 20
+    del calls[:]
+    with bdb.savepoint():
+        composer._joint_logpdf(bdb, genid, 0, Q, Y)
+    assert calls == [5, 5, 5, 5]
+    # A loose one stops after the first batch.
+    composer.tolerance = float('inf')
+    del calls[:]
+    with bdb.savepoint():
+        composer._joint_logpdf(bdb, genid, 0, Q, Y)
+        assert calls == [5]
+        del calls[:]
+        mi, stderr = composer.conditional_mutual_information(bdb, genid, 0,
+            [(row_id, period)], [(row_id, apogee)], [], [], numsamples=5,
+            return_stderr=True)
+        assert len(calls) == 1 + 2*5
+    assert np.isfinite(mi) and 0 <= stderr
+    mi, stderr = composer.column_mutual_information(bdb, genid, None,
+        period, apogee, numsamples=5, return_stderr=True)
+    assert np.isfinite(mi) and 0 <= stderr
+    # So does an exhausted time budget.
+    composer.tolerance = 0
+    composer.max_seconds = 0
+    del calls[:]
+    with bdb.savepoint():
+        composer._joint_logpdf(bdb, genid, 0, Q, Y)
+    assert calls == [5]
+    bdb.close()
+
+def test_multiple_rows():
+    bdb, composer = kepler_bdb()
+    genid = bayeslite.core.bayesdb_get_generator(bdb, 't1')
+    colno = lambda name: bayeslite.core.bayesdb_generator_column_number(
+        bdb, genid, name)
+    apogee, perigee, period = (colno('Apogee_km'), colno('Perigee_km'),
+        colno('Period_minutes'))
+    fresh = bayeslite.core.bayesdb_generator_fresh_row_id(bdb, genid)
+    cc = composer.cc(bdb, genid)
+    simulate_joint = cc.simulate_joint
+    cc_rows = []
+    def counting_simulate_joint(bdb, genid, targets, *args, **kwargs):
+        cc_rows.append(set(r for r, _ in targets))
+        return simulate_joint(bdb, genid, targets, *args, **kwargs)
+    cc.simulate_joint = counting_simulate_joint
+    try:
+        with bdb.savepoint():
+            predictor = composer.predictor(bdb, genid, period)
+            simulate_many = predictor.simulate_many
+            fp_calls = []
+            def counting_simulate_many(conditions):
+                fp_calls.append(len(conditions))
+                return simulate_many(conditions)
+            predictor.simulate_many = counting_simulate_many
+            queries = [(fresh + i, [period, apogee], [(perigee, 980)])
+                for i in xrange(3)]
+            queries.append((1, [period], []))
+            # A crosscat-only row is delegated.
+            queries.append((fresh + 3, [apogee], [(perigee, 980)]))
+            results = composer.simulate_rows(bdb, genid, 0, queries,
+                numpredictions=4)
+            assert [len(r) for r in results] == [4] * 5
+            assert all(len(s) == 2 for r in results[:3] for s in r)
+            assert all(len(s) == 1 for r in results[3:] for s in r)
+            # The hypothetical rows share their crosscat call, and the
+            # predictor is called once for the particle sets of every
+            # prediction of every row.
+            assert cc_rows[:1] == [set([fresh + 3])]
+            assert sorted(map(sorted, cc_rows[1:])) == [[1], [fresh]]
+            assert fp_calls == [4 * 4 * 5]
+    finally:
+        cc.simulate_joint = simulate_joint
+    with bdb.savepoint():
+        predictor = composer.predictor(bdb, genid, period)
+        queries = [
+            (fresh, [(period, value)], [(apogee, 1000), (perigee, 980)])
+            for value in [90, 100]]
+        queries.append((fresh, [(period, 100)], [(apogee, 1000)]))
+        queries.append((fresh, [(period, 100)], [(period, 90)]))
+        logps = composer.logpdf_rows(bdb, genid, 0, queries)
+        for value, logp in zip([90, 100], logps):
+            assert logp == predictor.logpdf(value,
+                {'Apogee_km': 1000, 'Perigee_km': 980})
+        assert np.isfinite(logps[2])
+        assert logps[3] == float('-inf')
+        assert len(composer.logpdf_rows(bdb, genid, None, queries)) == 4
+    bdb.close()
+
+def test_dependence_matrix():
+    bdb, composer = kepler_bdb(models=3)
+    genid = bayeslite.core.bayesdb_get_generator(bdb, 't1')
+    colno = lambda name: bayeslite.core.bayesdb_generator_column_number(
+        bdb, genid, name)
+    period, eccentricity = colno('Period_minutes'), colno('Eccentricity')
+    colnos = sorted(composer.lcols(bdb, genid)) + composer.topo(bdb, genid)
+    fcols = composer.fcols(bdb, genid)
+    pcols = lambda colno: composer.pcols(bdb, genid, colno)
+    cc, cc_id = composer.cc(bdb, genid), composer.cc_id(bdb, genid)
+    def baseline(modelno, colno0, colno1):
+        # The dependence probability of a pair of columns, by recursion
+        # over the network: local columns are delegated to crosscat, a
+        # foreign column depends on its conditions, and otherwise two
+        # columns depend on each other iff any of their conditions do.
+        if colno0 == colno1:
+            return 1
+        if colno0 not in fcols and colno1 not in fcols:
+            return cc.column_dependence_probability(bdb, cc_id, modelno,
+                *composer.cc_colnos(bdb, genid, [colno0, colno1]))
+        if colno0 in pcols(colno1) or colno1 in pcols(colno0):
+            return 1
+        if colno0 not in fcols:
+            colno0, colno1 = colno1, colno0
+        return max(baseline(modelno, pcol0, pcol1)
+            for pcol0 in pcols(colno0)
+            for pcol1 in (pcols(colno1) if colno1 in fcols else [colno1]))
+    def check():
+        with bdb.transaction():
+            for colno0 in colnos:
+                for colno1 in colnos:
+                    expected = [baseline(modelno, colno0, colno1)
+                        for modelno in xrange(3)]
+                    assert [composer.column_dependence_probability(bdb,
+                            genid, modelno, colno0, colno1)
+                        for modelno in xrange(3)] == expected
+                    assert composer.column_dependence_probability(bdb,
+                        genid, None, colno0, colno1) == np.mean(expected)
+            # As through BQL.
+            rows = bdb.execute('''
+                ESTIMATE DEPENDENCE PROBABILITY FROM PAIRWISE COLUMNS OF t1
+            ''').fetchall()
+            assert len(rows) == len(colnos)**2
+            for _, name0, name1, value in rows:
+                assert value == np.mean([baseline(modelno, colno(name0),
+                    colno(name1)) for modelno in xrange(3)])
+    check()
+    # The views are not read again by later queries, each in a savepoint
+    # of its own.
+    queries = []
+    tracer = lambda sql, _bindings: queries.append(sql)
+    bdb.sql_trace(tracer)
+    bdb.execute('''
+        ESTIMATE DEPENDENCE PROBABILITY FROM PAIRWISE COLUMNS OF t1
+    ''').fetchall()
+    bdb.sql_untrace(tracer)
+    assert not [q for q in queries if 'bayesdb_crosscat_theta' in q]
+    # The matrices are computed once for all pairs and models, until
+    # analysis changes the views.
+    for analyze in ['ANALYZE t1 FOR 2 ITERATIONS WAIT',
+            'ANALYZE t1_cc FOR 1 ITERATION WAIT']:
+        with bdb.transaction():
+            matrices = composer._dependence_matrices(bdb, genid)
+            composer.column_dependence_probability(bdb, genid, None, period,
+                eccentricity)
+            assert composer._dependence_matrices(bdb, genid) is matrices
+            bdb.execute(analyze)
+            assert composer._dependence_matrices(bdb, genid) is not matrices
+        check()
+    # Without models there is nothing to average over.
+    bdb.execute('DROP MODELS FROM t1')
+    with pytest.raises(BLE):
+        composer.column_dependence_probability(bdb, genid, None, period,
+            eccentricity)
+    bdb.close()
+
+def test_dependence_matrix_other_connection():
+    with tempfile.NamedTemporaryFile(suffix='.bdb') as bdb_file:
+        def open_bdb():
+            bdb = bayeslite.bayesdb_open(bdb_file.name)
+            composer = Composer(n_samples=5)
+            bayeslite.bayesdb_register_metamodel(bdb, composer)
+            composer.register_foreign_predictor(keplers_law.KeplersLaw)
+            return bdb, composer
+        bdb, composer = open_bdb()
+        bayeslite.bayesdb_read_csv_file(bdb, 'satellites',
+            PATH_SATELLITES_CSV, header=True, create=True)
+        bdbcontrib.bql_utils.nullify(bdb, 'satellites', 'NaN')
+        bdb.execute(KEPLER_GENERATOR.format('t1'))
+        bdb.execute('INITIALIZE 2 MODELS FOR t1')
+        genid = bayeslite.core.bayesdb_get_generator(bdb, 't1')
+        matrices = composer._dependence_matrices(bdb, genid)
+        assert composer._dependence_matrices(bdb, genid) is matrices
+        # Models initialized again by another connection have the same
+        # iterations, but are not the ones the matrices were computed from.
+        other, _ = open_bdb()
+        other.execute('DROP MODELS FROM t1')
+        other.execute('INITIALIZE 2 MODELS FOR t1')
+        other.close()
+        assert composer._dependence_matrices(bdb, genid) is not matrices
+        bdb.close()
+
 def test_composer_integration__ci_slow():
     # But currently difficult to seperate these tests into smaller tests because
     # of their sequential nature. We will still test all internal functions
@@ -117,3 +117,48 @@ def test_get_metadata():
         assert isinstance(md, dict)
         assert 'X_D' in md.keys()
         assert 'X_L' in md.keys()
+
+
+def test_similar_rows():
+    table_name = 'tmp_table'
+    generator_name = 'tmp_cc'
+    pandas_df = get_test_df()
+
+    with bayeslite.bayesdb_open() as bdb:
+        bayesdb_read_pandas_df(bdb, table_name, pandas_df, create=True)
+        bdb.execute('''
+            create generator {} for {} using crosscat(guess(*))
+        '''.format(generator_name, table_name))
+        with pytest.raises(BLE):
+            crosscat_utils.similar_rows(bdb, generator_name)
+
+        bdb.execute('INITIALIZE 4 MODELS FOR {}'.format(generator_name))
+        bdb.execute('ANALYZE {} FOR 5 ITERATIONS WAIT'.format(generator_name))
+        cursor = bdb.execute(
+            'ESTIMATE SIMILARITY FROM PAIRWISE {}'.format(generator_name))
+        expected = dict(((rowid0, rowid1), value)
+            for rowid0, rowid1, value in cursor)
+
+        neighbors = crosscat_utils.similar_rows(bdb, generator_name, k=3)
+        assert ['rowid0', 'rowid1', 'value'] == list(neighbors.columns)
+        for rowid0, group in neighbors.groupby('rowid0'):
+            assert rowid0 == group['rowid1'].iloc[0]
+            values = group['value'].tolist()
+            assert sorted(values, reverse=True) == values
+            best = sorted((value for (r0, _), value in expected.iteritems()
+                if r0 == rowid0), reverse=True)
+            for rowid1, value in zip(group['rowid1'], values):
+                assert abs(expected[rowid0, rowid1] - value) < 1e-9
+            # Rows sharing no cluster are not neighbors.
+            assert len(values) == min(3, sum(1 for v in best if v > 0))
+            assert abs(values[-1] - best[len(values) - 1]) < 1e-9
+
+        neighbors = crosscat_utils.similar_rows(bdb, generator_name,
+            rowids=[2], k=10, among=[1, 3, 5])
+        assert set(neighbors['rowid1']) <= set([1, 3, 5])
+        assert (neighbors['rowid0'] == 2).all()
+
+        with pytest.raises(BLE):
+            crosscat_utils.similar_rows(bdb, generator_name, rowids=[100])
+        with pytest.raises(BLE):
+            crosscat_utils.similar_rows(bdb, generator_name, k=0)
@@ -16,13 +16,20 @@
 
 import numpy as np
 import pandas as pd
+import pytest
+import scipy.sparse
 
+from bayeslite.exception import BayesLiteException as BLE
 from bdbcontrib.bql_utils import df_to_table
 from crosscat.tests import synthetic_data_generator as sdg
+from sklearn.linear_model import LinearRegression
 
 from bdbcontrib.predictors.random_forest import RandomForest
 from bdbcontrib.predictors.keplers_law import KeplersLaw
 from bdbcontrib.predictors.multiple_regression import MultipleRegression
+from bdbcontrib.predictors.sklearn_utils import \
+    extract_sklearn_features_categorical
+from bdbcontrib.predictors.sklearn_utils import stack_sklearn_features
 
 # TODO: More robust tests exploring more interesting cases. The main use
 # right now is crash testing. Moreover common patterns can be automated.
@@ -156,3 +163,120 @@ def test_multiple_regression():
     mr_predictor2.simulate(10, inputs)
     pdf_val2 = mr_predictor2.logpdf(-0.4, inputs)
     assert np.allclose(pdf_val, pdf_val2)
+
+def test_batch_matches_single():
+    (bdb, table) = get_synthetic_data(150)
+    conditions = [(c, 'NUMERICAL') for c in ['c1','c2','c4','c8']] + \
+        [(c, 'CATEGORICAL') for c in ['m1', 'm3']]
+    rf_predictor = RandomForest.create(bdb, table, [('m5', 'CATEGORICAL')],
+        conditions)
+    mr_predictor = MultipleRegression.create(bdb, table,
+        [('c7', 'NUMERICAL')], conditions)
+    kl_predictor = KeplersLaw.create(bdb, table, [('c4', 'NUMERICAL')],
+        [('c1','NUMERICAL'), ('c3', 'NUMERICAL')])
+
+    # Rows mixing seen and unseen (m3=7) categories, with an extra column.
+    rows = [
+        {'c1':1.3, 'c2':-2.1, 'c3':1.7, 'c4':0.2, 'c8':0.2, 'm1':1, 'm3':7},
+        {'c1':0.1, 'c2':0.5, 'c3':-1.0, 'c4':1.2, 'c8':-0.3, 'm1':2, 'm3':4},
+        {'c1':-2.0, 'c2':1.1, 'c3':0.4, 'c4':0.0, 'c8':1.5, 'm1':1, 'm3':2},
+    ]
+    matrix = pd.DataFrame(rows)
+
+    for predictor, values in [
+            (rf_predictor, [7, -1, 5]),
+            (mr_predictor, [-0.4, 0.3, 1.1]),
+            (kl_predictor, [1.2, -0.5, 0.7])]:
+        expected = [predictor.logpdf(v, r) for v, r in zip(values, rows)]
+        assert np.allclose(predictor.logpdf_many(values, matrix), expected)
+        assert len(predictor.simulate_many(matrix)) == len(rows)
+
+    assert rf_predictor.logpdf_many([-1], matrix[:1])[0] == float('-inf')
+    assert set(rf_predictor.simulate_many(matrix)).issubset(
+        set(rf_predictor.rf_partial.classes_))
+
+    with pytest.raises(BLE):
+        rf_predictor.logpdf_many([7], matrix[['c1', 'm1']])
+
+def test_sparse_categorical_features():
+    # A categorical condition with as many levels as rows.
+    n = 2000
+    prng = np.random.RandomState(0)
+    df = pd.DataFrame({
+        'x': prng.normal(size=n),
+        'level': ['l%d' % (i,) for i in xrange(n)],
+        'label': prng.choice(['a', 'b'], size=n),
+    })
+    df['y'] = 3 * df['x'] + prng.normal(size=n) + 100
+    conditions = [('x', 'NUMERICAL'), ('level', 'CATEGORICAL')]
+    mr_predictor = MultipleRegression.create_from_df(df, [('y', 'NUMERICAL')],
+        conditions)
+    rf_predictor = RandomForest.create_from_df(df,
+        [('label', 'CATEGORICAL')], conditions)
+    for predictor in [mr_predictor, rf_predictor]:
+        assert scipy.sparse.issparse(predictor.X_categorical)
+        assert predictor.X_categorical.nnz == n
+
+    # The full regression on sparse features fits the dense least squares.
+    X = np.hstack((mr_predictor.X_numerical,
+        mr_predictor.X_categorical.toarray()))
+    dense = LinearRegression().fit(X, mr_predictor.Y)
+    rows = df[['x', 'level']][:5]
+    predictions, _noise = mr_predictor._compute_targets_distributions(rows)
+    assert np.allclose(predictions, dense.predict(X[:5]), atol=1e-3)
+    prediction, _noise = mr_predictor._compute_targets_distribution(
+        rows.iloc[0].to_dict())
+    assert np.allclose(prediction, predictions[0])
+    distribution, _classes = rf_predictor._compute_targets_distribution(
+        rows.iloc[0].to_dict())
+    distributions, _classes = rf_predictor._compute_targets_distributions(
+        rows[:1])
+    assert np.allclose(distribution, distributions[0])
+
+def test_random_forest_compiled():
+    (bdb, table) = get_synthetic_data(150)
+    conditions = [(c, 'NUMERICAL') for c in ['c1','c2','c4','c8']] + \
+        [(c, 'CATEGORICAL') for c in ['m1', 'm3']]
+    rf_predictor = RandomForest.create(bdb, table, [('m5', 'CATEGORICAL')],
+        conditions)
+    rows = [
+        {'c1':0.1, 'c2':0.5, 'c4':1.2, 'c8':-0.3, 'm1':2, 'm3':4},
+        {'c1':-2.0, 'c2':1.1, 'c4':0.0, 'c8':1.5, 'm1':1, 'm3':2},
+        {'c1':1.3, 'c2':-2.1, 'c4':0.2, 'c8':0.2, 'm1':1, 'm3':7},
+    ]
+    # The compiled forests agree with sklearn.
+    X_numerical = [[row[c] for c in ['c1','c2','c4','c8']] for row in rows]
+    X_categorical = extract_sklearn_features_categorical(['m1', 'm3'],
+        rf_predictor.categories_to_val_map, pd.DataFrame(rows[:2]),
+        sparse=True)
+    expected = np.vstack((
+        rf_predictor.rf_full.predict_proba(
+            stack_sklearn_features(X_numerical[:2], X_categorical)),
+        rf_predictor.rf_partial.predict_proba(X_numerical[2:])))
+    distributions, _classes = rf_predictor._compute_targets_distributions(
+        pd.DataFrame(rows))
+    assert np.allclose(distributions, expected)
+    for row, distribution in zip(rows, expected):
+        assert np.allclose(
+            rf_predictor._compute_targets_distribution(row)[0], distribution)
+
+    # Distributions of repeated conditions are cached, least recently used
+    # first out.
+    rf_predictor.cache_size = 2
+    rf_predictor.distributions.clear()
+    first = rf_predictor._compute_targets_distribution(rows[0])[0]
+    assert rf_predictor._compute_targets_distribution(
+        dict(rows[0], m5=3))[0] is first
+    rf_predictor._compute_targets_distribution(rows[1])
+    rf_predictor._compute_targets_distribution(rows[2])
+    assert len(rf_predictor.distributions) == 2
+    assert rf_predictor._compute_targets_distribution(rows[0])[0] \
+        is not first
+
+    # Deserialized predictors are compiled up front.
+    rf_predictor2 = RandomForest.deserialize(bdb,
+        RandomForest.serialize(bdb, rf_predictor))
+    assert rf_predictor2.compiled is not None
+    assert np.allclose(
+        rf_predictor2._compute_targets_distributions(pd.DataFrame(rows))[0],
+        expected)
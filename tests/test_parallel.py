@@ -15,14 +15,17 @@
 #   limitations under the License.
 
 from apsw import SQLError
+import numpy as np
 import os
 from pandas.util.testing import assert_frame_equal
 import pytest
 import random
+import shutil
 import tempfile
 
 import bayeslite
 from bayeslite.exception import BayesLiteException as BLE
+from bayeslite.math_util import logmeanexp as logmeanexp_1
 from bdbcontrib import parallel
 from bdbcontrib.bql_utils import cursor_to_df
 
@@ -112,6 +115,11 @@ def test_estimate_pairwise_similarity():
         )
         assert_frame_equal(std_sim, parallel_sim, check_column_type=True)
 
+        # The pairs are indexed once loaded.
+        assert bdb.sql_execute('''
+            SELECT tbl_name FROM sqlite_master WHERE name = ?
+        ''', ('t_similarity_rowids',)).fetchall() == [('t_similarity',)]
+
 
 def _bigger_csv_data(n=30):
     """
@@ -132,6 +140,31 @@ def _bigger_csv_data(n=30):
     return '\n'.join(data)
 
 
+def _analyzed_bdb(bdb_file, n, models=3):
+    """
+    Open the BayesDB at bdb_file with a table t of n rows of
+    _bigger_csv_data and a crosscat generator t_cc of models models, each
+    analyzed for 10 iterations.
+    """
+    bdb = bayeslite.bayesdb_open(bdb_file)
+    with tempfile.NamedTemporaryFile() as temp:
+        temp.write(_bigger_csv_data(n))
+        temp.seek(0)
+        bayeslite.bayesdb_read_csv_file(
+            bdb, 't', temp.name, header=True, create=True)
+    bdb.execute('''
+        CREATE GENERATOR t_cc FOR t USING crosscat (
+            GUESS(*),
+            id IGNORE
+        )
+    ''')
+
+    bdb.execute('INITIALIZE {} MODELS FOR t_cc'.format(models))
+    bdb.execute('ANALYZE t_cc MODELS 0-{} FOR 10 ITERATIONS WAIT'.format(
+        models - 1))
+    return bdb
+
+
 def test_estimate_pairwise_similarity_long():
     """
     Tests larger queries that need to be broken into batch inserts of 500
@@ -168,14 +201,31 @@ def test_estimate_pairwise_similarity_long():
             parallel.estimate_pairwise_similarity(
                 bdb_file.name, 't', 't_cc', N=N, overwrite=True
             )
-            assert cursor_to_df(
-                bdb.execute('SELECT * FROM t_similarity')
-            ).shape == (N**2, 3)
+            sim = cursor_to_df(bdb.execute('SELECT * FROM t_similarity'))
+            assert sim.shape == (N**2, 3)
+            # The pairs are those among the first N rows.
+            assert set(sim.rowid0) == set(sim.rowid1) == set(range(1, N+1))
         # N too high should fail
         with pytest.raises(BLE):
             parallel.estimate_pairwise_similarity(
                 bdb_file.name, 't', 't_cc', N=41, overwrite=True
             )
+        # Bad chunksize should fail
+        with pytest.raises(BLE):
+            parallel.estimate_pairwise_similarity(
+                bdb_file.name, 't', 't_cc', chunksize=0, overwrite=True
+            )
+
+        # Many small chunks, more than fit in the queue at once, should
+        # stream into the same table.
+        parallel.estimate_pairwise_similarity(
+            bdb_file.name, 't', 't_cc', sim_table='t_similarity_chunked',
+            cores=2, chunksize=7
+        )
+        chunked_sim = cursor_to_df(
+            bdb.execute('SELECT * FROM t_similarity_chunked')
+        ).sort_values(by=['rowid0', 'rowid1'])
+        chunked_sim.index = range(chunked_sim.shape[0])
 
         parallel_sim = cursor_to_df(
             bdb.execute('SELECT * FROM t_similarity')
@@ -187,3 +237,518 @@ def test_estimate_pairwise_similarity_long():
         )
 
         assert_frame_equal(std_sim, parallel_sim, check_column_type=True)
+        assert_frame_equal(std_sim, chunked_sim, check_column_type=True)
+
+
+def test_estimate_pairwise_similarity_symmetric():
+    """
+    Tests that estimating only the upper triangle still presents the full
+    similarity matrix.
+    """
+    with tempfile.NamedTemporaryFile(suffix='.bdb') as bdb_file:
+        bdb = _analyzed_bdb(bdb_file.name, 20)
+
+        parallel.estimate_pairwise_similarity(
+            bdb_file.name, 't', 't_cc', symmetric=True, chunksize=11
+        )
+        # Only the upper triangle is stored...
+        assert cursor_to_df(
+            bdb.execute('SELECT * FROM t_similarity_triangle')
+        ).shape == (20 * 21 / 2, 3)
+        assert bdb.sql_execute('''
+            SELECT tbl_name FROM sqlite_master WHERE name = ?
+        ''', ('t_similarity_triangle_rowids',)).fetchall() == \
+            [('t_similarity_triangle',)]
+
+        # ...but the view has all of the pairs.
+        symmetric_sim = cursor_to_df(
+            bdb.execute('SELECT * FROM t_similarity')
+        ).sort_values(by=['rowid0', 'rowid1'])
+        symmetric_sim.index = range(symmetric_sim.shape[0])
+        std_sim = cursor_to_df(
+            bdb.execute('ESTIMATE SIMILARITY FROM PAIRWISE t_cc')
+        )
+        assert_frame_equal(std_sim, symmetric_sim, check_column_type=True)
+
+        # Should complain if overwrite flag is not set, but the view exists
+        with pytest.raises(SQLError):
+            parallel.estimate_pairwise_similarity(
+                bdb_file.name, 't', 't_cc', symmetric=True
+            )
+        # Should be able to overwrite the view with a table and back again
+        parallel.estimate_pairwise_similarity(
+            bdb_file.name, 't', 't_cc', overwrite=True
+        )
+        # An existing table leaves no triangle table behind either
+        with pytest.raises(SQLError):
+            parallel.estimate_pairwise_similarity(
+                bdb_file.name, 't', 't_cc', symmetric=True
+            )
+        assert not bayeslite.core.bayesdb_has_table(
+            bdb, 't_similarity_triangle')
+        parallel.estimate_pairwise_similarity(
+            bdb_file.name, 't', 't_cc', symmetric=True, overwrite=True
+        )
+
+
+def test_row_blocks():
+    """
+    Tests that rows are split into blocks owning about chunksize pairs.
+    """
+    rowids = [1, 2, 3, 5, 8]
+    assert parallel._row_blocks(rowids, 1, False) == \
+        [(1, 1), (2, 2), (3, 3), (5, 5), (8, 8)]
+    assert parallel._row_blocks(rowids, 10, False) == \
+        [(1, 2), (3, 5), (8, 8)]
+    # Rows further down the upper triangle own fewer pairs.
+    assert parallel._row_blocks(rowids, 7, True) == [(1, 2), (3, 8)]
+    assert parallel._row_blocks(rowids, 100, True) == [(1, 8)]
+    assert parallel._row_blocks([], 10, True) == []
+
+
+def test_parallel_bdb_reuse():
+    """
+    Tests that one pool of workers serves several queries, including after
+    one of them fails.
+    """
+    with tempfile.NamedTemporaryFile(suffix='.bdb') as bdb_file:
+        bdb = _analyzed_bdb(bdb_file.name, 10)
+
+        with pytest.raises(BLE):
+            parallel.ParallelBdb(bdb_file.name, cores=0)
+
+        std_sim = cursor_to_df(
+            bdb.execute('ESTIMATE SIMILARITY FROM PAIRWISE t_cc')
+        )
+        with parallel.ParallelBdb(bdb_file.name, cores=2) as pbdb:
+            for sim_table in ['t_similarity', 't_similarity_2']:
+                parallel.estimate_pairwise_similarity(
+                    bdb_file.name, 't', 't_cc', sim_table=sim_table,
+                    chunksize=10, pool=pbdb
+                )
+                with pytest.raises(Exception):
+                    pbdb.stream(
+                        'ESTIMATE SIMILARITY FROM PAIRWISE nonexistent_cc',
+                        [()], lambda df: None)
+            for sim_table in ['t_similarity', 't_similarity_2']:
+                parallel_sim = cursor_to_df(
+                    bdb.execute('SELECT * FROM {}'.format(sim_table))
+                ).sort_values(by=['rowid0', 'rowid1'])
+                parallel_sim.index = range(parallel_sim.shape[0])
+                assert_frame_equal(
+                    std_sim, parallel_sim, check_column_type=True)
+            # The workers see models analyzed while the pool is open.
+            bdb.execute('ANALYZE t_cc MODELS 0-2 FOR 2 ITERATIONS WAIT')
+            std_sim = cursor_to_df(
+                bdb.execute('ESTIMATE SIMILARITY FROM PAIRWISE t_cc')
+            )
+            parallel.estimate_pairwise_similarity(
+                bdb_file.name, 't', 't_cc', overwrite=True, chunksize=10,
+                pool=pbdb
+            )
+            parallel_sim = cursor_to_df(
+                bdb.execute('SELECT * FROM t_similarity')
+            ).sort_values(by=['rowid0', 'rowid1'])
+            parallel_sim.index = range(parallel_sim.shape[0])
+            assert_frame_equal(std_sim, parallel_sim, check_column_type=True)
+
+
+def test_parallel_bdb_journal_mode():
+    """
+    Tests that the pool switches the database to write-ahead logging only
+    while it is open, and only if asked to.
+    """
+    with tempfile.NamedTemporaryFile(suffix='.bdb') as bdb_file:
+        bayeslite.bayesdb_open(bdb_file.name).close()
+
+        def journal_mode():
+            bdb = bayeslite.bayesdb_open(bdb_file.name)
+            try:
+                return bdb.sql_execute('PRAGMA journal_mode').fetchall()[0][0]
+            finally:
+                bdb.close()
+
+        assert journal_mode() == 'delete'
+        with parallel.ParallelBdb(bdb_file.name, cores=2):
+            assert journal_mode() == 'wal'
+        assert journal_mode() == 'delete'
+        with parallel.ParallelBdb(bdb_file.name, cores=2, wal=False):
+            assert journal_mode() == 'delete'
+
+
+def test_execute():
+    """
+    Tests splitting row-wise queries by rows against the same queries run
+    serially.
+    """
+    with tempfile.NamedTemporaryFile(suffix='.bdb') as bdb_file:
+        bdb = _analyzed_bdb(bdb_file.name, 30)
+
+        for bql, bindings in [
+                ('ESTIMATE _rowid_, PREDICTIVE PROBABILITY OF one FROM t_cc',
+                 ()),
+                ('ESTIMATE _rowid_, SIMILARITY TO (_rowid_ = ?) FROM t_cc'
+                 ' WHERE one > ?', (3, 1)),
+                # Scalar max, not the aggregate.
+                ('ESTIMATE _rowid_, MAX(one, two) FROM t_cc', ()),
+                ('INFER EXPLICIT _rowid_, four, PREDICT four CONFIDENCE c'
+                 ' FROM t_cc', ()),
+        ]:
+            std = cursor_to_df(bdb.execute(bql, bindings))
+            par = parallel.execute(
+                bdb_file.name, bql, bindings, cores=2, chunksize=7)
+            if bql.startswith('INFER'):
+                # Predictions are sampled, so only their layout matches.
+                assert list(par.columns) == list(std.columns)
+                assert list(par._rowid_) == list(std._rowid_)
+                assert list(par.four) == list(std.four)
+            else:
+                assert_frame_equal(std, par, check_column_type=True)
+
+        bql = 'ESTIMATE _rowid_, PREDICTIVE PROBABILITY OF two FROM t_cc'
+        std = cursor_to_df(bdb.execute(bql))
+        # Partition by a column with repeated values.
+        par = parallel.execute(
+            bdb_file.name, bql, partition_by='three', cores=2, chunksize=4)
+        par = par.sort_values(by=par.columns[0])
+        par.index = range(par.shape[0])
+        assert_frame_equal(std, par, check_column_type=True)
+
+        # Results can go into a table instead.
+        parallel.execute(bdb_file.name, bql, into='t_pp', cores=2)
+        with pytest.raises(BLE):
+            parallel.execute(bdb_file.name, bql, into='t_pp', cores=2)
+        parallel.execute(
+            bdb_file.name, bql, into='t_pp', overwrite=True, cores=2)
+        into = cursor_to_df(bdb.execute('SELECT * FROM t_pp ORDER BY 1'))
+        assert_frame_equal(std, into, check_column_type=True)
+
+        # No rows, no results.
+        assert parallel.execute(
+            bdb_file.name, bql + ' WHERE one > 100', cores=2).empty
+
+        # Queries which combine rows cannot be split.
+        for bad in [
+                bql + ' LIMIT 3',
+                bql + ' ORDER BY _rowid_',
+                'ESTIMATE AVG(PREDICTIVE PROBABILITY OF one) FROM t_cc',
+                'ESTIMATE COUNT(*) FROM t_cc',
+                'ESTIMATE DISTINCT PREDICTIVE PROBABILITY OF one FROM t_cc',
+                'INFER EXPLICIT COUNT(DISTINCT one) FROM t_cc',
+                'ESTIMATE PAIRWISE SIMILARITY FROM PAIRWISE t_cc',
+                'SELECT * FROM t',
+                bql + '; ' + bql,
+        ]:
+            with pytest.raises(BLE):
+                parallel.execute(bdb_file.name, bad, cores=2)
+        with pytest.raises(BLE):
+            parallel.execute(bdb_file.name, bql, cores=2, chunksize=0)
+        with pytest.raises(BLE):
+            parallel.execute(
+                bdb_file.name,
+                'ESTIMATE PREDICTIVE PROBABILITY OF one FROM nonexistent_cc')
+
+
+def test_execute_by_model():
+    """
+    Tests splitting queries by model against the same queries run USING
+    MODEL each model in turn.
+    """
+    with tempfile.NamedTemporaryFile(suffix='.bdb') as bdb_file:
+        bdb = _analyzed_bdb(bdb_file.name, 10, models=4)
+
+        bql = 'ESTIMATE _rowid_, PREDICTIVE PROBABILITY OF one AS pp' \
+            ' FROM t_cc {} WHERE two >= ?'
+        per_model = [
+            cursor_to_df(bdb.execute(
+                bql.format('USING MODEL ?'), (modelno, 1)))
+            for modelno in range(4)
+        ]
+        bql = bql.format('')
+
+        par = parallel.execute_by_model(bdb_file.name, bql, (1,), cores=2)
+        assert list(par.columns) == ['modelno'] + list(per_model[0].columns)
+        for modelno, std in enumerate(per_model):
+            df = par[par.modelno == modelno].drop('modelno', axis=1)
+            df.index = range(df.shape[0])
+            assert_frame_equal(std, df, check_column_type=True)
+
+        par = parallel.execute_by_model(
+            bdb_file.name, bql, (1,), modelnos=[1, 3], cores=2)
+        assert sorted(set(par.modelno)) == [1, 3]
+
+        pp = 'pp'
+        mean = parallel.execute_by_model(
+            bdb_file.name, bql, (1,), reduce='mean', cores=2)
+        assert list(mean[mean.columns[0]]) == \
+            list(per_model[0][per_model[0].columns[0]])
+        assert np.allclose(
+            mean[pp], np.mean([df[pp] for df in per_model], axis=0))
+        logmeanexp = parallel.execute_by_model(
+            bdb_file.name, bql, (1,), reduce='logmeanexp', cores=2)
+        assert np.allclose(
+            logmeanexp[pp],
+            [logmeanexp_1(values)
+             for values in zip(*[df[pp] for df in per_model])])
+
+        # Per-model aggregates, as in plot_utils.mi_hist.
+        dep = parallel.execute_by_model(
+            bdb_file.name,
+            'ESTIMATE DEPENDENCE PROBABILITY OF one WITH two FROM t_cc'
+            ' LIMIT 1', cores=2)
+        assert dep.shape == (4, 2)
+
+        with pytest.raises(BLE):
+            parallel.execute_by_model(
+                bdb_file.name, bql, (1,), reduce='median', cores=2)
+        with pytest.raises(BLE):
+            parallel.execute_by_model(
+                bdb_file.name,
+                'ESTIMATE PREDICTIVE PROBABILITY OF one FROM t_cc'
+                ' USING MODEL 0', cores=2)
+        with pytest.raises(BLE):
+            parallel.execute_by_model(bdb_file.name, 'SELECT * FROM t')
+
+
+def test_logmeanexp():
+    """
+    Tests the elementwise logmeanexp against bayeslite's scalar one.
+    """
+    for values in [[0., 1., 2.], [-1000., -1001.], [-np.inf, 0.],
+                   [-np.inf, -np.inf], [np.inf, 0.]]:
+        assert np.allclose(
+            parallel._logmeanexp([[v] for v in values])[0],
+            logmeanexp_1(values))
+
+
+def test_estimate_pairwise_similarity_files():
+    """
+    Tests saving similarities as dense and sparse NumPy files against a
+    standard estimate pairwise similarity.
+    """
+    with tempfile.NamedTemporaryFile(suffix='.bdb') as bdb_file:
+        bdb = _analyzed_bdb(bdb_file.name, 20)
+
+        std_sim = cursor_to_df(
+            bdb.execute('ESTIMATE SIMILARITY FROM PAIRWISE t_cc'))
+        std = np.zeros((20, 20), dtype=np.float32)
+        std[std_sim.rowid0.astype(int) - 1, std_sim.rowid1.astype(int) - 1] = \
+            std_sim.value
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'sim')
+            for symmetric in [False, True]:
+                parallel.estimate_pairwise_similarity(
+                    bdb_file.name, 't', 't_cc', cores=2, chunksize=30,
+                    output='dense', path=path, symmetric=symmetric,
+                    overwrite=True)
+                sim = parallel.SimilarityMatrix(path)
+                assert not sim.sparse
+                assert len(sim) == 20
+                for rowid in [1, 7, 20]:
+                    rowids, values = sim.row(rowid)
+                    assert list(rowids) == range(1, 21)
+                    assert np.allclose(values, std[rowid - 1])
+            with pytest.raises(BLE):
+                parallel.estimate_pairwise_similarity(
+                    bdb_file.name, 't', 't_cc', output='dense', path=path)
+            with pytest.raises(BLE):
+                sim.row(21)
+
+            neighbors = sim.neighbors(7, k=5)
+            assert list(neighbors.columns) == ['rowid1', 'value']
+            assert np.allclose(neighbors.value, sorted(std[6])[::-1][:5])
+            assert np.allclose(
+                std[6][neighbors.rowid1.values - 1], neighbors.value)
+
+            # Top k of each row, with the pairs counted in both rows when
+            # symmetric.
+            for symmetric in [False, True]:
+                parallel.estimate_pairwise_similarity(
+                    bdb_file.name, 't', 't_cc', cores=2, chunksize=30,
+                    output='sparse', path=path, top_k=4, symmetric=symmetric,
+                    overwrite=True)
+                sim = parallel.SimilarityMatrix(path)
+                assert sim.sparse
+                for rowid in range(1, 21):
+                    rowids, values = sim.row(rowid)
+                    assert len(rowids) == 4
+                    assert np.allclose(
+                        sorted(values), sorted(std[rowid - 1])[-4:])
+                    assert np.allclose(std[rowid - 1][rowids - 1], values)
+
+            # The same from crosscat's clusters, without the pairs which
+            # share none.
+            parallel.estimate_pairwise_similarity(
+                bdb_file.name, 't', 't_cc', cores=2, chunksize=30,
+                output='sparse', path=path, top_k=4, use_clusters=True,
+                overwrite=True)
+            sim = parallel.SimilarityMatrix(path)
+            for rowid in range(1, 21):
+                rowids, values = sim.row(rowid)
+                assert len(rowids) == min(4, np.sum(std[rowid - 1] > 0))
+                assert np.allclose(
+                    sorted(values), sorted(std[rowid - 1])[-len(values):])
+                assert np.allclose(std[rowid - 1][rowids - 1], values)
+
+            # Everything above a threshold.
+            parallel.estimate_pairwise_similarity(
+                bdb_file.name, 't', 't_cc', cores=2, chunksize=30,
+                output='sparse', path=path, threshold=0.5, symmetric=True,
+                overwrite=True)
+            sim = parallel.SimilarityMatrix(path)
+            for rowid in range(1, 21):
+                rowids, values = sim.row(rowid)
+                assert list(rowids) == \
+                    list(np.nonzero(std[rowid - 1] >= 0.5)[0] + 1)
+                assert np.allclose(values, std[rowid - 1][rowids - 1])
+
+            for kwargs in [
+                    dict(output='sparse', path=path, overwrite=True),
+                    dict(output='sparse', path=path, top_k=0, overwrite=True),
+                    dict(output='dense'),
+                    dict(output='csv', path=path),
+                    dict(threshold=0.5),
+                    dict(output='sparse', path=path, threshold=0.5,
+                         use_clusters=True, overwrite=True),
+            ]:
+                with pytest.raises(BLE):
+                    parallel.estimate_pairwise_similarity(
+                        bdb_file.name, 't', 't_cc', **kwargs)
+            with pytest.raises(BLE):
+                parallel.SimilarityMatrix(tmpdir)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+_similarity_arrays = parallel._similarity_arrays
+
+
+def _failing_similarity_arrays(query_string, params):
+    """Fail to estimate the block of rows starting at rowid 5."""
+    if params[0] == 5:
+        raise ValueError('Simulated failure')
+    return _similarity_arrays(query_string, params)
+
+
+# File whose absence makes _dying_similarity_arrays kill its worker.
+_die_unless_exists = None
+
+
+def _dying_similarity_arrays(query_string, params):
+    """Kill the worker estimating the block of rows starting at rowid 5,
+    the first time only."""
+    if params[0] == 5 and not os.path.exists(_die_unless_exists):
+        open(_die_unless_exists, 'w').close()
+        os._exit(1)
+    return _similarity_arrays(query_string, params)
+
+
+_run_task = parallel._run_task
+
+
+def _dying_run_task(key, func, args, queue, running):
+    """Kill the worker given the block of rows starting at rowid 5 before it
+    lists the task as running, the first time only."""
+    if args[1][0] == 5 and not os.path.exists(_die_unless_exists):
+        open(_die_unless_exists, 'w').close()
+        os._exit(1)
+    return _run_task(key, func, args, queue, running)
+
+
+def _always_dying_run_task(key, func, args, queue, running):
+    """Kill the worker given the block of rows starting at rowid 5 before it
+    lists the task as running."""
+    if args[1][0] == 5:
+        os._exit(1)
+    return _run_task(key, func, args, queue, running)
+
+
+def test_estimate_pairwise_similarity_resume(monkeypatch):
+    """
+    Tests that failed blocks of rows are retried, and that a job which
+    failed can be resumed.
+    """
+    global _die_unless_exists
+    with tempfile.NamedTemporaryFile(suffix='.bdb') as bdb_file:
+        bdb = _analyzed_bdb(bdb_file.name, 20)
+
+        std_sim = cursor_to_df(
+            bdb.execute('ESTIMATE SIMILARITY FROM PAIRWISE t_cc'))
+
+        def check_sim():
+            sim = cursor_to_df(
+                bdb.execute('SELECT * FROM t_similarity')
+            ).sort_values(by=['rowid0', 'rowid1'])
+            sim.index = range(sim.shape[0])
+            assert_frame_equal(std_sim, sim, check_column_type=True)
+
+        # Nothing to resume yet.
+        with pytest.raises(BLE):
+            parallel.estimate_pairwise_similarity(
+                bdb_file.name, 't', 't_cc', resume=True)
+
+        # One block of rows fails every time, but the rest get in.
+        monkeypatch.setattr(
+            parallel, '_similarity_arrays', _failing_similarity_arrays)
+        with pytest.raises(ValueError):
+            parallel.estimate_pairwise_similarity(
+                bdb_file.name, 't', 't_cc', cores=2, chunksize=20,
+                retries=1)
+        assert cursor_to_df(
+            bdb.execute('SELECT * FROM t_similarity')).shape == (19 * 20, 3)
+        monkeypatch.undo()
+
+        for kwargs in [
+                dict(symmetric=True),
+                dict(overwrite=True),
+                dict(output='dense', path='t_similarity'),
+        ]:
+            with pytest.raises(BLE):
+                parallel.estimate_pairwise_similarity(
+                    bdb_file.name, 't', 't_cc', resume=True, **kwargs)
+
+        # Resuming estimates just the failed block.
+        parallel.estimate_pairwise_similarity(
+            bdb_file.name, 't', 't_cc', cores=2, resume=True)
+        check_sim()
+        assert bdb.sql_execute(
+            'SELECT COUNT(*) FROM bdbcontrib_similarity_chunk'
+        ).fetchvalue() == 0
+        with pytest.raises(BLE):
+            parallel.estimate_pairwise_similarity(
+                bdb_file.name, 't', 't_cc', resume=True)
+
+        # A worker which dies has its block retried.
+        tmpdir = tempfile.mkdtemp()
+        try:
+            _die_unless_exists = os.path.join(tmpdir, 'died')
+            monkeypatch.setattr(
+                parallel, '_similarity_arrays', _dying_similarity_arrays)
+            parallel.estimate_pairwise_similarity(
+                bdb_file.name, 't', 't_cc', cores=2, chunksize=20,
+                overwrite=True)
+            assert os.path.exists(_die_unless_exists)
+            check_sim()
+            monkeypatch.undo()
+
+            # So does one which dies before the task is listed as running.
+            os.remove(_die_unless_exists)
+            monkeypatch.setattr(parallel, '_run_task', _dying_run_task)
+            parallel.estimate_pairwise_similarity(
+                bdb_file.name, 't', 't_cc', cores=2, chunksize=20,
+                overwrite=True)
+            assert os.path.exists(_die_unless_exists)
+            check_sim()
+
+            # A block whose worker always dies is reported, not waited for.
+            monkeypatch.setattr(
+                parallel, '_run_task', _always_dying_run_task)
+            with pytest.raises(BLE):
+                parallel.estimate_pairwise_similarity(
+                    bdb_file.name, 't', 't_cc', cores=2, chunksize=20,
+                    overwrite=True, retries=1)
+            monkeypatch.undo()
+        finally:
+            shutil.rmtree(tmpdir)
@@ -114,3 +114,23 @@ def test_similar_rows(dts_df):
     if len(call_types) > 0:
         call_counts = call_types.iloc[:,0].value_counts()
         assert 'warn' not in call_counts
+
+def test_similar_rows_by_clusters(dts_df):
+    dts, _df = dts_df
+    rowid = dts.query('SELECT _rowid_ FROM %t WHERE "index" = 3').ix[0][0]
+    result = dts.quick_similar_rows(identify_row_by={'index': 3}, nsimilar=5,
+                                    use_clusters=True)
+    expected = dts.query('''ESTIMATE _rowid_, SIMILARITY TO (_rowid_ = ?)
+                            FROM %g''', (rowid,))
+    expected = dict(zip(expected.iloc[:, 0], expected.iloc[:, 1]))
+    assert 5 == len(result)
+    # The row itself is among the most similar, maybe tied with others.
+    assert 3 in result['index'].tolist()
+    assert 1 == result['similarity_to_3'][0]
+    similarities = result['similarity_to_3'].tolist()
+    assert sorted(similarities, reverse=True) == similarities
+    assert similarities[-1] >= sorted(expected.values())[-5] - 1e-9
+    rowids = dts.query('SELECT _rowid_, "index" FROM %t')
+    rowid_of = dict(zip(rowids.iloc[:, 1], rowids.iloc[:, 0]))
+    for index, value in zip(result['index'], similarities):
+      assert abs(expected[rowid_of[index]] - value) < 1e-9
@@ -16,6 +16,8 @@
 
 import numpy as np
 import pandas as pd
+import pytest
+
 from bdbcontrib.predictors import sklearn_utils as sku
 
 def test_extract_sklearn_dataset():
@@ -71,6 +73,28 @@ def test_extract_sklearn_features_categorical():
         [0, 0, 0, 1, 0, 0, 1]])
     assert np.array_equal(matrix, expected)
 
+def test_extract_sklearn_features_categorical_sparse():
+    dataset = pd.DataFrame({
+        'Nationality':['USA', None, 'France', 'Germany', 'Bengal'],
+        'Gender':['M', 'F', 'M', 'M', 'T'],
+        })
+    dataset = dataset.where((pd.notnull(dataset)), None)
+    categories = ['Nationality', 'Gender']
+    categories_to_val_map = sku.build_categorical_to_value_map(categories,
+        dataset)
+    matrix = sku.extract_sklearn_features_categorical(categories,
+        categories_to_val_map, dataset, sparse=True)
+    assert matrix.nnz == 10
+    expected = [sku.binarize_categorical_row(categories,
+        categories_to_val_map, list(row)) for row in dataset[categories].values]
+    assert np.array_equal(matrix.toarray(), expected)
+    assert np.array_equal(sku.extract_sklearn_features_categorical(
+        categories, categories_to_val_map, dataset), expected)
+    # Values without a code are rejected as by the lookup dictionary.
+    with pytest.raises(KeyError):
+        sku.extract_sklearn_features_categorical(['Gender'],
+            {'Gender': {'M':0, 'F':1}}, dataset)
+
 def test_build_categorical_to_value_map():
     dataset = pd.DataFrame({
         'Nationality':['USA', 'USA', 'France', 'Germany', 'Bengal'],